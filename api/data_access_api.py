@@ -1,8 +1,8 @@
-from multiprocessing.pool import ThreadPool
-from zipfile import ZipFile, ZIP_STORED
-
 from boto.utils import JSONDecodeError
 from datetime import datetime
+from functools import partial
+from zipfile import ZIP_DEFLATED
+
 from flask import Blueprint, request, abort, json, Response
 
 from config import load_django
@@ -10,12 +10,16 @@ from config import load_django
 from config.constants import (API_TIME_FORMAT, VOICE_RECORDING, ALL_DATA_STREAMS,
     SURVEY_ANSWERS, SURVEY_TIMINGS, IMAGE_FILE)
 from database.models import is_object_id
-from database.data_access_models import ChunkRegistry
+from database.data_access_models import ChunkRegistry, DownloadCursor
 from database.study_models import Study
 from database.user_models import Participant, Researcher
-from libs.s3 import s3_retrieve, s3_upload
-from libs.streaming_bytes_io import StreamingBytesIO
+from libs.chunk_cache import cacheable_hash
+from libs.s3 import s3_upload_stream
+from libs.streaming_tar import DEFAULT_ZSTD_LEVEL, MAX_ZSTD_LEVEL, StreamingZstdTarFile, zstandard
+from libs.streaming_zip import DEFAULT_DEFLATE_LEVEL, StreamingZipFile
+from libs.study_key_cache import study_key_cache
 from libs.parse_filename import parse_filename
+from libs.zip_download import DownloadBlocks, PrefetchingDownload
 from database.data_access_models import PipelineUpload, InvalidUploadParameterError, PipelineUploadTags
 
 # Data Notes
@@ -25,6 +29,11 @@ from database.data_access_models import PipelineUpload, InvalidUploadParameterEr
 
 data_access_api = Blueprint('data_access_api', __name__)
 
+# The member of a compressed download that holds the sizes of its files before and after compression.
+COMPRESSION_STATS_FILE_NAME = "compression"
+# The member of an incremental download that holds the range of update times of its files.
+CURSOR_FILE_NAME = "cursor"
+
 #########################################################################################
 
 def get_and_validate_study_id(chunked_download=False):
@@ -142,6 +151,7 @@ def get_data():
     JSON blobs: data streams, users - default to all
     Strings: date-start, date-end - format as "YYYY-MM-DDThh:mm:ss"
     optional: top-up = a file (registry.dat)
+    optional: cursor = the name of a server-side download cursor, replaces the registry
     cases handled:
         missing creds or study, invalid researcher or study, researcher does not have access
         researcher creds are invalid
@@ -153,17 +163,21 @@ def get_data():
     # return abort(503)
     
     study = get_and_validate_study_id(chunked_download=True)
-    get_and_validate_researcher(study)
+    researcher = get_and_validate_researcher(study)
    
  
     query = {}
     determine_data_streams_for_db_query(query)  # select data streams
     determine_users_for_db_query(query)  # select users
     determine_time_range_for_db_query(query)  # construct time ranges
+    archive = determine_archive()
+    cursor = determine_download_cursor(researcher, study, query)
     
 
     # Do query (this is actually a generator)
-    if "registry" in request.values:
+    if cursor is not None:
+        get_these_files = handle_database_query(study.pk, query, updated_after=cursor.high_water_mark)
+    elif "registry" in request.values:
         get_these_files = handle_database_query(study.pk, query, registry=parse_registry(request.values["registry"]))
     else:
         get_these_files = handle_database_query(study.pk, query, registry=None)
@@ -174,85 +188,104 @@ def get_data():
     # Oddly, it is the presence of  mimetype=zip that causes the streaming response to actually stream.
     if 'web_form' in request.values:
         return Response(
-            zip_generator(get_these_files, construct_registry=False),
-            mimetype="zip",
-            headers={'Content-Disposition': 'attachment; filename="data.zip"'}
+            zip_generator(get_these_files, construct_registry=False, archive=archive, cursor=cursor),
+            mimetype=archive.mimetype,
+            headers={'Content-Disposition': 'attachment; filename="data.%s"' % archive.file_extension}
         )
     else:
         return Response(
-                zip_generator(get_these_files, construct_registry=True),
-                mimetype="zip"
+                zip_generator(get_these_files, construct_registry=cursor is None, archive=archive,
+                              cursor=cursor),
+                mimetype=archive.mimetype
         )
 
 
 # from libs.security import generate_random_string
 
 # Note: you cannot access the request context inside a generator function
-def zip_generator(files_list, construct_registry=False):
+def zip_generator(files_list, construct_registry=False, archive=None, cursor=None):
     """ Pulls in data from S3 in a multithreaded network operation, constructs a zip file of that
     data. This is a generator, advantage is it starts returning data (file by file, but wrapped
-    in zip compression) almost immediately. """
-    
+    in zip compression) almost immediately.
+    archive is the StreamingZipFile or StreamingZstdTarFile to write, an uncompressed zip file by
+    default.  cursor is the DownloadCursor of an incremental download, see stream_zip. """
+    archive = archive or StreamingZipFile()
+    # chunks that are stored compressed are copied into a compressed zip file as they are.
+    open_file = partial(batch_retrieve_s3, deflated=archive.copies_deflated_data)
+    download = PrefetchingDownload(files_list, partial(prepare_download, open_file, archive), "data")
+    return stream_zip(download, archive, determine_file_name, construct_registry=construct_registry,
+                      cursor=cursor)
+
+
+def prepare_download(open_file, archive, item):
+    """ Opens a file and lets the archive prepare it, on a thread of a PrefetchingDownload. """
+    return archive.prepare(open_file(item))
+
+
+def stream_zip(download, zip_file, file_name_function, construct_registry=False, cursor=None,
+               skip_duplicate_names=True):
+    """ Yields a zip file (or another archive with the same methods) of the files of a
+    PrefetchingDownload, in order, with each file named by file_name_function(item).  Files are
+    passed on a block at a time as they are downloaded, stored blocks are yielded as they are
+    rather than copied into the zip buffer.  A registry of the chunk paths and hashes of the files
+    is added at the end if construct_registry is set, and the sizes of the files before and after
+    compression if the archive is compressed.
+    Only the first file with a name is written if skip_duplicate_names is set, pipeline downloads
+    have always written every file.
+    If there is a DownloadCursor the range of update times of the files is added, and the cursor is
+    advanced once the whole archive has been yielded; a download that fails or that the client
+    leaves part way through is sent again in full by the next download with the cursor. """
     processed_files = set()
     duplicate_files = set()
-    pool = ThreadPool(3)
-    # 3 Threads has been heuristically determined to be a good value, it does not cause the server
-    # to be overloaded, and provides more-or-less the maximum data download speed.  This was tested
-    # on an m4.large instance (dual core, 8GB of ram).
     file_registry = {}
-    
-    zip_output = StreamingBytesIO()
-    zip_input = ZipFile(zip_output, mode="w", compression=ZIP_STORED, allowZip64=True)
     # random_id = generate_random_string()[:32]
     # print "returning data for query %s" % random_id
     try:
-        # chunks_and_content is a list of tuples, of the chunk and the content of the file.
-        # chunksize (which is a keyword argument of imap, not to be confused with Beiwe Chunks)
-        # is the size of the batches that are handed to the pool. We always want to add the next
-        # file to retrieve to the pool asap, so we want a chunk size of 1.
-        # (In the documentation there are comments about the timeout, it is irrelevant under this construction.)
-        chunks_and_content = pool.imap_unordered(batch_retrieve_s3, files_list, chunksize=1)
-        total_size = 0
-        for chunk, file_contents in chunks_and_content:
+        for item, file_blocks in download:
             if construct_registry:
-                file_registry[chunk['chunk_path']] = chunk["chunk_hash"]
-            file_name = determine_file_name(chunk)
-            if file_name in processed_files:
-                duplicate_files.add((file_name, chunk['chunk_path']))
+                file_registry[item['chunk_path']] = item["chunk_hash"]
+            file_name = file_name_function(item)
+            if skip_duplicate_names and file_name in processed_files:
+                duplicate_files.add(file_name)
                 continue
             processed_files.add(file_name)
             # print file_name
-            zip_input.writestr(file_name, file_contents)
-            # These can be large, and we don't want them sticking around in memory as we wait for the yield
-            del file_contents, chunk
-            # print len(zip_output)
-            x = zip_output.getvalue()
-            total_size += len(x)
-            # print "%s: %sK, %sM" % (random_id, total_size / 1024, total_size / 1024 / 1024)
-            yield x  # yield the (compressed) file information
-            del x
-            zip_output.empty()
+            for data in zip_file.write_blocks(file_name, file_blocks):
+                yield data
+            del file_blocks, item
         
         if construct_registry:
-            zip_input.writestr("registry", json.dumps(file_registry))
+            yield zip_file.writestr("registry", json.dumps(file_registry))
+        
+        if cursor is not None:
+            yield zip_file.writestr(CURSOR_FILE_NAME, json.dumps({
+                "name": cursor.name,
+                "updated_after": cursor.high_water_mark.isoformat() if cursor.high_water_mark else None,
+                "next_updated_after": cursor.next_high_water_mark.isoformat(),
+            }))
+        
+        if zip_file.compressed:
+            yield zip_file.flush()
+            yield zip_file.writestr(COMPRESSION_STATS_FILE_NAME, json.dumps({
+                "uncompressed_bytes": zip_file.uncompressed_bytes,
+                "compressed_bytes": zip_file.compressed_bytes,
+            }))
+            print("compressed download: %s bytes to %s bytes" %
+                  (zip_file.uncompressed_bytes, zip_file.compressed_bytes))
         
         # close, then yield all remaining data in the zip.
-        zip_input.close()
-        yield zip_output.getvalue()
+        yield zip_file.close()
+        
+        if cursor is not None:
+            cursor.advance()
     
-    except None:
-        # The try-except-finally block is here to guarantee the Threadpool is closed and terminated.
-        # we don't handle any errors, we just re-raise any error that shows up.
-        # (with statement does not work.)
-        raise
     finally:
-        # We rely on the finally block to ensure that the threadpool will be closed and terminated,
-        # and also to print an error to the log if we need to.
-        pool.close()
-        pool.terminate()
+        # The finally block guarantees that the download's thread pool is closed, also when the
+        # client goes away part way through.
+        download.close()
         if duplicate_files:
             duplcate_file_message = "encountered duplicate files: %s" % ",".join(
-                    str(name_path) for name_path in duplicate_files)
+                    str(name) for name in duplicate_files)
 
 
 #########################################################################################
@@ -322,11 +355,10 @@ def str_to_datetime(time_string):
             return abort(400)
 
 
-def batch_retrieve_s3(chunk):
-    """ Data is returned in the form (chunk_object, file_data). """
-    return chunk, s3_retrieve(chunk["chunk_path"],
-                              study_object_id=Study.objects.get(id=chunk["study_id"]).object_id,
-                              raw_path=True)
+def batch_retrieve_s3(chunk, deflated=False):
+    """ Data is returned in the form of a DownloadBlocks of the file. """
+    return DownloadBlocks(chunk["chunk_path"], study_key_cache.get_object_id(chunk["study_id"]),
+                          cacheable_hash(chunk["data_type"], chunk["chunk_hash"]), deflated=deflated)
 
 
 #########################################################################################
@@ -368,6 +400,27 @@ def determine_users_for_db_query(query):
             return abort(404)
 
 
+def determine_archive():
+    """ Returns the archive to write a download to, from the html request: the compression
+    parameter is "stored" (the default, an uncompressed zip file), "deflate" (a compressed zip file)
+    or "zstd" (a zstd compressed tar file), optionally followed by a colon and a compression level.
+    Throws a 400 if the compression is invalid or not available. """
+    compression = request.values.get('compression') or "stored"
+    method, _, level = compression.partition(":")
+    try:
+        level = int(level) if level else None
+    except ValueError:
+        return abort(400)
+    
+    if method == "stored" and level is None:
+        return StreamingZipFile()
+    if method == "deflate" and (level is None or 1 <= level <= 9):
+        return StreamingZipFile(ZIP_DEFLATED, level or DEFAULT_DEFLATE_LEVEL)
+    if method == "zstd" and zstandard is not None and (level is None or 1 <= level <= MAX_ZSTD_LEVEL):
+        return StreamingZstdTarFile(level or DEFAULT_ZSTD_LEVEL)
+    return abort(400)
+
+
 def determine_time_range_for_db_query(query):
     """ Determines, from the html request, the time range that should go into the database query.
     Modifies the provided query object accordingly, there is no return value.
@@ -379,14 +432,30 @@ def determine_time_range_for_db_query(query):
         query['end'] = str_to_datetime(request.values['time_end'])
 
 
-def handle_database_query(study_id, query, registry=None):
+def determine_download_cursor(researcher, study, query):
+    """ Returns the DownloadCursor of the query for the cursor name in the html request, or None if
+    no cursor was provided (old clients send a registry instead).
+    Throws a 400 if the name is too long or a registry is provided as well. """
+    name = request.values.get('cursor')
+    if not name:
+        return None
+    if len(name) > DownloadCursor._meta.get_field('name').max_length or "registry" in request.values:
+        return abort(400)
+    return DownloadCursor.for_query(researcher.pk, study.pk, name, query)
+
+
+def handle_database_query(study_id, query, registry=None, updated_after=None):
     """
     Runs the database query and returns a QuerySet.
+    With updated_after (the high water mark of a DownloadCursor) only the chunks that were added or
+    updated after it are returned, a range scan on the (study, last_updated) index.
     """
     chunk_fields = ["pk", "participant_id", "data_type", "chunk_path", "time_bin", "chunk_hash",
                     "participant__patient_id", "study_id", "survey_id", "survey__object_id"]
 
     chunks = ChunkRegistry.get_chunks_time_range(study_id, **query)
+    if updated_after is not None:
+        chunks = chunks.filter(last_updated__gt=updated_after)
     
     if not registry:
         return chunks.values(*chunk_fields)
@@ -458,9 +527,10 @@ def data_pipeline_upload():
         creation_args, tags = PipelineUpload.get_creation_arguments(request.values, request.files['file'])
     except InvalidUploadParameterError as e:
         return Response(e.message, 400)
-    s3_upload(
+    # the upload is encrypted and sent to S3 in parts as it is read, rather than as a whole.
+    s3_upload_stream(
             creation_args['s3_path'],
-            request.files['file'].read(),
+            request.files['file'],
             Study.objects.get(id=creation_args['study_id']).object_id,
             raw_path=True
     )
@@ -493,55 +563,27 @@ def pipeline_data_download():
     else:
         query = PipelineUpload.objects.filter(study__id=study_obj.id)
     
+    archive = determine_archive()
     ####################################
     return Response(
-            zip_generator_for_pipeline(query),
-            mimetype="zip",
-            headers={'Content-Disposition': 'attachment; filename="data.zip"'}
+            zip_generator_for_pipeline(query, archive),
+            mimetype=archive.mimetype,
+            headers={'Content-Disposition': 'attachment; filename="data.%s"' % archive.file_extension}
     )
     
-#TODO: This is a trivial rewrite of the other zip generator function for minor differences. refactor when you get to django.
-def zip_generator_for_pipeline(files_list):
-    pool = ThreadPool(3)
-    zip_output = StreamingBytesIO()
-    zip_input = ZipFile(zip_output, mode="w", compression=ZIP_STORED, allowZip64=True)
-    try:
-        # chunks_and_content is a list of tuples, of the chunk and the content of the file.
-        # chunksize (which is a keyword argument of imap, not to be confused with Beiwe Chunks)
-        # is the size of the batches that are handed to the pool. We always want to add the next
-        # file to retrieve to the pool asap, so we want a chunk size of 1.
-        # (In the documentation there are comments about the timeout, it is irrelevant under this construction.)
-        chunks_and_content = pool.imap_unordered(batch_retrieve_pipeline_s3, files_list, chunksize=1)
-        for pipeline_upload, file_contents in chunks_and_content:
-            # file_name = determine_file_name(chunk)
-            zip_input.writestr("data/" + pipeline_upload.file_name, file_contents)
-            # These can be large, and we don't want them sticking around in memory as we wait for the yield
-            del file_contents, pipeline_upload
-            yield zip_output.getvalue()  # yield the (compressed) file information
-            zip_output.empty()
-        
-        # close, then yield all remaining data in the zip.
-        zip_input.close()
-        yield zip_output.getvalue()
-    
-    except None:
-        # The try-except-finally block is here to guarantee the Threadpool is closed and terminated.
-        # we don't handle any errors, we just re-raise any error that shows up.
-        # (with statement does not work.)
-        raise
-    finally:
-        # We rely on the finally block to ensure that the threadpool will be closed and terminated,
-        # and also to print an error to the log if we need to.
-        pool.close()
-        pool.terminate()
-        
-        
+def zip_generator_for_pipeline(files_list, archive=None):
+    """ As zip_generator, for pipeline uploads. """
+    archive = archive or StreamingZipFile()
+    download = PrefetchingDownload(files_list, partial(prepare_download, batch_retrieve_pipeline_s3, archive),
+                                   "pipeline")
+    return stream_zip(download, archive, lambda pipeline_upload: "data/" + pipeline_upload.file_name,
+                      skip_duplicate_names=False)
+
+
 def batch_retrieve_pipeline_s3(pipeline_upload):
-    """ Data is returned in the form (chunk_object, file_data). """
+    """ Data is returned in the form of a DownloadBlocks of the file. """
     study = Study.objects.get(id = pipeline_upload.study_id)
-    return pipeline_upload, s3_retrieve(pipeline_upload.s3_path,
-                                        study.object_id,
-                                        raw_path=True)
+    return DownloadBlocks(pipeline_upload.s3_path, study.object_id)
 
 
 # class dummy_threadpool():
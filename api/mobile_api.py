@@ -20,6 +20,7 @@ from libs.sentry import make_sentry_client
 from libs.user_authentication import (authenticate_user, authenticate_user_registration,
     authenticate_user_ignore_password)
 from libs.s3 import construct_s3_raw_data_path
+from libs.upload_spool import upload_spool
 
 from database.study_models import ParticipantSurvey
 
@@ -151,6 +152,13 @@ def upload(OS_API=""):
         print('constructing rawdata filename') 
         raw_data_filename = construct_s3_raw_data_path(user.study.object_id, file_name.replace("_", "/"))
         print('rawdata filename {0}'.format(raw_data_filename)) 
+        if upload_spool:
+            # The upload is written to the local spool and acknowledged, the S3 upload and the
+            # database entries below are done by the spool's uploader threads.
+            upload_spool.spool(raw_data_filename, uploaded_file, user.study.object_id,
+                               user.study_id, user.pk)
+            print('file spooled for upload')
+            return render_template('blank.html'), 200
         s3_upload(raw_data_filename, uploaded_file, user.study.object_id, raw_path=True)
         print('file uploaded to s3, now adding to FTP') 
         FileToProcess.append_file_for_processing(raw_data_filename, user.study.object_id, participant=user)
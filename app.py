@@ -12,6 +12,7 @@ from api import (participant_administration, admin_api, copy_study_api, data_acc
 from config.settings import SENTRY_ELASTIC_BEANSTALK_DSN, SENTRY_JAVASCRIPT_DSN
 from libs.admin_authentication import is_logged_in
 from libs.security import set_secret_key
+from libs.upload_spool import upload_spool
 from pages import (admin_pages, mobile_pages, survey_designer, system_admin_pages,
     data_access_web_form)
 
@@ -54,6 +55,11 @@ app.register_blueprint(data_pipeline_api.data_pipeline_api)
 if os.environ['DJANGO_DB_ENV'] != 'local':
     sentry = Sentry(app, dsn=SENTRY_ELASTIC_BEANSTALK_DSN)
 
+# Uploads left in the spool by a previous run, or by a process that died, are sent right away
+# instead of waiting for the next upload to this process.
+if upload_spool:
+    upload_spool.start()
+
 
 @app.route("/<page>.html")
 def strip_dot_html(page):
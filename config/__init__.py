@@ -51,10 +51,28 @@ for mandatory_var in MANDATORY_VARS:
 
 # Environment variables might be unpredictable, so we sanitize the numerical ones as ints.
 constants.DEFAULT_S3_RETRIES = int(constants.DEFAULT_S3_RETRIES)
+constants.S3_MAX_POOL_CONNECTIONS = int(constants.S3_MAX_POOL_CONNECTIONS)
+constants.S3_MULTIPART_THRESHOLD_MB = int(constants.S3_MULTIPART_THRESHOLD_MB)
 constants.CONCURRENT_NETWORK_OPS = int(constants.CONCURRENT_NETWORK_OPS)
+constants.CONCURRENT_PROCESSING_OPS = int(constants.CONCURRENT_PROCESSING_OPS)
 constants.FILE_PROCESS_PAGE_SIZE = int(constants.FILE_PROCESS_PAGE_SIZE)
+constants.BINIFIED_DATA_MEMORY_BUDGET_MB = int(constants.BINIFIED_DATA_MEMORY_BUDGET_MB)
+constants.STUDY_KEY_CACHE_TTL_SECONDS = int(constants.STUDY_KEY_CACHE_TTL_SECONDS)
+constants.PRIVATE_KEY_CACHE_MB = int(constants.PRIVATE_KEY_CACHE_MB)
+constants.PRIVATE_KEY_CACHE_TTL_SECONDS = int(constants.PRIVATE_KEY_CACHE_TTL_SECONDS)
+constants.UPLOAD_SPOOL_UPLOADERS = int(constants.UPLOAD_SPOOL_UPLOADERS)
+constants.CHUNK_CACHE_MB = int(constants.CHUNK_CACHE_MB)
+constants.DOWNLOAD_PREFETCH_MB = int(constants.DOWNLOAD_PREFETCH_MB)
+constants.DOWNLOAD_CONCURRENCY = int(constants.DOWNLOAD_CONCURRENCY)
+constants.CHUNK_COMPRESSION_LEVEL = int(constants.CHUNK_COMPRESSION_LEVEL)
 constants.CELERY_EXPIRY_MINUTES = int(constants.CELERY_EXPIRY_MINUTES)
 
+if constants.SERVER_ENCRYPTION_MODE not in ("ctr", "cfb"):
+    errors.append('SERVER_ENCRYPTION_MODE must be "ctr" or "cfb".')
+
+if not 0 <= constants.CHUNK_COMPRESSION_LEVEL <= 9:
+    errors.append('CHUNK_COMPRESSION_LEVEL must be between 0 and 9.')
+
 # email addresses are parsed from a comma separated list
 # whitespace before and after addresses are stripped
 if settings.SYSADMIN_EMAILS:
@@ -13,14 +13,60 @@ from config.settings import DOMAIN_NAME
 ## Networking
 #This value is used in libs.s3, does what it says.
 DEFAULT_S3_RETRIES = getenv("DEFAULT_S3_RETRIES") or 1
+#Size of the S3 connection pool, 0 sizes it for the thread pools that use it (4x CONCURRENT_NETWORK_OPS).
+S3_MAX_POOL_CONNECTIONS = getenv("S3_MAX_POOL_CONNECTIONS") or 0
+#S3 objects larger than this many megabytes are uploaded in parts and downloaded with parallel ranged requests.
+S3_MULTIPART_THRESHOLD_MB = getenv("S3_MULTIPART_THRESHOLD_MB") or 8
 
 ## File processing directives
 #NOTE: these numbers were determined through trial and error on a C4 Large AWS instance.
 #Used in data download and data processing, base this on CPU core count.
 CONCURRENT_NETWORK_OPS = getenv("CONCURRENT_NETWORK_OPS") or 10
+#Used in file processing, number of worker processes that parse and binify csv files in parallel.
+# 0 or 1 keeps that work on the main process.  Base this on CPU core count.  Celery worker
+# processes need billiard (a Celery dependency) to start a process pool.
+CONCURRENT_PROCESSING_OPS = getenv("CONCURRENT_PROCESSING_OPS") or 0
 #Used in file processing, number of files to be pulled in and processed simultaneously.
 # Higher values reduce s3 usage, reduce processing time, but increase ram requirements.
 FILE_PROCESS_PAGE_SIZE = getenv("FILE_PROCESS_PAGE_SIZE") or 250
+#Used in file processing, megabytes of parsed rows held in memory before the largest time bins are
+# spilled to a temporary file.  0 keeps everything in memory.
+BINIFIED_DATA_MEMORY_BUDGET_MB = getenv("BINIFIED_DATA_MEMORY_BUDGET_MB") or 0
+
+#Number of seconds a study's encryption key is cached by each process.
+STUDY_KEY_CACHE_TTL_SECONDS = getenv("STUDY_KEY_CACHE_TTL_SECONDS") or 300
+
+#Megabytes of parsed participant private keys each process keeps for decrypting uploads, 0 disables.
+PRIVATE_KEY_CACHE_MB = getenv("PRIVATE_KEY_CACHE_MB") or 32
+#Number of seconds a participant's private key is cached by each process.
+PRIVATE_KEY_CACHE_TTL_SECONDS = getenv("PRIVATE_KEY_CACHE_TTL_SECONDS") or 300
+
+#Cipher mode of the files the server encrypts for S3: "cfb" (the original AES-CFB with 8 bit segments,
+# the only mode that servers without versioned encryption can read), or "ctr" (AES-CTR).  Files in
+# either mode are always readable.  Only switch to "ctr" once every web server, data processing
+# server and the lambda run a version that reads it.
+SERVER_ENCRYPTION_MODE = getenv("SERVER_ENCRYPTION_MODE") or "cfb"
+
+#A local directory that mobile uploads are spooled to before being sent to S3 in the background, the
+# upload request is acknowledged once the file is on disk.  Empty sends uploads to S3 during the request.
+UPLOAD_SPOOL_DIRECTORY = getenv("UPLOAD_SPOOL_DIRECTORY") or ""
+#Number of threads in each web server process that send spooled uploads to S3.
+UPLOAD_SPOOL_UPLOADERS = getenv("UPLOAD_SPOOL_UPLOADERS") or 4
+
+#A local directory where decrypted chunks are cached, shared by the processes of a server.  Empty
+# disables the cache.
+CHUNK_CACHE_DIRECTORY = getenv("CHUNK_CACHE_DIRECTORY") or ""
+#Megabytes of chunks kept in the cache, the least recently used chunks are removed past this.
+CHUNK_CACHE_MB = getenv("CHUNK_CACHE_MB") or 2048
+
+#Megabytes of file data a data download may fetch ahead of the client.
+DOWNLOAD_PREFETCH_MB = getenv("DOWNLOAD_PREFETCH_MB") or 32
+#The most S3 requests a data download makes at once, it adapts between 3 and this.
+DOWNLOAD_CONCURRENCY = getenv("DOWNLOAD_CONCURRENCY") or 8
+
+#Chunks of csv data are compressed before they are encrypted at this deflate level (1-9), 0 stores
+# them uncompressed.  Compressed chunks are copied into compressed downloads as they are.
+CHUNK_COMPRESSION_LEVEL = getenv("CHUNK_COMPRESSION_LEVEL") or 0
 
 #This string will be printed into non-error hourly reports to improve error filtering.
 DATA_PROCESSING_NO_ERROR_STRING = getenv("DATA_PROCESSING_NO_ERROR_STRING") or "2HEnBwlawY"
@@ -229,6 +275,12 @@ CHUNKABLE_FILES = {ACCELEROMETER,
                    REACHABILITY,
                    IOS_LOG_FILE}
 
+# Sensor streams with very large numbers of rows, these are binified with numpy.
+HIGH_FREQUENCY_DATA_STREAMS = {ACCELEROMETER,
+                               GYRO,
+                               MAGNETOMETER,
+                               DEVICEMOTION}
+
 ## Survey Question Types
 FREE_RESPONSE = "free_response"
 CHECKBOX = "checkbox"
@@ -9,7 +9,7 @@ except ImportError:
 API_URL_BASE = 'https://staging.beiwe.org/'
 
 from pprint import pprint
-def make_pipeline_request(study_id, access_key=ACCESS_KEY, secret_key=SECRET_KEY, tags=None):
+def make_pipeline_request(study_id, access_key=ACCESS_KEY, secret_key=SECRET_KEY, tags=None, compression=None):
     """
     Behavior This function will download the data from the server, decompress it, and WRITE IT TO
     FILES IN YOUR CURRENT WORKING DIRECTORY. If the data in the current working directory
@@ -29,6 +29,9 @@ def make_pipeline_request(study_id, access_key=ACCESS_KEY, secret_key=SECRET_KEY
     Tags Provide a list to tags.  Any pipeline files that matche any tags will be downloaded.  If
     you provide an empty list of tags no data will be returned.  If you provide no tags at all (a
     None, the default value) you will get all files that match the study.
+
+    Compression As in download_data.make_request: "stored" (the default), "deflate" or "zstd",
+    optionally followed by a colon and a compression level.  A zstd download is a .tar.zst file.
     """
     
     if access_key is None or secret_key is None:
@@ -44,6 +47,8 @@ def make_pipeline_request(study_id, access_key=ACCESS_KEY, secret_key=SECRET_KEY
         if not isinstance(tags, list):
             raise TypeError("tags must be a list, received %s" % type(tags))
         values['tags'] = json.dumps(tags)
+    if compression:
+        values['compression'] = compression
     
     print "sending request, this could take some time."
     # print values
@@ -58,8 +63,10 @@ def make_pipeline_request(study_id, access_key=ACCESS_KEY, secret_key=SECRET_KEY
 
     return_data = response.read()
     
-    print "writing file to the_downloaded_data.zip"
-    with open("the_downloaded_data.zip", "w") as f:
+    file_name = "the_downloaded_data.tar.zst" if compression and compression.startswith("zstd") \
+        else "the_downloaded_data.zip"
+    print "writing file to %s" % file_name
+    with open(file_name, "w") as f:
         f.write(return_data)
     
     print "Operations complete."
@@ -1,4 +1,4 @@
-import urllib, urllib2, StringIO, zipfile, json
+import urllib, urllib2, StringIO, tarfile, zipfile, json
 from datetime import datetime
 from os import path
 # Comment out the following import to disable the credentials file.
@@ -25,7 +25,7 @@ IOS_LOG = "ios_log"
 DEBUG = False
 
 def make_request(study_id, access_key=ACCESS_KEY, secret_key=SECRET_KEY, user_ids=None, data_streams=None,
-                 time_start=None, time_end=None):
+                 time_start=None, time_end=None, compression=None, cursor=None):
     """
     Behavior
     This function will download the data from the server, decompress it, and WRITE IT TO FILES IN YOUR CURRENT WORKING DIRECTORY.
@@ -54,6 +54,15 @@ def make_request(study_id, access_key=ACCESS_KEY, secret_key=SECRET_KEY, user_id
     Default behavior: if you provide no start time parameter data will be returned starting from the beginning of time for that user; if you provide no end time parameter data will be returned up to the most current indexed data.
     NOTE: granularity of requesting time is by hour, data will be updated on the server roughly once an hour.
     NOTE: Use the string from this module's API_TIME_FORMAT variable if you are using the Python DateTime library to generate date strings, or investigate the commented out lines of code in this function.
+
+    Compression
+    Data files are mostly csvs that compress well, on a slow connection a compressed download can be many times faster.
+    compression is "stored" (no compression), "deflate" (a compressed zip file) or "zstd" (a zstd compressed tar file, this requires the zstandard package), optionally followed by a colon and a compression level, e.g. "deflate:9" or "zstd:10".
+    Default behavior: if you provide no compression the data is not compressed.
+
+    Cursors
+    If you provide a cursor, a name of your choosing for this copy of the data (e.g. the name of your computer), the server remembers what it has sent you for this query and next time only sends the files that were added or updated since.  This replaces the master_registry file, which can grow very large for long-running studies.  A download that fails part way through is sent again in full the next time.  To start over, use a new cursor name.
+    Default behavior: if you provide no cursor the master_registry file is used.
     """
     
     if access_key is None or secret_key is None:
@@ -76,8 +85,12 @@ def make_request(study_id, access_key=ACCESS_KEY, secret_key=SECRET_KEY, user_id
         # if isinstance(time_end, datetime):
         # time_end = time_end.strftime(API_TIME_FORMAT)
         values['time_end'] = time_end
+    if compression: values['compression'] = compression
+    if cursor: values['cursor'] = cursor
     
-    if path.exists("master_registry"):
+    if cursor:
+        old_registry = None
+    elif path.exists("master_registry"):
         with open("master_registry") as f:
             old_registry = json.load(f)
             f.close()
@@ -120,17 +133,34 @@ def make_request(study_id, access_key=ACCESS_KEY, secret_key=SECRET_KEY, user_id
     
     print "Data received.  Unpacking and overwriting any updated files into", path.abspath('.')
     
-    z = zipfile.ZipFile(StringIO.StringIO(return_data))
-    z.extractall()
+    if compression and compression.startswith("zstd"):
+        import zstandard
+        tar_data = zstandard.ZstdDecompressor().decompressobj().decompress(return_data)
+        tarfile.open(fileobj=StringIO.StringIO(tar_data)).extractall()
+    else:
+        z = zipfile.ZipFile(StringIO.StringIO(return_data))
+        z.extractall()
     
-    with open("registry") as f:
-        new_registry = json.load(f)
-        f.close()
+    if path.exists("compression"):
+        with open("compression") as f:
+            sizes = json.load(f)
+        print "Received %s bytes of data as %s bytes." % (sizes["uncompressed_bytes"], sizes["compressed_bytes"])
+        path.os.remove("compression")
     
-    old_registry.update(new_registry)
-    with open("master_registry", "w") as f:
-        json.dump(old_registry, f)
-    path.os.remove("registry")
+    if cursor:
+        with open("cursor") as f:
+            cursor_range = json.load(f)
+        print "Received the files updated since %s." % (cursor_range["updated_after"] or "the start of the study")
+        path.os.remove("cursor")
+    else:
+        with open("registry") as f:
+            new_registry = json.load(f)
+            f.close()
+        
+        old_registry.update(new_registry)
+        with open("master_registry", "w") as f:
+            json.dump(old_registry, f)
+        path.os.remove("registry")
     print "Operations complete."
     # Uncomment the following line to have the function return a list of newly updated files.
     # return [name.filename for name in z.filelist if name.filename != "registry"]
@@ -1,30 +1,43 @@
+import hashlib
 import json
 import random
 import string
 
-from datetime import datetime
+from datetime import datetime, timedelta
 
 from django.db import models
+from django.db.models import Case, Value, When
 from django.utils import timezone
 
-from config.constants import ALL_DATA_STREAMS, CHUNKABLE_FILES, CHUNK_TIMESLICE_QUANTUM, PIPELINE_FOLDER
+from config.constants import ALL_DATA_STREAMS, API_TIME_FORMAT, CHUNKABLE_FILES, CHUNK_TIMESLICE_QUANTUM, PIPELINE_FOLDER
 from database.validators import LengthValidator
-from libs.security import chunk_hash, low_memory_chunk_hash
+from libs.security import chunk_hash, file_object_hash, low_memory_chunk_hash
 from database.models import AbstractModel
 from database.study_models import Study
+from database.user_models import Participant
 
 
 class FileProcessingLockedError(Exception): pass
 class UnchunkableDataTypeError(Exception): pass
 class ChunkableDataTypeError(Exception): pass
 
+# Each chunk in a bulk update takes 5 query parameters, this keeps the queries under sqlite's limit
+# of 999 parameters and reasonably sized on postgres.
+BULK_WRITE_BATCH_SIZE = 100
+# sqlite's limit of query parameters also bounds the length of an IN (...) list.
+BULK_READ_BATCH_SIZE = 900
+# A download cursor is moved to this long before the download started: a chunk that was updated
+# just before then may not have been committed yet, it is sent again by the next download instead
+# of being skipped.
+DOWNLOAD_CURSOR_OVERLAP = timedelta(minutes=5)
+
 
 class ChunkRegistry(AbstractModel):
 
     DATA_TYPE_CHOICES = tuple([(stream_name, stream_name) for stream_name in ALL_DATA_STREAMS])
 
     is_chunkable = models.BooleanField()
-    chunk_path = models.CharField(max_length=256, db_index=True)  # , unique=True)
+    chunk_path = models.CharField(max_length=256, unique=True)
     chunk_hash = models.CharField(max_length=25, blank=True)
 
     data_type = models.CharField(max_length=32, choices=DATA_TYPE_CHOICES, db_index=True)
@@ -35,23 +48,32 @@ class ChunkRegistry(AbstractModel):
     survey = models.ForeignKey('Survey', blank=True, null=True, on_delete=models.PROTECT, related_name='chunk_registries', db_index=True)
 
     number_of_observations = models.PositiveIntegerField(blank=True, null=True)
+
+    class Meta:
+        indexes = [
+            # get_chunks_time_range, every data download and pipeline job, is a range scan on this
+            # index.  On postgres it only covers chunks that are not deleted (migration 0034).
+            models.Index(fields=['study', 'participant', 'data_type', 'time_bin'], name='chunk_time_range_idx'),
+            # incremental downloads (see DownloadCursor) are a range scan on this index.
+            models.Index(fields=['study', 'last_updated'], name='chunk_study_last_updated_idx'),
+        ]
     
     @classmethod
     def register_chunked_data(cls, data_type, time_bin, chunk_path, file_contents, study_id, participant_id, survey_id=None):
-        
-        if data_type not in CHUNKABLE_FILES:
-            raise UnchunkableDataTypeError
+        cls.build_chunked_data(
+            data_type, time_bin, chunk_path, file_contents, study_id, participant_id, survey_id
+        ).save(force_insert=True)
 
-        # we want to make sure that there are no extraneous newline characters at the
-        # end of the line. we want the line to end in exactly one newline character
-        file_contents = file_contents.rstrip('\n') + '\n'
+    @classmethod
+    def build_chunked_data(cls, data_type, time_bin, chunk_path, file_contents, study_id, participant_id, survey_id=None):
+        """ As register_chunked_data, but returns the unsaved ChunkRegistry so that many of them
+        can be inserted at once with bulk_register_chunked_data. """
 
-        # we subtract one to exclude the header line
-        chunk_file_number_of_observations = file_contents.count('\n') - 1
+        if data_type not in CHUNKABLE_FILES:
+            raise UnchunkableDataTypeError
 
-        chunk_hash_str = chunk_hash(file_contents)
+        chunk_hash_str, chunk_file_number_of_observations = cls.hash_chunk_contents(file_contents)
 
-        
         time_bin = int(time_bin) * CHUNK_TIMESLICE_QUANTUM
         time_bin = timezone.make_aware(datetime.utcfromtimestamp(time_bin), timezone.utc)
         # previous time_bin form was this:
@@ -63,8 +85,8 @@ class ChunkRegistry(AbstractModel):
         # Django's behavior (at least on this project, but this project is set to the New York
         # timezone so it should be generalizable) is to add UTC as a timezone when storing a naive
         # datetime in the database.
-        
-        cls.objects.create(
+
+        return cls(
             is_chunkable=True,
             chunk_path=chunk_path,
             chunk_hash=chunk_hash_str,
@@ -78,30 +100,77 @@ class ChunkRegistry(AbstractModel):
     
     @classmethod
     def register_unchunked_data(cls, data_type, unix_timestamp, chunk_path, study_id, participant_id, survey_id=None):
+        """ Returns the ChunkRegistry of an unchunked file, creating it unless one is already
+        registered at chunk_path: a file that is processed again (a retry, or a duplicate upload)
+        moves to the same chunk path. """
         # see comment in register_chunked_data above
         time_bin = timezone.make_aware(datetime.utcfromtimestamp(unix_timestamp), timezone.utc)
         
         if data_type in CHUNKABLE_FILES:
             raise ChunkableDataTypeError
         
+        # unchunked files (e.g. audio recordings) are not csvs, they have no number of observations.
+        chunk, _ = cls.objects.get_or_create(
+            chunk_path=chunk_path,
+            defaults=dict(
+                is_chunkable=False,
+                chunk_hash='',
+                data_type=data_type,
+                time_bin=time_bin,
+                study_id=study_id,
+                participant_id=participant_id,
+                survey_id=survey_id,
+                number_of_observations=None
+            )
+        )
+        return chunk
+
+    @classmethod
+    def bulk_register_chunked_data(cls, chunk_registries):
+        """ Inserts unsaved ChunkRegistries from build_chunked_data in a single query per batch.
+        bulk_create does not call save, so full_clean is skipped; the fields are all set by
+        build_chunked_data from already validated values. """
+        cls.objects.bulk_create(chunk_registries, batch_size=BULK_WRITE_BATCH_SIZE)
+
+    @classmethod
+    def bulk_update_chunk_hashes(cls, chunk_registries):
+        """ Writes the chunk_hash and number_of_observations of ChunkRegistries updated with
+        set_chunk_hash, one UPDATE ... CASE query per batch instead of a save() per chunk. """
+        now = timezone.now()
+        for i in xrange(0, len(chunk_registries), BULK_WRITE_BATCH_SIZE):
+            batch = chunk_registries[i:i + BULK_WRITE_BATCH_SIZE]
+            cls.objects.filter(pk__in=[chunk.pk for chunk in batch]).update(
+                chunk_hash=Case(
+                    *[When(pk=chunk.pk, then=Value(chunk.chunk_hash)) for chunk in batch],
+                    output_field=models.CharField()
+                ),
+                number_of_observations=Case(
+                    *[When(pk=chunk.pk, then=Value(chunk.number_of_observations)) for chunk in batch],
+                    output_field=models.PositiveIntegerField()
+                ),
+                last_updated=now,
+            )
+
+    @staticmethod
+    def hash_chunk_contents(file_contents):
+        """ Returns the chunk hash and the number of observations of a chunk file. """
         # we want to make sure that there are no extraneous newline characters at the
         # end of the line. we want the line to end in exactly one newline character
         file_contents = file_contents.rstrip('\n') + '\n'
 
         # we subtract one to exclude the header line
-        chunk_file_number_of_observations = file_contents.count('\n') - 1
+        return chunk_hash(file_contents), file_contents.count('\n') - 1
 
-        cls.objects.create(
-            is_chunkable=False,
-            chunk_path=chunk_path,
-            chunk_hash='',
-            data_type=data_type,
-            time_bin=time_bin,
-            study_id=study_id,
-            participant_id=participant_id,
-            survey_id=survey_id,
-            number_of_observations=chunk_file_number_of_observations
-        )
+    @classmethod
+    def get_by_chunk_paths(cls, chunk_paths):
+        """ Returns a dict of chunk path to ChunkRegistry for those of chunk_paths that exist.
+        This is a single query unless there are more than BULK_READ_BATCH_SIZE paths. """
+        chunk_paths = list(chunk_paths)
+        ret = {}
+        for i in xrange(0, len(chunk_paths), BULK_READ_BATCH_SIZE):
+            for chunk in cls.objects.filter(chunk_path__in=chunk_paths[i:i + BULK_READ_BATCH_SIZE]):
+                ret[chunk.chunk_path] = chunk
+        return ret
 
     @classmethod
     def get_chunks_time_range(cls, study_id, user_ids=None, data_types=None, start=None, end=None):
@@ -109,11 +178,15 @@ class ChunkRegistry(AbstractModel):
         This function uses Django query syntax to provide datetimes and have Django do the
         comparison operation, and the 'in' operator to have Django only match the user list
         provided.
+        The user list is resolved to participant primary keys first, so that the query is on the
+        columns of the chunk_time_range_idx index alone and does not join the participant table.
         """
 
         query = {'study_id': study_id, 'deleted': False}
         if user_ids:
-            query['participant__patient_id__in'] = user_ids
+            query['participant_id__in'] = list(
+                Participant.objects.filter(study_id=study_id, patient_id__in=user_ids).values_list('pk', flat=True)
+            )
         if data_types:
             query['data_type__in'] = data_types
         if start:
@@ -134,6 +207,10 @@ class ChunkRegistry(AbstractModel):
         self.number_of_observations = chunk_file_number_of_observations
         self.save()
 
+    def set_chunk_hash(self, file_contents):
+        """ As update_chunk_hash without the save, for use with bulk_update_chunk_hashes. """
+        self.chunk_hash, self.number_of_observations = self.hash_chunk_contents(file_contents)
+
     def low_memory_update_chunk_hash(self, list_data_to_hash):
         # we want to make sure that there are no extraneous newline characters at the
         # end of the line. we want the line to end in exactly one newline character
@@ -147,6 +224,70 @@ class ChunkRegistry(AbstractModel):
         self.save()
 
 
+class DownloadCursor(AbstractModel):
+    """
+    The high water mark of a researcher's incremental downloads of a query on a study.  A download
+    that uses a cursor gets only the chunks that were added or updated (ChunkRegistry.last_updated)
+    after the cursor's high water mark, and moves the cursor forward once it has been sent in full.
+
+    Cursors are named by the client, so that several copies of the same data (e.g. on different
+    computers) are kept up to date independently, and are separate for each query: the data
+    streams, participants and time range of a download.
+    """
+
+    researcher = models.ForeignKey('Researcher', on_delete=models.PROTECT, related_name='download_cursors')
+    study = models.ForeignKey('Study', on_delete=models.PROTECT, related_name='download_cursors')
+    name = models.CharField(max_length=64)
+    query_hash = models.CharField(max_length=40)
+    high_water_mark = models.DateTimeField()
+
+    class Meta:
+        unique_together = (('researcher', 'study', 'name', 'query_hash'),)
+
+    @staticmethod
+    def hash_query(query):
+        """ Returns a hash of the query of a download (see get_chunks_time_range) that does not
+        depend on the order of its data streams and participants. """
+        normalized = {}
+        for key, value in query.iteritems():
+            if isinstance(value, datetime):
+                value = value.strftime(API_TIME_FORMAT)
+            elif isinstance(value, (list, tuple)):
+                value = sorted(set(value))
+            normalized[key] = value
+        return hashlib.sha1(json.dumps(normalized, sort_keys=True)).hexdigest()
+
+    @classmethod
+    def for_query(cls, researcher_id, study_id, name, query):
+        """ Returns the cursor of a query, unsaved and with no high water mark if it has not been
+        used yet.  Call this before running the query: next_high_water_mark, where advance() moves
+        the cursor to, is set from the current time. """
+        query_hash = cls.hash_query(query)
+        try:
+            cursor = cls.objects.get(researcher_id=researcher_id, study_id=study_id, name=name,
+                                     query_hash=query_hash)
+        except cls.DoesNotExist:
+            cursor = cls(researcher_id=researcher_id, study_id=study_id, name=name,
+                         query_hash=query_hash, high_water_mark=None)
+        cursor.next_high_water_mark = timezone.now() - DOWNLOAD_CURSOR_OVERLAP
+        return cursor
+
+    def advance(self):
+        """ Moves the cursor forward to next_high_water_mark, a cursor never moves back (e.g. when
+        an older download that used the same cursor finishes last). """
+        if self.pk is None:
+            cursor, created = DownloadCursor.objects.get_or_create(
+                researcher_id=self.researcher_id, study_id=self.study_id, name=self.name,
+                query_hash=self.query_hash, defaults={'high_water_mark': self.next_high_water_mark}
+            )
+            self.pk, self.high_water_mark = cursor.pk, cursor.high_water_mark
+            if created:
+                return
+        DownloadCursor.objects.filter(pk=self.pk, high_water_mark__lt=self.next_high_water_mark)\
+            .update(high_water_mark=self.next_high_water_mark, last_updated=timezone.now())
+        self.high_water_mark = max(self.high_water_mark, self.next_high_water_mark)
+
+
 class FileToProcess(AbstractModel):
 
     s3_file_path = models.CharField(max_length=256, blank=False)
@@ -251,8 +392,7 @@ class PipelineUpload(AbstractModel):
             raise InvalidUploadParameterError("\n".join(errors))
 
         created_on = timezone.now()
-        file_hash = low_memory_chunk_hash(file_object.read())
-        file_object.seek(0)
+        file_hash = file_object_hash(file_object)
 
         s3_path = "%s/%s/%s/%s/%s" % (
             PIPELINE_FOLDER,
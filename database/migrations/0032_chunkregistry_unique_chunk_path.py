@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import Count, Max
+
+
+def remove_duplicate_chunk_paths(apps, schema_editor):
+    # Interrupted processing runs could register the same chunk twice, the chunker used to winnow
+    # these down to one at a time.  The most recently created registry is the one kept.
+    ChunkRegistry = apps.get_model('database', 'ChunkRegistry')
+    duplicates = (
+        ChunkRegistry.objects.order_by().values('chunk_path')
+        .annotate(count=Count('id'), keep_id=Max('id')).filter(count__gt=1)
+    )
+    for duplicate in duplicates.iterator():
+        ChunkRegistry.objects.filter(chunk_path=duplicate['chunk_path'])\
+            .exclude(id=duplicate['keep_id']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('database', '0031_auto_20191213_1753'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_chunk_paths, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='chunkregistry',
+            name='chunk_path',
+            field=models.CharField(max_length=256, unique=True),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('database', '0032_chunkregistry_unique_chunk_path'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DownloadCursor',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('deleted', models.BooleanField(default=False)),
+                ('created_on', models.DateTimeField(auto_now_add=True)),
+                ('last_updated', models.DateTimeField(auto_now=True)),
+                ('name', models.CharField(max_length=64)),
+                ('query_hash', models.CharField(max_length=40)),
+                ('high_water_mark', models.DateTimeField()),
+                ('researcher', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='download_cursors', to='database.Researcher')),
+                ('study', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='download_cursors', to='database.Study')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='downloadcursor',
+            unique_together=set([('researcher', 'study', 'name', 'query_hash')]),
+        ),
+        migrations.AddIndex(
+            model_name='chunkregistry',
+            index=models.Index(fields=['study', 'last_updated'], name='chunk_study_last_updated_idx'),
+        ),
+    ]
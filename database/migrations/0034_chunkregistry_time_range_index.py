@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+INDEX_NAME = 'chunk_time_range_idx'
+
+
+def make_time_range_index_partial(apps, schema_editor):
+    # Django 1.11 indexes cannot have a condition.  Deleted chunks are never downloaded, so on
+    # postgres the index is recreated under the same name without them; Django's own operations
+    # on the index (e.g. reversing this migration) still find it by name.
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('DROP INDEX "%s"' % INDEX_NAME)
+    schema_editor.execute(
+        'CREATE INDEX "%s" ON "database_chunkregistry" '
+        '("study_id", "participant_id", "data_type", "time_bin") WHERE NOT "deleted"' % INDEX_NAME
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('database', '0033_downloadcursor'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='chunkregistry',
+            index=models.Index(fields=['study', 'participant', 'data_type', 'time_bin'], name=INDEX_NAME),
+        ),
+        migrations.RunPython(make_time_range_index_partial, migrations.RunPython.noop),
+    ]
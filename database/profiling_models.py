@@ -1,6 +1,8 @@
 from datetime import timedelta
 
 from django.db import models
+from django.db.models import F, Value
+from django.db.models.functions import Greatest
 from django.utils import timezone
 
 from config.constants import UPLOAD_FILE_TYPE_MAPPING
@@ -139,6 +141,35 @@ class ReceivedDataStats(AbstractModel):
                 statistics_object.update(
                     last_upload_timestamp = timestamp
                 )
+
+    @classmethod
+    def bulk_update_statistics(cls, uploads):
+        """ As update_statistics for a list of (file_path, participant_id, file_size, timestamp),
+        one query per participant and data type instead of several per upload. """
+        totals = {}
+        for file_path, participant_id, file_size, timestamp in uploads:
+            key = participant_id, parse_filename(file_path)['data_type']
+            number_of_uploads, number_bytes_uploaded, last_upload_timestamp = totals.get(key, (0, 0, timestamp))
+            totals[key] = (number_of_uploads + 1, number_bytes_uploaded + file_size,
+                           max(last_upload_timestamp, timestamp))
+
+        for (participant_id, data_type), (number_of_uploads, number_bytes_uploaded, last_upload_timestamp) in totals.iteritems():
+            updated = cls.objects.filter(participant_id=participant_id, data_type=data_type).update(
+                number_of_uploads = F('number_of_uploads') + number_of_uploads,
+                number_bytes_uploaded = F('number_bytes_uploaded') + number_bytes_uploaded,
+                last_upload_timestamp = Greatest(
+                    'last_upload_timestamp', Value(last_upload_timestamp, output_field=models.DateTimeField())
+                ),
+                last_updated = timezone.now(),
+            )
+            if not updated:
+                cls.objects.create(
+                    participant_id = participant_id,
+                    data_type = data_type,
+                    last_upload_timestamp = last_upload_timestamp,
+                    number_of_uploads = number_of_uploads,
+                    number_bytes_uploaded = number_bytes_uploaded
+                )
                  
 
 class UploadTracking(AbstractModel):
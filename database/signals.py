@@ -5,6 +5,7 @@ from django.db.models.signals import post_save, pre_save
 from django.dispatch import receiver
 
 from database.study_models import DeviceSettings, Study, Survey, SurveyArchive
+from libs.study_key_cache import study_key_cache
 
 
 @receiver(post_save, sender=Study)
@@ -21,6 +22,12 @@ def populate_study_device_settings(sender, **kwargs):
         DeviceSettings.objects.create(study=my_study)
 
 
+@receiver(post_save, sender=Study)
+def invalidate_study_key_cache(sender, **kwargs):
+    """ Drops the cached encryption key of a Study whenever it is saved. """
+    study_key_cache.invalidate(kwargs['instance'].object_id)
+
+
 @receiver(pre_save, sender=Survey)
 def create_survey_archive(sender, **kwargs):
     """
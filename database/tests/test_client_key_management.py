@@ -0,0 +1,92 @@
+from unittest import TestCase
+
+from Crypto.PublicKey import RSA
+
+from libs import client_key_management
+from libs.client_key_management import (create_client_key_pair, estimate_rsa_key_size,
+    get_client_private_key, private_key_cache, PrivateKeyCache, restore_client_public_key)
+from libs.s3 import construct_s3_key_paths
+
+# small keys, generating the real ASYMMETRIC_KEY_LENGTH ones is slow
+KEYS = [RSA.generate(1024) for _ in xrange(3)]
+KEY_SIZE = estimate_rsa_key_size(KEYS[0])
+
+
+class TestPrivateKeyCache(TestCase):
+    def test_hits_and_misses(self):
+        cache = PrivateKeyCache(10 * KEY_SIZE, ttl=60)
+        self.assertIsNone(cache.get("a"))
+        cache.put("a", KEYS[0])
+        self.assertIs(cache.get("a"), KEYS[0])
+        self.assertIs(cache.get("a"), KEYS[0])
+        self.assertEqual(cache.stats(), {"hits": 2, "misses": 1, "size": 1, "bytes": KEY_SIZE})
+
+    def test_least_recently_used_keys_are_evicted_by_bytes(self):
+        cache = PrivateKeyCache(2 * KEY_SIZE, ttl=60)
+        cache.put("a", KEYS[0])
+        cache.put("b", KEYS[1])
+        cache.get("a")
+        cache.put("c", KEYS[2])
+        self.assertIsNone(cache.get("b"))
+        self.assertIs(cache.get("a"), KEYS[0])
+        self.assertIs(cache.get("c"), KEYS[2])
+        self.assertEqual(cache.stats()["bytes"], 2 * KEY_SIZE)
+        # replacing a key does not count its old size
+        cache.put("c", KEYS[1])
+        self.assertEqual(cache.stats()["bytes"], 2 * KEY_SIZE)
+
+    def test_zero_max_bytes_disables_the_cache(self):
+        cache = PrivateKeyCache(0, ttl=60)
+        cache.put("a", KEYS[0])
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.stats()["bytes"], 0)
+
+    def test_entries_expire(self):
+        cache = PrivateKeyCache(10 * KEY_SIZE, ttl=-1)
+        cache.put("a", KEYS[0])
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.stats()["bytes"], 0)
+
+    def test_invalidate(self):
+        cache = PrivateKeyCache(10 * KEY_SIZE, ttl=60)
+        cache.put("a", KEYS[0])
+        cache.invalidate("a")
+        cache.invalidate("missing")
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.stats()["bytes"], 0)
+
+
+class TestClientKeyManagement(TestCase):
+    def setUp(self):
+        self.s3_files = {}
+        self.original_functions = (client_key_management.s3_upload, client_key_management.s3_retrieve,
+                                   client_key_management.encryption.generate_key_pairing)
+        client_key_management.s3_upload = \
+            lambda key_path, contents, study_id, raw_path: self.s3_files.__setitem__(key_path, contents)
+        client_key_management.s3_retrieve = \
+            lambda key_path, study_id, raw_path: self.s3_files[key_path]
+        self.generated_keys = iter(KEYS)
+
+        def generate_key_pairing():
+            key = next(self.generated_keys)
+            return key.publickey().exportKey(), key.exportKey()
+        client_key_management.encryption.generate_key_pairing = generate_key_pairing
+
+    def tearDown(self):
+        (client_key_management.s3_upload, client_key_management.s3_retrieve,
+         client_key_management.encryption.generate_key_pairing) = self.original_functions
+        private_key_cache.invalidate(("study", "patient1"))
+
+    def test_create_client_key_pair_invalidates_the_cached_key(self):
+        create_client_key_pair("patient1", "study")
+        self.assertEqual(get_client_private_key("patient1", "study"), KEYS[0])
+        self.assertIsNotNone(private_key_cache.get(("study", "patient1")))
+        create_client_key_pair("patient1", "study")
+        self.assertEqual(get_client_private_key("patient1", "study"), KEYS[1])
+
+    def test_restore_client_public_key(self):
+        create_client_key_pair("patient1", "study")
+        public_key_path = construct_s3_key_paths("study", "patient1")["public"]
+        del self.s3_files[public_key_path]
+        restore_client_public_key("patient1", "study")
+        self.assertEqual(self.s3_files[public_key_path], KEYS[0].publickey().exportKey())
@@ -0,0 +1,141 @@
+import json
+from datetime import datetime, timedelta
+from io import BytesIO
+from zipfile import ZipFile
+
+from django.test import TestCase
+from django.utils import timezone
+
+from api.data_access_api import CURSOR_FILE_NAME, handle_database_query, stream_zip
+from config.constants import ACCELEROMETER, GPS
+from database.data_access_models import ChunkRegistry, DownloadCursor
+from database.study_models import Study
+from database.user_models import Participant, Researcher
+from libs.streaming_zip import StreamingZipFile
+
+
+class Download(list):
+    """ The parts of a PrefetchingDownload that stream_zip uses. """
+    closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class TestDownloadCursor(TestCase):
+    def setUp(self):
+        self.study = Study.create_with_object_id(name="TEST_STUDY_FOR_TESTS",
+                                                 encryption_key="aabbccddefggiijjkklmnoppqqrrsstt")
+        # A Researcher cannot be saved in the test database, the model does not have the site_admin
+        # column that migration 0031 added; sqlite does not enforce the foreign key.
+        self.researcher = Researcher(pk=1, username="researcher")
+        self.participant = Participant.objects.create(patient_id="patient1", password="x", salt="x",
+                                                      os_type=Participant.IOS_API, study=self.study)
+        self.query = {"data_types": [GPS, ACCELEROMETER], "user_ids": ["patient1", "patient2"],
+                      "start": datetime(2018, 4, 27), "end": datetime(2018, 4, 28)}
+
+    def for_query(self, name="laptop", query=None):
+        return DownloadCursor.for_query(self.researcher.pk, self.study.pk, name, query or self.query)
+
+    def test_hash_query_ignores_order(self):
+        reordered = {"end": datetime(2018, 4, 28), "start": datetime(2018, 4, 27),
+                     "user_ids": ["patient2", "patient1", "patient1"], "data_types": (ACCELEROMETER, GPS)}
+        self.assertEqual(DownloadCursor.hash_query(self.query), DownloadCursor.hash_query(reordered))
+        self.assertNotEqual(DownloadCursor.hash_query(self.query),
+                            DownloadCursor.hash_query(dict(self.query, user_ids=["patient1"])))
+        self.assertNotEqual(DownloadCursor.hash_query(self.query),
+                            DownloadCursor.hash_query(dict(self.query, end=datetime(2018, 4, 29))))
+
+    def test_for_query(self):
+        cursor = self.for_query()
+        self.assertIsNone(cursor.pk)
+        self.assertIsNone(cursor.high_water_mark)
+        self.assertLess(cursor.next_high_water_mark, timezone.now())
+        cursor.advance()
+        self.assertEqual(DownloadCursor.objects.count(), 1)
+
+        existing = self.for_query()
+        self.assertEqual(existing.pk, cursor.pk)
+        self.assertEqual(existing.high_water_mark, cursor.next_high_water_mark)
+        self.assertGreaterEqual(existing.next_high_water_mark, existing.high_water_mark)
+        # other names and other queries have cursors of their own
+        self.assertIsNone(self.for_query(name="desktop").pk)
+        self.assertIsNone(self.for_query(query=dict(self.query, user_ids=["patient1"])).pk)
+
+    def test_advance_never_moves_back(self):
+        cursor = self.for_query()
+        cursor.advance()
+        newer = self.for_query()
+        newer.next_high_water_mark = cursor.next_high_water_mark + timedelta(hours=1)
+        newer.advance()
+        # an older download that used the cursor finishes last
+        older = DownloadCursor.objects.get(pk=cursor.pk)
+        older.next_high_water_mark = cursor.next_high_water_mark + timedelta(minutes=1)
+        older.advance()
+        self.assertEqual(older.high_water_mark, newer.next_high_water_mark)
+        self.assertEqual(DownloadCursor.objects.get(pk=cursor.pk).high_water_mark, newer.next_high_water_mark)
+
+    def test_advance_of_a_cursor_created_by_another_download(self):
+        # two downloads start before either created the cursor
+        first, second = self.for_query(), self.for_query()
+        second.next_high_water_mark = first.next_high_water_mark + timedelta(minutes=1)
+        second.advance()
+        first.advance()
+        self.assertEqual(DownloadCursor.objects.count(), 1)
+        self.assertEqual(first.pk, second.pk)
+        self.assertEqual(DownloadCursor.objects.get().high_water_mark, second.next_high_water_mark)
+
+        # and the other way around, the newer mark is kept
+        third, fourth = self.for_query(name="desktop"), self.for_query(name="desktop")
+        fourth.next_high_water_mark = third.next_high_water_mark - timedelta(minutes=1)
+        third.advance()
+        fourth.advance()
+        self.assertEqual(DownloadCursor.objects.get(name="desktop").high_water_mark, third.next_high_water_mark)
+
+    def register_chunk(self, data_type, last_updated):
+        chunk_path = "CHUNKED_DATA/%s/patient1/%s/%s.csv" % (self.study.object_id, data_type, last_updated)
+        ChunkRegistry.bulk_register_chunked_data([ChunkRegistry.build_chunked_data(
+            data_type, 424666, chunk_path, "timestamp,UTC time,x\n1,a,1", self.study.pk, self.participant.pk
+        )])
+        ChunkRegistry.objects.filter(chunk_path=chunk_path).update(last_updated=last_updated)
+        return chunk_path
+
+    def test_handle_database_query_updated_after(self):
+        high_water_mark = timezone.now() - timedelta(days=1)
+        self.register_chunk(GPS, high_water_mark - timedelta(hours=1))
+        self.register_chunk(GPS, high_water_mark)
+        updated = self.register_chunk(GPS, high_water_mark + timedelta(hours=1))
+        self.register_chunk(ACCELEROMETER, high_water_mark + timedelta(hours=1))
+        query = {"data_types": [GPS]}
+        self.assertEqual([chunk["chunk_path"] for chunk in handle_database_query(
+            self.study.pk, query, updated_after=high_water_mark)], [updated])
+        self.assertEqual(len(handle_database_query(self.study.pk, query)), 3)
+
+    def download(self):
+        item = {"chunk_path": "a_file.csv", "chunk_hash": "hash"}
+        return Download([(item, ["header\n", "1,2,3\n"]), (dict(item, chunk_path="b_file.csv"), ["header\n"])])
+
+    def test_cursor_advances_after_a_whole_download(self):
+        cursor = self.for_query()
+        download = self.download()
+        zip_contents = "".join(stream_zip(download, StreamingZipFile(), lambda item: item["chunk_path"],
+                                          cursor=cursor))
+        self.assertTrue(download.closed)
+        cursor_file = json.loads(ZipFile(BytesIO(zip_contents)).read(CURSOR_FILE_NAME))
+        self.assertEqual(cursor_file, {"name": "laptop", "updated_after": None,
+                                       "next_updated_after": cursor.next_high_water_mark.isoformat()})
+        self.assertEqual(DownloadCursor.objects.get().high_water_mark, cursor.next_high_water_mark)
+
+    def test_cursor_stays_when_a_download_is_abandoned(self):
+        cursor = self.for_query()
+        cursor.advance()
+        high_water_mark = cursor.high_water_mark
+        cursor = self.for_query()
+        cursor.next_high_water_mark = high_water_mark + timedelta(hours=1)
+        download = self.download()
+        zip_stream = stream_zip(download, StreamingZipFile(), lambda item: item["chunk_path"], cursor=cursor)
+        next(zip_stream)
+        # the client goes away part way through
+        zip_stream.close()
+        self.assertTrue(download.closed)
+        self.assertEqual(DownloadCursor.objects.get().high_water_mark, high_water_mark)
@@ -0,0 +1,74 @@
+import zlib
+from io import BytesIO
+from itertools import cycle
+from os import urandom
+
+from django.test import TestCase
+
+from database.study_models import Study
+from libs.encryption import (decrypt_server, encrypt_for_server, server_encryption_version,
+    ServerDecryptionStream, ServerEncryptionStream, SERVER_ENCRYPTION_CFB8, SERVER_ENCRYPTION_CTR,
+    SERVER_ENCRYPTION_CTR_DEFLATE, SERVER_ENCRYPTION_HEADER_LENGTH, SERVER_ENCRYPTION_MAGIC,
+    SERVER_STREAM_BLOCK_SIZE, UnknownServerEncryptionVersion)
+
+# none of these fall on an AES block, the last one spans a stream block.
+READ_SIZES = [1, 7, 17, 1000, SERVER_STREAM_BLOCK_SIZE + 3]
+
+
+def read_in_pieces(file_object):
+    """ Reads a file-like object to its end, in reads of each of READ_SIZES in turn. """
+    pieces = []
+    for size in cycle(READ_SIZES):
+        piece = file_object.read(size)
+        if not piece:
+            return "".join(pieces)
+        assert len(piece) <= size
+        pieces.append(piece)
+
+
+class TestServerEncryption(TestCase):
+    # random data, and data that compresses, of a size that is not a multiple of a block either.
+    plaintext = urandom(SERVER_STREAM_BLOCK_SIZE + 12345) + "1,2,3\n" * 400001
+
+    def setUp(self):
+        self.study = Study.create_with_object_id(name="TEST_STUDY_FOR_TESTS",
+                                                 encryption_key="aabbccddefggiijjkklmnoppqqrrsstt")
+
+    def decrypt_stream(self, encrypted, **kwargs):
+        stream = ServerDecryptionStream(BytesIO(encrypted), self.study.object_id, **kwargs)
+        return stream, read_in_pieces(stream)
+
+    def test_stream_round_trips(self):
+        for version in [SERVER_ENCRYPTION_CFB8, SERVER_ENCRYPTION_CTR]:
+            encrypted = read_in_pieces(ServerEncryptionStream(BytesIO(self.plaintext), self.study.object_id,
+                                                              version))
+            self.assertEqual(len(encrypted), SERVER_ENCRYPTION_HEADER_LENGTH + len(self.plaintext))
+            self.assertEqual(server_encryption_version(encrypted[:SERVER_ENCRYPTION_HEADER_LENGTH]), version)
+            stream, decrypted = self.decrypt_stream(encrypted, encrypted_size=len(encrypted))
+            self.assertEqual(decrypted, self.plaintext)
+            self.assertEqual(stream.size, len(self.plaintext))
+            self.assertEqual(decrypt_server(encrypted, self.study.object_id), self.plaintext)
+
+    def test_compressed_round_trips(self):
+        encrypted = encrypt_for_server(self.plaintext, self.study.object_id, compression_level=6)
+        self.assertEqual(server_encryption_version(encrypted[:SERVER_ENCRYPTION_HEADER_LENGTH]),
+                         SERVER_ENCRYPTION_CTR_DEFLATE)
+        self.assertLess(len(encrypted), len(self.plaintext))
+        self.assertEqual(decrypt_server(encrypted, self.study.object_id), self.plaintext)
+
+        stream, decrypted = self.decrypt_stream(encrypted)
+        self.assertEqual(decrypted, self.plaintext)
+        self.assertEqual(stream.size, len(self.plaintext))
+
+        # the raw deflate data, as it is copied into compressed zip downloads
+        stream, deflated = self.decrypt_stream(encrypted, inflate=False)
+        self.assertTrue(stream.deflated)
+        self.assertEqual(stream.crc, zlib.crc32(self.plaintext) & 0xffffffff)
+        self.assertEqual(zlib.decompress(deflated, -zlib.MAX_WBITS), self.plaintext)
+
+    def test_unknown_version_is_rejected(self):
+        encrypted = SERVER_ENCRYPTION_MAGIC + chr(9) + urandom(8) + "data from a newer server"
+        with self.assertRaises(UnknownServerEncryptionVersion):
+            ServerDecryptionStream(BytesIO(encrypted), self.study.object_id)
+        with self.assertRaises(UnknownServerEncryptionVersion):
+            decrypt_server(encrypted, self.study.object_id)
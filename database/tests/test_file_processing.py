@@ -0,0 +1,479 @@
+from multiprocessing import Process, Queue
+from unittest import skipIf, TestCase
+
+from cronutils.error_handler import ErrorHandler
+from django.test import TestCase as DatabaseTestCase
+
+from config.constants import ACCELEROMETER, GPS, SURVEY_ANSWERS, VOICE_RECORDING
+from config.settings import S3_BUCKET
+from database.data_access_models import BULK_WRITE_BATCH_SIZE, ChunkRegistry
+from database.study_models import Study, Survey
+from database.user_models import Participant
+from libs import binified_data_accumulator, file_processing, s3
+from libs.binified_data_accumulator import BinifiedDataAccumulator
+from libs.file_processing import (add_utc_time_column, binify_csv_payload, ChunkPrefetcher,
+    construct_csv_string, construct_utf_safe_csv_string, csv_to_list, csv_to_row_generator,
+    ensure_sorted_by_timestamp, marshalled_binify_csv_payload, merge_sorted_csv_rows,
+    move_unchunkable_files, resolve_chunk_foreign_keys, serialize_csv_lines,
+    unmarshal_binified_payload, with_human_readable_timestamps)
+from libs.s3 import construct_s3_chunk_path_from_raw_data_path, construct_s3_raw_data_path, unix_time_to_string
+
+try:
+    from moto import mock_s3
+except ImportError:
+    mock_s3 = None
+
+HEADER = "timestamp,UTC time,x"
+
+
+def legacy_construct_csv_string(header, rows_list):
+    """ construct_csv_string as it was before the streaming merge: an order preserving dedupe of
+    every line, appended to the header one at a time. """
+    seen = set()
+    ret = header
+    for line in (",".join(row) for row in rows_list):
+        if line not in seen:
+            seen.add(line)
+            ret += "\n" + line
+    return ret
+
+
+def legacy_construct_utf_safe_csv_string(header, rows_list):
+    """ construct_utf_safe_csv_string as it was, which decoded every cell. """
+    return legacy_construct_csv_string(
+        header.decode("utf"), [[cell.decode("utf") for cell in row] for row in rows_list]
+    ).encode("utf")
+
+
+def legacy_convert_unix_to_human_readable_timestamps(header, rows):
+    """ The original UTC time column, formatted row by row and inserted into each row. """
+    for row in rows:
+        unix_millisecond = int(row[0])
+        time_string = unix_time_to_string(unix_millisecond / 1000)
+        time_string += ".%03d" % (unix_millisecond % 1000)
+        row.insert(1, time_string)
+    header = header.split(",")
+    header.insert(1, "UTC time")
+    return ",".join(header)
+
+
+def legacy_update_chunk(old_chunk, new_rows):
+    """ The old way an existing chunk was updated: the old rows and the new rows concatenated,
+    stable sorted by timestamp and deduplicated. """
+    header, old_rows = csv_to_list(old_chunk)
+    rows = list(old_rows) + [list(row) for row in new_rows]
+    ensure_sorted_by_timestamp(rows)
+    return legacy_construct_csv_string(header, rows)
+
+
+def update_chunk(old_chunk, new_rows):
+    """ The way binify_and_queue_uploads updates an existing chunk. """
+    header, old_rows = csv_to_row_generator(old_chunk)
+    rows = [list(row) for row in new_rows]
+    ensure_sorted_by_timestamp(rows)
+    return serialize_csv_lines(header, merge_sorted_csv_rows(old_rows, rows))
+
+
+def rows(*lines):
+    return [line.split(",") for line in lines]
+
+
+class TestChunkMerge(TestCase):
+    def assert_same_as_legacy(self, old_chunk, new_rows):
+        merged = update_chunk(old_chunk, new_rows)
+        self.assertEqual(merged, legacy_update_chunk(old_chunk, new_rows))
+        return merged
+
+    def test_overlapping_and_duplicate_rows(self):
+        old_chunk = "\n".join([HEADER, "1,a,1", "3,a,3", "5,a,5", "5,a,5b"])
+        new_rows = rows("6,a,6", "3,a,3", "2,a,2", "5,a,5b", "2,a,2", "7,a,7")
+        merged = self.assert_same_as_legacy(old_chunk, new_rows)
+        self.assertEqual(merged, "\n".join(
+            [HEADER, "1,a,1", "2,a,2", "3,a,3", "5,a,5", "5,a,5b", "6,a,6", "7,a,7"]))
+
+    def test_old_rows_come_first_on_equal_timestamps(self):
+        old_chunk = "\n".join([HEADER, "1,a,old", "2,a,old"])
+        new_rows = rows("2,a,new2", "1,a,new", "2,a,new1")
+        merged = self.assert_same_as_legacy(old_chunk, new_rows)
+        self.assertEqual(merged, "\n".join(
+            [HEADER, "1,a,old", "1,a,new", "2,a,old", "2,a,new2", "2,a,new1"]))
+
+    def test_empty_old_chunk(self):
+        merged = self.assert_same_as_legacy(HEADER + "\n", rows("2,a,2", "1,a,1"))
+        self.assertEqual(merged, "\n".join([HEADER, "1,a,1", "2,a,2"]))
+        # without any newline the header is kept whole, csv_to_list cut off its last character
+        self.assertEqual(update_chunk(HEADER, rows("1,a,1")), "\n".join([HEADER, "1,a,1"]))
+
+    def test_empty_new_data(self):
+        old_chunk = "\n".join([HEADER, "1,a,1", "2,a,2", "2,a,2b"])
+        self.assertEqual(self.assert_same_as_legacy(old_chunk, []), old_chunk)
+
+    def test_line_breaks_are_split_as_splitlines_splits_them(self):
+        for old_chunk in [HEADER + "\r\n1,a,1\r\n2,a,2\r\n",
+                          HEADER + "\n1,a,1\r2,a,2\n",
+                          HEADER + "\r1,a,1\n\n2,a,2",
+                          HEADER + "\n1,a,1\n\n",
+                          HEADER + "\n",
+                          "\n"]:
+            header, old_rows = csv_to_row_generator(old_chunk)
+            legacy_header, legacy_rows = csv_to_list(old_chunk)
+            self.assertEqual((header, list(old_rows)), (legacy_header, list(legacy_rows)))
+
+    def test_blank_lines_in_a_chunk_still_fail(self):
+        old_chunk = "\n".join([HEADER, "1,a,1", "", "2,a,2"])
+        with self.assertRaises(ValueError):
+            legacy_update_chunk(old_chunk, rows("3,a,3"))
+        with self.assertRaises(ValueError):
+            update_chunk(old_chunk, rows("3,a,3"))
+
+
+class TestCsvSerializers(TestCase):
+    def test_construct_csv_string(self):
+        # timestamps that are equal as integers are one group, however they are written
+        sorted_rows = rows("123,a", "0123,b", "123,a", "124,c", "0123,b", "124,c")
+        ensure_sorted_by_timestamp(sorted_rows)
+        expected = "\n".join([HEADER, "123,a", "0123,b", "124,c"])
+        self.assertEqual(construct_csv_string(HEADER, sorted_rows), expected)
+        self.assertEqual(legacy_construct_csv_string(HEADER, sorted_rows), expected)
+        self.assertEqual(construct_csv_string(HEADER, []), HEADER)
+
+    def test_unsorted_rows_are_rejected(self):
+        with self.assertRaises(ValueError):
+            construct_csv_string(HEADER, rows("2,a", "1,b", "2,a"))
+        with self.assertRaises(ValueError):
+            construct_utf_safe_csv_string(HEADER, rows("2,a", "1,b"))
+
+    def test_construct_utf_safe_csv_string(self):
+        sorted_rows = rows("1,caf\xc3\xa9", "1,caf\xc3\xa9", "2,\xe2\x98\x83,x")
+        self.assertEqual(construct_utf_safe_csv_string(HEADER, sorted_rows),
+                         legacy_construct_utf_safe_csv_string(HEADER, sorted_rows))
+        self.assertEqual(construct_utf_safe_csv_string(HEADER, sorted_rows),
+                         construct_csv_string(HEADER, sorted_rows))
+        with self.assertRaises(UnicodeDecodeError):
+            construct_utf_safe_csv_string(HEADER, rows("1,caf\xe9"))
+        with self.assertRaises(UnicodeDecodeError):
+            legacy_construct_utf_safe_csv_string(HEADER, rows("1,caf\xe9"))
+
+
+class TestHumanReadableTimestamps(TestCase):
+    def assert_legacy_csv(self, new_rows):
+        original_rows = [list(row) for row in new_rows]
+        legacy_rows = [list(row) for row in new_rows]
+        legacy_header = legacy_convert_unix_to_human_readable_timestamps("timestamp,x,y", legacy_rows)
+        self.assertEqual(construct_csv_string(add_utc_time_column("timestamp,x,y"),
+                                              with_human_readable_timestamps(new_rows)),
+                         legacy_construct_csv_string(legacy_header, legacy_rows))
+        # the parsed rows are not modified
+        self.assertEqual(new_rows, original_rows)
+
+    def test_millisecond_timestamps(self):
+        self.assert_legacy_csv(rows("1524857988000,a,1", "1524857988001,b,2", "1524857989999,c,3"))
+
+    def test_other_timestamps(self):
+        # these are formatted row by row instead of with numpy
+        self.assert_legacy_csv(rows("152485798801,b,2", "1524857988000,a,1", "01524857988002,c,3"))
+
+    def test_rows_of_one_or_many_columns(self):
+        self.assert_legacy_csv(rows("1524857988000", "1524857988001,", "1524857988002,a,b,c,d"))
+
+    def test_blocks(self):
+        original_block_rows = file_processing.HUMAN_READABLE_TIMESTAMP_BLOCK_ROWS
+        file_processing.HUMAN_READABLE_TIMESTAMP_BLOCK_ROWS = 2
+        try:
+            self.assert_legacy_csv(rows(*["%s,a,%s" % (1524857988000 + i, i) for i in range(5)]))
+        finally:
+            file_processing.HUMAN_READABLE_TIMESTAMP_BLOCK_ROWS = original_block_rows
+
+
+class TestChunkRegistryBulkWrites(DatabaseTestCase):
+    def setUp(self):
+        self.study = Study.create_with_object_id(name="TEST_STUDY_FOR_TESTS",
+                                                 encryption_key="aabbccddefggiijjkklmnoppqqrrsstt")
+        self.participant = Participant.objects.create(patient_id="patient1", password="x", salt="x",
+                                                      os_type=Participant.IOS_API, study=self.study)
+        self.survey = Survey.create_with_object_id(study=self.study, survey_type="tracking_survey",
+                                                   name="TEST_SURVEY_FOR_TESTS")
+
+    def chunk_contents(self, number_of_rows):
+        return "\n".join([HEADER] + ["%s,a,1" % i for i in xrange(number_of_rows)])
+
+    def register_chunks(self, number_of_chunks):
+        ChunkRegistry.bulk_register_chunked_data([
+            ChunkRegistry.build_chunked_data(GPS, 420000 + i, "%s/patient1/gps/%s.csv" % (self.study.object_id, i),
+                                             self.chunk_contents(1), self.study.pk, self.participant.pk)
+            for i in xrange(number_of_chunks)
+        ])
+        return sorted(ChunkRegistry.objects.all(), key=lambda chunk: chunk.time_bin)
+
+    def test_bulk_register_chunked_data(self):
+        number_of_chunks = BULK_WRITE_BATCH_SIZE + 5
+        chunks = self.register_chunks(number_of_chunks)
+        self.assertEqual(len(chunks), number_of_chunks)
+        self.assertEqual(set(chunk.number_of_observations for chunk in chunks), {1})
+        chunk_paths = [chunk.chunk_path for chunk in chunks]
+        self.assertEqual(sorted(ChunkRegistry.get_by_chunk_paths(chunk_paths + ["missing"])), sorted(chunk_paths))
+
+    def test_bulk_update_chunk_hashes(self):
+        chunks = self.register_chunks(BULK_WRITE_BATCH_SIZE + 5)
+        untouched = chunks.pop()
+        # every chunk is given different contents, so that a Case mixup would show
+        for i, chunk in enumerate(chunks):
+            chunk.set_chunk_hash(self.chunk_contents(i + 2))
+        ChunkRegistry.bulk_update_chunk_hashes(chunks)
+        for i, chunk in enumerate(chunks):
+            updated = ChunkRegistry.objects.get(pk=chunk.pk)
+            self.assertEqual(updated.chunk_hash, ChunkRegistry.hash_chunk_contents(self.chunk_contents(i + 2))[0])
+            self.assertEqual(updated.number_of_observations, i + 2)
+            self.assertGreater(updated.last_updated, untouched.last_updated)
+        self.assertEqual(ChunkRegistry.objects.get(pk=untouched.pk).chunk_hash, untouched.chunk_hash)
+        self.assertEqual(ChunkRegistry.objects.get(pk=untouched.pk).last_updated, untouched.last_updated)
+
+    def test_register_unchunked_data_is_idempotent(self):
+        chunk_path = "CHUNKED_DATA/%s/patient1/voiceRecording/1524857988.mp4" % self.study.object_id
+        chunk = ChunkRegistry.register_unchunked_data(VOICE_RECORDING, 1524857988, chunk_path,
+                                                      self.study.pk, self.participant.pk)
+        again = ChunkRegistry.register_unchunked_data(VOICE_RECORDING, 1524857988, chunk_path,
+                                                      self.study.pk, self.participant.pk)
+        self.assertEqual(again.pk, chunk.pk)
+        self.assertEqual(ChunkRegistry.objects.filter(chunk_path=chunk_path).count(), 1)
+
+    def test_resolve_chunk_foreign_keys(self):
+        binified_data = {
+            (self.study.object_id, "patient1", GPS, 420000, HEADER): [],
+            (self.study.object_id, "patient1", SURVEY_ANSWERS, 420000, HEADER): [],
+            (self.study.object_id, "not_a_patient", GPS, 420000, HEADER): [],
+        }
+        survey_id_dict = {
+            (self.study.object_id, "patient1", SURVEY_ANSWERS, HEADER): self.survey.object_id,
+            (self.study.object_id, "patient1", SURVEY_ANSWERS, "other header"): "not_a_survey",
+        }
+        participant_pks, survey_pks = resolve_chunk_foreign_keys(binified_data, survey_id_dict)
+        self.assertEqual(participant_pks, {"patient1": (self.participant.pk, self.study.pk)})
+        self.assertEqual(survey_pks, {self.survey.object_id: self.survey.pk})
+
+
+class TestChunkPrefetcher(TestCase):
+    def setUp(self):
+        self.real_retrieve_chunk = file_processing.retrieve_chunk
+        self.real_concurrent_network_ops = file_processing.CONCURRENT_NETWORK_OPS
+        file_processing.retrieve_chunk = self.retrieve_chunk
+        file_processing.CONCURRENT_NETWORK_OPS = 2
+        self.retrieved = []
+
+    def tearDown(self):
+        file_processing.retrieve_chunk = self.real_retrieve_chunk
+        file_processing.CONCURRENT_NETWORK_OPS = self.real_concurrent_network_ops
+
+    def retrieve_chunk(self, chunk_path, study_id, chunk_hash):
+        self.retrieved.append(chunk_path)
+        if chunk_path == "missing":
+            raise KeyError(chunk_path)
+        return "%s %s %s" % (chunk_path, study_id, chunk_hash)
+
+    def prefetcher(self, chunk_paths):
+        return ChunkPrefetcher([(chunk_path, "study", "hash") for chunk_path in chunk_paths])
+
+    def test_chunks_are_fetched_once_in_plan_order(self):
+        prefetcher = self.prefetcher(["a", "b", "a", "c", "d"])
+        try:
+            self.assertEqual(list(prefetcher.in_flight), ["a", "b"])
+            for chunk_path, in_flight in [("a", ["b", "c"]), ("b", ["c", "d"]), ("c", ["d"]), ("d", [])]:
+                self.assertEqual(prefetcher.retrieve(chunk_path, "study", "hash"), chunk_path + " study hash")
+                self.assertEqual(list(prefetcher.in_flight), in_flight)
+        finally:
+            prefetcher.close()
+        self.assertEqual(sorted(self.retrieved), ["a", "b", "c", "d"])
+
+    def test_skipped_and_unplanned_chunks(self):
+        prefetcher = self.prefetcher(["a", "b", "c", "d", "e"])
+        try:
+            # a and b are skipped, their prefetched contents are dropped
+            self.assertEqual(prefetcher.retrieve("c", "study", "hash"), "c study hash")
+            self.assertEqual(list(prefetcher.in_flight), ["d", "e"])
+            # chunks that were skipped or not planned are fetched when they are asked for
+            self.assertEqual(prefetcher.retrieve("a", "study", "hash"), "a study hash")
+            self.assertEqual(prefetcher.retrieve("z", "study", "hash"), "z study hash")
+            self.assertEqual(list(prefetcher.in_flight), ["d", "e"])
+        finally:
+            prefetcher.close()
+        self.assertEqual(self.retrieved.count("z"), 1)
+
+    def test_errors_are_raised_by_retrieve(self):
+        prefetcher = self.prefetcher(["missing", "a"])
+        try:
+            with self.assertRaises(KeyError):
+                prefetcher.retrieve("missing", "study", "hash")
+            self.assertEqual(prefetcher.retrieve("a", "study", "hash"), "a study hash")
+        finally:
+            prefetcher.close()
+
+
+class TestBinifiedDataAccumulator(TestCase):
+    def setUp(self):
+        self.real_spill_block_rows = binified_data_accumulator.SPILL_BLOCK_ROWS
+        binified_data_accumulator.SPILL_BLOCK_ROWS = 3
+
+    def tearDown(self):
+        binified_data_accumulator.SPILL_BLOCK_ROWS = self.real_spill_block_rows
+
+    def test_spilled_bins_are_merged_in_stable_timestamp_order(self):
+        files = [rows("5,a", "1,a", "3,a", "1,b"), rows("2,c", "1,c", "5,a"), rows("4,d"),
+                 rows("3,e", "0,e", "6,e", "1,e", "2,e", "2,f", "0,f")]
+        # the budget only holds a few rows, the bin is spilled more than once
+        accumulator = BinifiedDataAccumulator(memory_budget=500)
+        try:
+            for ftp_id, file_rows in enumerate(files):
+                accumulator.add("bin", [list(row) for row in file_rows], ftp_id)
+                accumulator.add("other bin", rows("9,z"), ftp_id)
+            self.assertGreater(accumulator.spilled_bytes, 0)
+            self.assertGreater(len(accumulator.bins["bin"][2]), 1)
+            expected = [row for file_rows in files for row in file_rows]
+            ensure_sorted_by_timestamp(expected)
+            binified_data = dict((data_bin, (list(rows), list(ftp_ids)))
+                                 for data_bin, (rows, ftp_ids) in accumulator.iteritems())
+            self.assertEqual(binified_data["bin"], (expected, [0, 1, 2, 3]))
+            self.assertEqual(binified_data["other bin"], (rows("9,z") * 4, [0, 1, 2, 3]))
+            self.assertEqual(accumulator.in_memory_size, 0)
+        finally:
+            accumulator.close()
+        self.assertIsNone(accumulator.spill_file)
+
+    def test_rows_that_cannot_be_sorted_fail_when_their_bin_is_read(self):
+        accumulator = BinifiedDataAccumulator(memory_budget=200)
+        try:
+            accumulator.add("bad bin", rows("2,a", "1x,a", "1,a"), 0)
+            accumulator.add("good bin", rows("2,a", "1,a", "3,a"), 1)
+            self.assertGreater(accumulator.spilled_bytes, 0)
+            for data_bin, (bin_rows, _) in accumulator.iteritems():
+                if data_bin == "bad bin":
+                    self.assertRaises(ValueError, list, bin_rows)
+                else:
+                    self.assertEqual(list(bin_rows), rows("1,a", "2,a", "3,a"))
+        finally:
+            accumulator.close()
+
+
+@skipIf(mock_s3 is None, "moto is not installed")
+class TestMoveUnchunkableFiles(DatabaseTestCase):
+    def setUp(self):
+        self.mock = mock_s3()
+        self.mock.start()
+        self.real_conn = s3.conn
+        s3.conn = s3.create_s3_client()
+        s3.conn.create_bucket(Bucket=S3_BUCKET)
+        self.study = Study.create_with_object_id(name="TEST_STUDY_FOR_TESTS",
+                                                 encryption_key="aabbccddefggiijjkklmnoppqqrrsstt")
+        self.participant = Participant.objects.create(patient_id="patient1", password="x", salt="x",
+                                                      os_type=Participant.IOS_API, study=self.study)
+        self.raw_path = construct_s3_raw_data_path(self.study.object_id, "patient1/voiceRecording/1524857988000.mp4")
+        self.chunked_path = construct_s3_chunk_path_from_raw_data_path(self.raw_path)
+        s3.conn.put_object(Bucket=S3_BUCKET, Key=self.raw_path, Body="audio")
+
+    def tearDown(self):
+        s3.conn = self.real_conn
+        self.mock.stop()
+
+    def unchunkable_file(self, ftp_id):
+        ftp = {"id": ftp_id, "s3_file_path": self.raw_path, "study": self.study, "participant": self.participant}
+        return ftp, VOICE_RECORDING, 1524857988, self.chunked_path
+
+    def move(self, *ftp_ids):
+        ftps_to_remove = set()
+        error_handler = ErrorHandler()
+        move_unchunkable_files([self.unchunkable_file(ftp_id) for ftp_id in ftp_ids], ftps_to_remove, error_handler)
+        return ftps_to_remove, error_handler.errors
+
+    def test_duplicate_ftps(self):
+        self.assertEqual(self.move(1, 2), ({1, 2}, {}))
+        # and a duplicate that is processed after the file was moved and registered
+        self.assertEqual(self.move(3), ({3}, {}))
+        self.assertEqual(ChunkRegistry.objects.filter(chunk_path=self.chunked_path).count(), 1)
+        self.assertEqual(s3.s3_list_files(self.chunked_path), [self.chunked_path])
+
+    def test_retry_after_failed_registration(self):
+        real_register_unchunked_data = ChunkRegistry.register_unchunked_data
+
+        def failing_register_unchunked_data(*args, **kwargs):
+            raise IOError("the database is down")
+        ChunkRegistry.register_unchunked_data = staticmethod(failing_register_unchunked_data)
+        try:
+            ftps_to_remove, errors = self.move(1)
+        finally:
+            ChunkRegistry.register_unchunked_data = real_register_unchunked_data
+        self.assertEqual(ftps_to_remove, set())
+        self.assertEqual(len(errors), 1)
+        # the raw file was moved before registration failed, the retry registers it
+        self.assertEqual(s3.s3_list_files(self.raw_path), [])
+        self.assertEqual(self.move(1), ({1}, {}))
+        self.assertTrue(ChunkRegistry.objects.filter(chunk_path=self.chunked_path).exists())
+
+    def test_missing_file(self):
+        s3.conn.delete_object(Bucket=S3_BUCKET, Key=self.raw_path)
+        ftps_to_remove, errors = self.move(1)
+        self.assertEqual(ftps_to_remove, set())
+        self.assertEqual(len(errors), 1)
+        self.assertFalse(ChunkRegistry.objects.exists())
+
+
+def put_binification_pool(queue):
+    queue.put(file_processing.get_binification_pool())
+
+
+def put_pool_binified_payload(queue, payload):
+    # as do_process_user_file_chunks hands csvs to the pool
+    process_pool = file_processing.get_binification_pool()
+    queue.put(unmarshal_binified_payload(
+        process_pool.apply_async(marshalled_binify_csv_payload, (payload,)).get()
+    ))
+    process_pool.close()
+    process_pool.join()
+
+
+class TestBinification(TestCase):
+    def payload(self, data_type, file_contents):
+        return {"file_contents": file_contents, "data_type": data_type,
+                "s3_file_path": "study/patient/%s/1524857988000.csv" % data_type,
+                "os_type": Participant.IOS_API, "study_object_id": u"study", "patient_id": u"patient"}
+
+    def test_marshalled_payload_matches_binify_csv_payload(self):
+        contents = "\n".join([HEADER] + ["%s,a,%s" % (1524857988000 + i * 600000, i) for i in range(20)])
+        for data_type in [ACCELEROMETER, GPS]:
+            binified_data, survey_id_hash = binify_csv_payload(self.payload(data_type, contents))
+            expected = dict((data_bin, list(rows)) for data_bin, rows in binified_data.iteritems())
+            self.assertEqual(len(expected), 4)
+            marshalled = marshalled_binify_csv_payload(self.payload(data_type, contents))
+            self.assertEqual(unmarshal_binified_payload(marshalled), (expected, survey_id_hash))
+        empty = marshalled_binify_csv_payload(self.payload(GPS, HEADER))
+        self.assertEqual(unmarshal_binified_payload(empty), (None, None))
+
+    @skipIf(file_processing.DAEMONIC_PROCESS_POOLS, "billiard is installed")
+    def test_no_process_pool_in_a_daemonic_process(self):
+        original_ops = file_processing.CONCURRENT_PROCESSING_OPS
+        file_processing.CONCURRENT_PROCESSING_OPS = 2
+        try:
+            queue = Queue()
+            process = Process(target=put_binification_pool, args=(queue,))
+            process.daemon = True
+            process.start()
+            self.assertIsNone(queue.get(timeout=10))
+            process.join()
+        finally:
+            file_processing.CONCURRENT_PROCESSING_OPS = original_ops
+
+    @skipIf(not file_processing.DAEMONIC_PROCESS_POOLS, "billiard is not installed")
+    def test_process_pool_in_a_celery_worker_process(self):
+        import billiard
+        contents = "\n".join([HEADER] + ["%s,a,%s" % (1524857988000 + i * 600000, i) for i in range(20)])
+        payload = self.payload(GPS, contents)
+        original_ops = file_processing.CONCURRENT_PROCESSING_OPS
+        file_processing.CONCURRENT_PROCESSING_OPS = 2
+        try:
+            # Celery's prefork workers are daemonic billiard processes
+            queue = billiard.Queue()
+            process = billiard.Process(target=put_pool_binified_payload, args=(queue, payload))
+            process.daemon = True
+            process.start()
+            self.assertEqual(queue.get(timeout=30), unmarshal_binified_payload(marshalled_binify_csv_payload(payload)))
+            process.join()
+        finally:
+            file_processing.CONCURRENT_PROCESSING_OPS = original_ops
@@ -1,8 +1,27 @@
+import zlib
+from io import BytesIO
+from os import urandom
+from shutil import rmtree
+from tempfile import mkdtemp
+from unittest import skipIf, TestCase
+
+from Crypto.Cipher import AES
+from botocore.exceptions import (ClientError, ConnectionClosedError, EndpointConnectionError,
+    NoCredentialsError, ParamValidationError, ReadTimeoutError)
 from django.test import TransactionTestCase
 
+from config.settings import S3_BUCKET
+from database.data_access_models import ChunkRegistry
 from database.study_models import Study
+from libs import encryption, s3
+from libs.chunk_cache import ChunkCache, ChunkHasher
 from libs.s3 import s3_upload, s3_retrieve
 
+try:
+    from moto import mock_s3
+except ImportError:
+    mock_s3 = None
+
 
 class TestRoutes(TransactionTestCase):
     def setUp(self):
@@ -20,3 +39,177 @@ class TestRoutes(TransactionTestCase):
         s3_upload("test_file_for_tests.txt", test_data, study.object_id)
         s3_data = s3_retrieve("test_file_for_tests.txt", study.object_id)
         self.assertEqual(s3_data, test_data)
+
+
+@skipIf(mock_s3 is None, "moto is not installed")
+class TestS3Transfers(TransactionTestCase):
+    """ Runs against moto's S3 stand-in rather than the real bucket. """
+
+    def setUp(self):
+        self.mock = mock_s3()
+        self.mock.start()
+        self.real_conn = s3.conn
+        s3.conn = s3.create_s3_client()
+        s3.conn.create_bucket(Bucket=S3_BUCKET)
+        self.study = Study(object_id='0vsvxgyx5skpI0ndOSAk1Duf',
+                           encryption_key='aabbccddefggiijjkklmnoppqqrrsstt',
+                           name='TEST_STUDY_FOR_TESTS')
+        self.study.save()
+
+    def tearDown(self):
+        s3.conn = self.real_conn
+        self.mock.stop()
+
+    def test_multipart_upload_and_ranged_retrieve(self):
+        # larger than a transfer part, and not a multiple of it
+        test_data = urandom(s3.TRANSFER_PART_SIZE * 2 + 12345)
+        s3_upload("large_file_for_tests", test_data, self.study.object_id)
+        self.assertEqual(s3_retrieve("large_file_for_tests", self.study.object_id), test_data)
+        self.assertIn("multipart_put", s3.s3_metrics.stats())
+        self.assertIn("get_range", s3.s3_metrics.stats())
+
+    def test_streamed_upload_and_retrieve(self):
+        test_data = urandom(s3.TRANSFER_PART_SIZE + 12345)
+        s3.s3_upload_stream("streamed_file_for_tests", BytesIO(test_data), self.study.object_id)
+        self.assertEqual(s3_retrieve("streamed_file_for_tests", self.study.object_id), test_data)
+        stream = s3.s3_retrieve_stream("streamed_file_for_tests", self.study.object_id)
+        self.assertEqual("".join(stream), test_data)
+
+    def test_reencrypt_legacy_object(self):
+        key_path = self.study.object_id + "/legacy_file_for_tests"
+        iv = urandom(16)
+        s3.conn.put_object(Bucket=S3_BUCKET, Key=key_path, Body=iv + AES.new(
+            self.study.encryption_key, AES.MODE_CFB, segment_size=8, IV=iv).encrypt("legacy data"))
+        original_version = encryption.SERVER_ENCRYPTION_VERSION
+        encryption.SERVER_ENCRYPTION_VERSION = encryption.SERVER_ENCRYPTION_CFB8
+        try:
+            # nothing to do until the servers are switched to ctr
+            self.assertFalse(s3.s3_reencrypt(key_path, self.study.object_id))
+            encryption.SERVER_ENCRYPTION_VERSION = encryption.SERVER_ENCRYPTION_CTR
+            self.assertTrue(s3.s3_reencrypt(key_path, self.study.object_id))
+            self.assertFalse(s3.s3_reencrypt(key_path, self.study.object_id))
+        finally:
+            encryption.SERVER_ENCRYPTION_VERSION = original_version
+        self.assertEqual(s3_retrieve(key_path, self.study.object_id, raw_path=True), "legacy data")
+
+    def test_compressed_upload_and_deflated_stream(self):
+        test_data = "header\n" + "1,2,3\n" * 10000
+        s3_upload("compressed_file_for_tests", test_data, self.study.object_id, compression_level=6)
+        self.assertEqual(s3_retrieve("compressed_file_for_tests", self.study.object_id), test_data)
+        stream = s3.s3_retrieve_stream("compressed_file_for_tests", self.study.object_id, inflate=False)
+        self.assertTrue(stream.deflated)
+        self.assertEqual((stream.size, stream.crc), (len(test_data), zlib.crc32(test_data) & 0xffffffff))
+        self.assertEqual(zlib.decompress("".join(stream), -zlib.MAX_WBITS), test_data)
+
+    def test_missing_key_is_not_retried(self):
+        s3.s3_metrics.reset()
+        with self.assertRaises(s3.ClientError):
+            s3_retrieve("missing_file_for_tests", self.study.object_id, number_retries=3)
+        self.assertEqual(s3.s3_metrics.stats()["get"]["count"], 1)
+
+    def test_move_many_and_delete_many(self):
+        sources = ["RAW_DATA/tests/%s.mp4" % i for i in range(5)]
+        for source in sources:
+            s3.conn.put_object(Bucket=S3_BUCKET, Key=source, Body="audio")
+        failures = s3.s3_move_many(
+            [(source, source.replace("RAW_DATA", "CHUNKED_DATA")) for source in sources + ["RAW_DATA/tests/missing"]]
+        )
+        self.assertEqual([source for source, _, _ in failures], ["RAW_DATA/tests/missing"])
+        self.assertEqual(s3.s3_list_files("RAW_DATA/tests"), [])
+        self.assertEqual(len(s3.s3_list_files("CHUNKED_DATA/tests")), 5)
+        self.assertEqual(s3.s3_delete_many(s3.s3_list_files("CHUNKED_DATA/tests")), [])
+        self.assertEqual(s3.s3_list_files("CHUNKED_DATA/tests"), [])
+
+    def test_sharded_listing_and_folder_stats(self):
+        key_paths = ["CHUNKED_DATA/study_%s/participant_%s/gps/%s.csv" % (study, participant, i)
+                     for study in range(2) for participant in range(3) for i in range(4)]
+        for key_path in key_paths:
+            s3.conn.put_object(Bucket=S3_BUCKET, Key=key_path, Body="data")
+        for shard_depth in range(3):
+            listed = sorted(key_path for key_path, _ in s3.s3_iterate_objects("CHUNKED_DATA", shard_depth))
+            self.assertEqual(listed, sorted(key_paths))
+        self.assertEqual(s3.s3_folder_stats("CHUNKED_DATA", prefix_depth=1),
+                         {"study_0": {"count": 12, "bytes": 48}, "study_1": {"count": 12, "bytes": 48}})
+
+
+class TestS3Retries(TestCase):
+    def setUp(self):
+        self.original_backoff_base = s3.BACKOFF_BASE
+        s3.BACKOFF_BASE = 0
+
+    def tearDown(self):
+        s3.BACKOFF_BASE = self.original_backoff_base
+
+    def attempts(self, error):
+        """ Returns the number of attempts _s3_call makes of a call that fails twice with error. """
+        attempts = []
+
+        def function():
+            attempts.append(error)
+            if len(attempts) <= 2:
+                raise error
+            return "data"
+        try:
+            s3._s3_call("test", function, number_retries=2)
+        except type(error):
+            pass
+        return len(attempts)
+
+    def client_error(self, code, status):
+        return ClientError({"Error": {"Code": code}, "ResponseMetadata": {"HTTPStatusCode": status}}, "GetObject")
+
+    def test_connection_errors_and_throttling_are_retried(self):
+        for error in [EndpointConnectionError(endpoint_url="https://s3"),
+                      ReadTimeoutError(endpoint_url="https://s3"),
+                      ConnectionClosedError(endpoint_url="https://s3"),
+                      self.client_error("SlowDown", 503),
+                      self.client_error("InternalError", 500),
+                      self.client_error("RequestTimeout", 400)]:
+            self.assertEqual(self.attempts(error), 3)
+
+    def test_other_errors_are_raised_immediately(self):
+        for error in [self.client_error("NoSuchKey", 404),
+                      self.client_error("AccessDenied", 403),
+                      ParamValidationError(report="invalid Bucket"),
+                      NoCredentialsError(),
+                      TypeError("a bug")]:
+            self.assertEqual(self.attempts(error), 1)
+
+
+class TestChunkCache(TestCase):
+    def setUp(self):
+        self.directory = mkdtemp()
+        self.cache = ChunkCache(self.directory, 1000)
+
+    def tearDown(self):
+        rmtree(self.directory)
+
+    def test_chunk_hasher_matches_chunk_registry(self):
+        contents = "header\n1,2\n\n3,4\n\n\n"
+        for block_size in (1, 2, 5, len(contents)):
+            hasher = ChunkHasher()
+            for i in xrange(0, len(contents), block_size):
+                hasher.update(contents[i:i + block_size])
+            self.assertEqual(hasher.chunk_hash(), ChunkRegistry.hash_chunk_contents(contents)[0])
+
+    def test_entries_are_keyed_and_verified_by_chunk_hash(self):
+        contents = "header\n1,2\n"
+        chunk_hash = ChunkRegistry.hash_chunk_contents(contents)[0]
+        self.assertTrue(self.cache.put("a_chunk", chunk_hash, contents))
+        self.assertEqual(self.cache.get("a_chunk", chunk_hash), contents)
+        # an updated chunk has a new hash, the old entry is never served for it
+        self.assertIsNone(self.cache.get("a_chunk", ChunkRegistry.hash_chunk_contents("other\n")[0]))
+        # contents that do not match their hash are not cached
+        self.assertFalse(self.cache.put("b_chunk", chunk_hash, "something else\n"))
+        self.assertIsNone(self.cache.get("b_chunk", chunk_hash))
+        stats = self.cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["rejected"]), (1, 2, 1))
+
+    def test_least_recently_used_entries_are_evicted(self):
+        for i in xrange(10):
+            self.cache.put("chunk_%s" % i, "", "x" * 150)
+            self.cache.get("chunk_0", "")
+        self.assertIsNotNone(self.cache.get("chunk_0", ""))
+        self.assertIsNotNone(self.cache.get("chunk_9", ""))
+        self.assertIsNone(self.cache.get("chunk_1", ""))
+        self.assertGreater(self.cache.stats()["evictions"], 0)
@@ -0,0 +1,70 @@
+import struct
+from io import BytesIO
+from unittest import TestCase
+from zipfile import LargeZipFile, ZipFile, ZIP_DEFLATED, ZIP_STORED, ZIP64_LIMIT
+
+from libs import streaming_zip
+from libs.streaming_zip import StreamingZipFile
+
+
+class Blocks(list):
+    """ The parts of a DownloadBlocks that write_blocks uses. """
+    def __init__(self, blocks, size=None):
+        super(Blocks, self).__init__(blocks)
+        self.size = size
+
+
+def local_header(zip_contents):
+    """ Returns the extract version, the extra field and the rest of the first member's local header. """
+    (_, extract_version, _, _, _, _, _, _, _, file_name_length,
+     extra_length) = struct.unpack("<4sHHHHHLLLHH", zip_contents[:30])
+    extra = zip_contents[30 + file_name_length:30 + file_name_length + extra_length]
+    return extract_version, extra, zip_contents[30 + file_name_length + extra_length:]
+
+
+class TestStreamingZip(TestCase):
+    contents = ["header\n", "1,2,3\n" * 1000]
+
+    def write(self, blocks, compression=ZIP_STORED):
+        zip_file = StreamingZipFile(compression)
+        zip_contents = "".join(zip_file.write_blocks("a_file.csv", blocks)) + zip_file.close()
+        self.assertEqual(ZipFile(BytesIO(zip_contents)).read("a_file.csv"), "".join(self.contents))
+        return zip_contents
+
+    def test_known_size(self):
+        for compression in [ZIP_STORED, ZIP_DEFLATED]:
+            zip_contents = self.write(Blocks(self.contents, len("".join(self.contents))), compression)
+            extract_version, extra, _ = local_header(zip_contents)
+            self.assertEqual(extra, "")
+            self.assertEqual(extract_version, 20)
+
+    def test_unknown_size_has_zip64_sizes(self):
+        for compression in [ZIP_STORED, ZIP_DEFLATED]:
+            zip_contents = self.write(Blocks(self.contents), compression)
+            extract_version, extra, rest = local_header(zip_contents)
+            # the zip64 extra field, with the sizes left at 0
+            self.assertEqual(extra, struct.pack("<HHQQ", 1, 16, 0, 0))
+            self.assertEqual(extract_version, 45)
+            # the data descriptor, after the member's data, has 64 bit sizes
+            size = len("".join(self.contents))
+            compressed_size = size if compression == ZIP_STORED else ZipFile(
+                BytesIO(zip_contents)).getinfo("a_file.csv").compress_size
+            descriptor = rest[compressed_size:compressed_size + 24]
+            self.assertEqual(struct.unpack("<4sLQQ", descriptor)[2:], (compressed_size, size))
+
+    def test_size_over_the_zip64_limit_has_zip64_sizes(self):
+        zip_contents = self.write(Blocks(self.contents, ZIP64_LIMIT + 1))
+        self.assertEqual(local_header(zip_contents)[1], struct.pack("<HHQQ", 1, 16, 0, 0))
+        # deflate may expand a file that is just under the limit past it
+        zip_contents = self.write(Blocks(self.contents, ZIP64_LIMIT - 10), ZIP_DEFLATED)
+        self.assertEqual(local_header(zip_contents)[1], struct.pack("<HHQQ", 1, 16, 0, 0))
+
+    def test_member_larger_than_its_size(self):
+        original_limit = streaming_zip.ZIP64_LIMIT
+        streaming_zip.ZIP64_LIMIT = 100
+        try:
+            # its header was written without zip64 sizes, which cannot be added after it
+            with self.assertRaises(LargeZipFile):
+                list(StreamingZipFile().write_blocks("a_file.csv", Blocks(self.contents, 10)))
+        finally:
+            streaming_zip.ZIP64_LIMIT = original_limit
@@ -0,0 +1,47 @@
+from django.test import TestCase
+
+from database.study_models import Study
+from libs.study_key_cache import study_key_cache, StudyKeyCache
+
+
+class TestStudyKeyCache(TestCase):
+    def setUp(self):
+        self.study = Study.create_with_object_id(name="TEST_STUDY_FOR_TESTS",
+                                                 encryption_key="aabbccddefggiijjkklmnoppqqrrsstt")
+
+    def test_entries_are_cached_until_they_expire(self):
+        cache = StudyKeyCache(ttl=300)
+        with self.assertNumQueries(1):
+            self.assertEqual(cache.get_object_id(self.study.pk), self.study.object_id)
+            # the key was cached by the same query
+            self.assertEqual(cache.get_encryption_key(self.study.object_id), self.study.encryption_key)
+            self.assertEqual(cache.get_object_id(self.study.pk), self.study.object_id)
+        self.assertEqual(cache.stats(), {"hits": 2, "misses": 1, "size": 1})
+
+    def test_expired_entries_are_looked_up_again(self):
+        cache = StudyKeyCache(ttl=0)
+        with self.assertNumQueries(2):
+            self.assertEqual(cache.get_encryption_key(self.study.object_id), self.study.encryption_key)
+            self.assertEqual(cache.get_encryption_key(self.study.object_id), self.study.encryption_key)
+        self.assertEqual(cache.stats(), {"hits": 0, "misses": 2, "size": 1})
+
+    def test_invalidate(self):
+        cache = StudyKeyCache(ttl=300)
+        cache.get_object_id(self.study.pk)
+        cache.invalidate(self.study.object_id)
+        self.assertEqual((cache.encryption_keys, cache.object_ids), ({}, {}))
+        cache.get_object_id(self.study.pk)
+        cache.invalidate()
+        self.assertEqual((cache.encryption_keys, cache.object_ids), ({}, {}))
+
+    def test_saving_a_study_invalidates_its_entries(self):
+        self.addCleanup(study_key_cache.invalidate)
+        study_key_cache.get_object_id(self.study.pk)
+        with self.assertNumQueries(0):
+            study_key_cache.get_encryption_key(self.study.object_id)
+        self.study.encryption_key = "ttssrrqqppoonmlkkjjiiggfeddccbba"
+        self.study.save()
+        # both of its entries were dropped
+        with self.assertNumQueries(2):
+            self.assertEqual(study_key_cache.get_encryption_key(self.study.object_id), self.study.encryption_key)
+            self.assertEqual(study_key_cache.get_object_id(self.study.pk), self.study.object_id)
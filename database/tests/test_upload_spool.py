@@ -0,0 +1,185 @@
+import os
+from datetime import datetime
+from shutil import rmtree
+from tempfile import mkdtemp
+from time import time
+
+from django.test import TestCase
+from django.utils import timezone
+
+from database.data_access_models import FileToProcess
+from database.profiling_models import ReceivedDataStats, UploadTracking
+from database.study_models import Study
+from database.user_models import Participant
+from libs import upload_spool
+from libs.s3 import construct_s3_raw_data_path
+from libs.upload_spool import (CLAIMED_SUFFIX, local_directory_store, SPOOLED_SUFFIX,
+    TEMPORARY_SUFFIX, UploadSpool)
+
+
+class TestUploadSpool(TestCase):
+    def setUp(self):
+        self.spool_directory = mkdtemp()
+        self.store_directory = mkdtemp()
+        self.study = Study.create_with_object_id(name="TEST_STUDY_FOR_TESTS",
+                                                 encryption_key="aabbccddefggiijjkklmnoppqqrrsstt")
+        self.participant = Participant.objects.create(patient_id="patient1", password="x", salt="x",
+                                                      os_type=Participant.IOS_API, study=self.study)
+
+    def tearDown(self):
+        rmtree(self.spool_directory)
+        rmtree(self.store_directory)
+
+    def upload_spool(self):
+        # no uploader threads, the tests drain the spool themselves
+        return UploadSpool(self.spool_directory, store=local_directory_store(self.store_directory),
+                           uploader_count=0)
+
+    def spool(self, spool, file_name, contents):
+        s3_path = construct_s3_raw_data_path(self.study.object_id, "patient1/gps/%s" % file_name)
+        spool.spool(s3_path, contents, self.study.object_id, self.study.pk, self.participant.pk)
+        return s3_path
+
+    def spooled_files(self, suffix):
+        return [file_name for file_name in os.listdir(self.spool_directory) if file_name.endswith(suffix)]
+
+    def stored_contents(self, s3_path):
+        with open(os.path.join(self.store_directory, s3_path), "rb") as f:
+            return f.read()
+
+    def test_spool_then_upload(self):
+        spool = self.upload_spool()
+        s3_path = self.spool(spool, "1524857988000.csv", "timestamp,x\n1,2")
+        self.assertEqual(len(self.spooled_files(SPOOLED_SUFFIX)), 1)
+        self.assertEqual(spool.drain_batch(), 1)
+        self.assertEqual(os.listdir(self.spool_directory), [])
+        self.assertEqual(self.stored_contents(s3_path), "timestamp,x\n1,2")
+        self.assertEqual(list(FileToProcess.objects.values_list("s3_file_path", "participant_id")),
+                         [(s3_path, self.participant.pk)])
+        self.assertEqual(list(UploadTracking.objects.values_list("file_path", "file_size")), [(s3_path, 15)])
+        self.assertEqual(spool.drain_batch(), 0)
+
+    def test_uploads_survive_a_crash_before_they_are_sent(self):
+        # the process dies after spool() returned, before any uploader ran
+        s3_path = self.spool(self.upload_spool(), "1524857988000.csv", "contents")
+        # and in the middle of writing another upload, which was never acknowledged
+        with open(os.path.join(self.spool_directory, "1-unfinished" + TEMPORARY_SUFFIX), "wb") as f:
+            f.write("partial")
+
+        restarted_spool = self.upload_spool()
+        self.assertEqual(restarted_spool.drain_batch(), 1)
+        self.assertEqual(self.stored_contents(s3_path), "contents")
+        self.assertEqual(FileToProcess.objects.count(), 1)
+        self.assertEqual(os.listdir(self.spool_directory), ["1-unfinished" + TEMPORARY_SUFFIX])
+
+    def test_stale_claims_are_released(self):
+        spool = self.upload_spool()
+        stale_path = self.spool(spool, "1524857988000.csv", "stale")
+        self.spool(spool, "1524857989000.csv", "fresh")
+        # a process claimed the first upload and died, the second claim is still being worked on
+        stale_claim, _ = spool.claim_batch()
+        long_ago = time() - upload_spool.STALE_CLAIM_SECONDS - 60
+        os.utime(stale_claim, (long_ago, long_ago))
+
+        restarted_spool = self.upload_spool()
+        restarted_spool.start()
+        self.assertEqual(len(self.spooled_files(SPOOLED_SUFFIX)), 1)
+        self.assertEqual(len(self.spooled_files(CLAIMED_SUFFIX)), 1)
+        self.assertEqual(restarted_spool.drain_batch(), 1)
+        self.assertEqual(self.stored_contents(stale_path), "stale")
+
+    def test_failed_uploads_stay_in_the_spool(self):
+        spool = self.upload_spool()
+        self.spool(spool, "1524857988000.csv", "contents")
+
+        def failing_store(s3_path, contents, study_object_id):
+            raise IOError("S3 is down")
+        spool.store = failing_store
+        self.assertEqual(spool.drain_batch(), 0)
+        self.assertEqual(len(self.spooled_files(SPOOLED_SUFFIX)), 1)
+        self.assertEqual(FileToProcess.objects.count(), 0)
+        # it waits out its retry delay instead of being claimed again straight away
+        self.assertEqual(spool.claim_batch(), [])
+
+    def test_uploads_that_always_fail_are_quarantined(self):
+        spool = self.upload_spool()
+        failing_path = self.spool(spool, "1524857988000.csv", "fails")
+        store = spool.store
+
+        def failing_store(s3_path, contents, study_object_id):
+            if s3_path == failing_path:
+                raise IOError("S3 is down")
+            store(s3_path, contents, study_object_id)
+        spool.store = failing_store
+
+        original_retry_seconds = upload_spool.UPLOAD_SPOOL_RETRY_SECONDS
+        upload_spool.UPLOAD_SPOOL_RETRY_SECONDS = 0
+        try:
+            for attempt in xrange(1, upload_spool.UPLOAD_SPOOL_MAX_ATTEMPTS):
+                self.assertEqual(spool.drain_batch(), 0)
+                [spooled_file] = self.spooled_files(SPOOLED_SUFFIX)
+                self.assertEqual(upload_spool.spooled_attempts(spooled_file), attempt)
+            # a failing upload does not hold back the uploads spooled after it
+            working_path = self.spool(spool, "1524857989000.csv", "works")
+            upload_spool.UPLOAD_SPOOL_BATCH_SIZE, original_batch_size = 1, upload_spool.UPLOAD_SPOOL_BATCH_SIZE
+            try:
+                self.assertEqual(spool.drain_batch(), 1)
+            finally:
+                upload_spool.UPLOAD_SPOOL_BATCH_SIZE = original_batch_size
+            self.assertEqual(self.stored_contents(working_path), "works")
+            self.assertEqual(spool.drain_batch(), 0)
+        finally:
+            upload_spool.UPLOAD_SPOOL_RETRY_SECONDS = original_retry_seconds
+
+        self.assertEqual(os.listdir(self.spool_directory), [upload_spool.QUARANTINE_DIRECTORY])
+        self.assertEqual(len(os.listdir(os.path.join(self.spool_directory, upload_spool.QUARANTINE_DIRECTORY))), 1)
+        self.assertEqual(list(FileToProcess.objects.values_list("s3_file_path", flat=True)), [working_path])
+
+    def test_uploads_of_deleted_participants_are_quarantined(self):
+        spool = self.upload_spool()
+        recorded_path = self.spool(spool, "1524857988000.csv", "contents")
+        missing_participant_path = construct_s3_raw_data_path(self.study.object_id, "patient2/gps/1524857988000.csv")
+        spool.spool(missing_participant_path, "contents", self.study.object_id, self.study.pk,
+                    self.participant.pk + 1000)
+        self.assertEqual(spool.drain_batch(), 1)
+        self.assertEqual(list(FileToProcess.objects.values_list("s3_file_path", flat=True)), [recorded_path])
+        self.assertEqual(os.listdir(self.spool_directory), [upload_spool.QUARANTINE_DIRECTORY])
+
+    def test_a_failing_upload_does_not_fail_its_batch(self):
+        spool = self.upload_spool()
+        recorded_path = self.spool(spool, "1524857988000.csv", "contents")
+        failing_path = self.spool(spool, "1524857989000.csv", "contents")
+        record_uploads = UploadSpool.record_uploads
+
+        def failing_record_uploads(uploads):
+            if failing_path in [upload["s3_path"] for upload in uploads]:
+                raise ValueError("bad row")
+            record_uploads(uploads)
+        spool.record_uploads = failing_record_uploads
+        self.assertEqual(spool.drain_batch(), 1)
+        self.assertEqual(list(FileToProcess.objects.values_list("s3_file_path", flat=True)), [recorded_path])
+        [spooled_file] = self.spooled_files(SPOOLED_SUFFIX)
+        self.assertEqual(upload_spool.spooled_attempts(spooled_file), 1)
+
+    def test_record_uploads_updates_received_data_stats(self):
+        first_upload = timezone.make_aware(datetime(2018, 4, 27, 12), timezone.utc)
+        ReceivedDataStats.objects.create(participant=self.participant, data_type="gps",
+                                         last_upload_timestamp=first_upload, number_of_uploads=1,
+                                         number_bytes_uploaded=100)
+        uploads = [
+            {"s3_path": construct_s3_raw_data_path(self.study.object_id, "patient1/%s/1524857988000.csv" % data_type),
+             "study_pk": self.study.pk, "participant_pk": self.participant.pk, "file_size": file_size,
+             "timestamp": timestamp}
+            for data_type, file_size, timestamp in [("gps", 10, 1524900000), ("gps", 20, 1524800000),
+                                                    ("accel", 30, 1524800000)]
+        ]
+        UploadSpool.record_uploads(uploads)
+        self.assertEqual(FileToProcess.objects.count(), 3)
+        self.assertEqual(UploadTracking.objects.count(), 3)
+        stats = dict((stats.data_type, stats) for stats in ReceivedDataStats.objects.all())
+        self.assertEqual(sorted(stats), ["accelerometer", "gps"])
+        self.assertEqual((stats["gps"].number_of_uploads, stats["gps"].number_bytes_uploaded), (3, 130))
+        self.assertEqual(stats["gps"].last_upload_timestamp,
+                         timezone.make_aware(datetime.utcfromtimestamp(1524900000), timezone.utc))
+        self.assertEqual((stats["accelerometer"].number_of_uploads, stats["accelerometer"].number_bytes_uploaded),
+                         (1, 30))
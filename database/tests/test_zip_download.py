@@ -0,0 +1,138 @@
+from io import BytesIO
+from random import random
+from threading import Lock
+from time import sleep
+from unittest import TestCase
+from zipfile import ZipFile
+
+from api.data_access_api import stream_zip
+from libs import zip_download
+from libs.encryption import SERVER_STREAM_BLOCK_SIZE
+from libs.streaming_zip import StreamingZipFile
+from libs.zip_download import MIN_CONCURRENCY, PrefetchingDownload
+
+
+class Blocks(object):
+    """ The parts of a DownloadBlocks that PrefetchingDownload uses, a file that fits in a block
+    and is closed once it is opened, or a larger one that holds its connection open. """
+    def __init__(self, item, size):
+        self.item = item
+        self.first_block = "x" * min(size, SERVER_STREAM_BLOCK_SIZE)
+        self.stream = object() if size > SERVER_STREAM_BLOCK_SIZE else None
+        self.bytes_read = len(self.first_block)
+        self.closed = False
+
+    def close(self):
+        self.stream = None
+        self.closed = True
+
+
+class Opener(object):
+    """ An open_file for a PrefetchingDownload that keeps track of the files it opened. """
+    def __init__(self, size=1000, delay=0.0):
+        self.size = size
+        self.delay = delay
+        self.lock = Lock()
+        self.opened = []
+
+    def __call__(self, item):
+        if self.delay:
+            sleep(self.delay * random())
+        blocks = Blocks(item, self.size)
+        with self.lock:
+            self.opened.append(blocks)
+        return blocks
+
+
+class TestPrefetchingDownload(TestCase):
+    def test_items_come_in_order(self):
+        opener = Opener(delay=0.01)
+        download = PrefetchingDownload(range(50), opener, "test", max_concurrency=8)
+        self.assertEqual([(item, blocks.item) for item, blocks in download], [(i, i) for i in range(50)])
+        self.assertEqual(len(opener.opened), 50)
+        self.assertTrue(all(blocks.closed for blocks in opener.opened))
+        self.assertEqual(download.stats()["files"], 50)
+        self.assertEqual(download.stats()["bytes"], 50 * 1000)
+
+    def test_a_slow_consumer_bounds_the_bytes_in_flight(self):
+        opener = Opener(size=1000)
+        download = PrefetchingDownload(range(100), opener, "test", prefetch_bytes=5000, max_concurrency=4)
+        for item, _ in download:
+            # give the pool time to run as far ahead as it can
+            sleep(0.005)
+            with opener.lock:
+                opened_ahead = len(opener.opened) - item - 1
+            # a file is only started while less than prefetch_bytes are buffered, at most
+            # max_concurrency of them at once
+            self.assertLessEqual(opened_ahead, 5 + 4)
+        self.assertLessEqual(download.peak_buffered_bytes, 5000 + 4 * 1000)
+        # the window was full each time, concurrency never went up
+        self.assertEqual(download.concurrency, MIN_CONCURRENCY)
+
+    def test_large_files_that_are_waiting_hold_at_most_max_concurrency_connections(self):
+        opener = Opener(size=SERVER_STREAM_BLOCK_SIZE + 1)
+        download = PrefetchingDownload(range(20), opener, "test", prefetch_bytes=100 * SERVER_STREAM_BLOCK_SIZE,
+                                       max_concurrency=4)
+        for item, _ in download:
+            sleep(0.005)
+            with opener.lock:
+                open_connections = len([blocks for blocks in opener.opened if blocks.stream is not None])
+            self.assertLessEqual(open_connections, 4)
+
+    def test_concurrency_goes_up_when_the_consumer_waits(self):
+        opener = Opener(delay=0.02)
+        download = PrefetchingDownload(range(60), opener, "test", max_concurrency=10)
+        self.assertEqual(len(list(download)), 60)
+        self.assertGreater(download.concurrency, MIN_CONCURRENCY)
+        self.assertLessEqual(download.concurrency, 10)
+        self.assertGreater(download.stats()["wait_seconds"], 0)
+
+    def test_files_opened_ahead_are_closed_when_the_consumer_leaves(self):
+        opener = Opener(size=SERVER_STREAM_BLOCK_SIZE + 1)
+        download = PrefetchingDownload(range(20), opener, "test", max_concurrency=4)
+        iterator = iter(download)
+        next(iterator)
+        sleep(0.05)
+        iterator.close()
+        # files that were still being opened are left for the garbage collector
+        sleep(0.05)
+        self.assertTrue(download.closed)
+        self.assertLess(len(opener.opened), 20)
+        self.assertTrue(all(blocks.closed for blocks in opener.opened))
+
+    def test_metrics_are_recorded(self):
+        original_metrics = zip_download.download_metrics
+        zip_download.download_metrics = zip_download.S3Metrics()
+        try:
+            list(PrefetchingDownload(range(3), Opener(), "test"))
+            self.assertEqual(zip_download.download_metrics.stats()["test"]["count"], 1)
+        finally:
+            zip_download.download_metrics = original_metrics
+
+
+class Download(list):
+    """ The parts of a PrefetchingDownload that stream_zip uses. """
+    def close(self):
+        pass
+
+
+class FileBlocks(list):
+    """ The parts of a DownloadBlocks that StreamingZipFile uses. """
+    def __init__(self, contents):
+        super(FileBlocks, self).__init__([contents])
+        self.size = len(contents)
+
+
+class TestStreamZip(TestCase):
+    def zip_contents(self, **kwargs):
+        download = Download((file_name, FileBlocks(contents))
+                            for file_name, contents in [("a.csv", "1"), ("b.csv", "2"), ("a.csv", "3")])
+        zip_contents = "".join(stream_zip(download, StreamingZipFile(), lambda file_name: file_name, **kwargs))
+        zip_file = ZipFile(BytesIO(zip_contents))
+        return [(info.filename, zip_file.open(info).read()) for info in zip_file.infolist()]
+
+    def test_duplicate_names(self):
+        self.assertEqual(self.zip_contents(), [("a.csv", "1"), ("b.csv", "2")])
+        # pipeline downloads write every file
+        self.assertEqual(self.zip_contents(skip_duplicate_names=False),
+                         [("a.csv", "1"), ("b.csv", "2"), ("a.csv", "3")])
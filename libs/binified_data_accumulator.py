@@ -0,0 +1,159 @@
+import marshal
+from collections import deque
+from heapq import merge as heapq_merge
+from tempfile import TemporaryFile
+
+# Rough CPython 2 (64 bit) sizes of a row held in memory: a list is 72 bytes plus an 8 byte pointer
+# per field, a str is 37 bytes plus its contents.  Python object overhead, rather than the raw
+# bytes of the csv, is what makes a batch of files large in memory.
+ROW_OVERHEAD = 72
+FIELD_OVERHEAD = 45
+# Spilled rows are written and read back in marshalled blocks of this many rows, a bin that is
+# read back holds one block per spilled segment in memory rather than all of its rows.
+SPILL_BLOCK_ROWS = 10000
+
+
+def timestamp_key(row):
+    """ The sort key of ensure_sorted_by_timestamp. """
+    return int(row[0])
+
+
+def estimate_rows_size(rows):
+    """ Estimates the memory used by a list of rows from the size of its first row. """
+    if not rows:
+        return 0
+    first_row = rows[0]
+    row_size = ROW_OVERHEAD + FIELD_OVERHEAD * len(first_row) + sum(len(field) for field in first_row)
+    return row_size * len(rows)
+
+
+class BinifiedDataAccumulator(object):
+    """
+    Collects the binified rows of a batch of files, keyed by data bin, along with the ids of the
+    FileToProcess objects that contributed to each bin.
+
+    When a memory budget (in bytes) is provided and the rows held in memory exceed it, the
+    largest bins are spilled to a temporary file, sorted by timestamp, as marshalled blocks of
+    rows.  iteritems reads the bins back one at a time, merging the spilled segments of a bin with
+    the rows still in memory, so a bin is never loaded into memory whole.  A budget of 0 keeps
+    everything in memory.
+    """
+
+    def __init__(self, memory_budget=0):
+        self.memory_budget = memory_budget
+        # data_bin -> (in memory rows, ftp ids, spilled segments)
+        self.bins = {}
+        self.bin_sizes = {}
+        self.in_memory_size = 0
+        self.spill_file = None
+        self.spilled_bytes = 0
+
+    def add(self, data_bin, rows, ftp_id):
+        if data_bin not in self.bins:
+            self.bins[data_bin] = (deque(), deque(), [])
+            self.bin_sizes[data_bin] = 0
+        in_memory_rows, ftp_ids, _ = self.bins[data_bin]
+        size = estimate_rows_size(rows)
+        in_memory_rows.extend(rows)
+        ftp_ids.append(ftp_id)
+        self.bin_sizes[data_bin] += size
+        self.in_memory_size += size
+        if self.memory_budget and self.in_memory_size > self.memory_budget:
+            self.spill()
+
+    def spill(self):
+        """ Writes the largest in memory bins to the spill file until at most half of the memory
+        budget is in use. """
+        if self.spill_file is None:
+            self.spill_file = TemporaryFile(prefix="binified_data")
+        self.spill_file.seek(0, 2)
+        for data_bin in sorted(self.bin_sizes, key=self.bin_sizes.get, reverse=True):
+            if self.in_memory_size <= self.memory_budget / 2:
+                break
+            in_memory_rows, _, segments = self.bins[data_bin]
+            if not in_memory_rows:
+                continue
+            segments.append(self.write_segment(list(in_memory_rows)))
+            in_memory_rows.clear()
+            self.in_memory_size -= self.bin_sizes[data_bin]
+            self.bin_sizes[data_bin] = 0
+        self.spilled_bytes = self.spill_file.tell()
+
+    def write_segment(self, rows):
+        """ Sorts rows and appends them to the spill file in blocks of SPILL_BLOCK_ROWS rows.
+        Returns the segment: its offset, its number of blocks and whether it is sorted.  Rows with
+        a timestamp that is not an integer cannot be sorted; they are written as they are, and
+        fail when they are read back, as they would have with all the rows in memory. """
+        try:
+            rows.sort(key=timestamp_key)
+            is_sorted = True
+        except ValueError:
+            is_sorted = False
+        offset = self.spill_file.tell()
+        number_of_blocks = 0
+        for i in xrange(0, len(rows), SPILL_BLOCK_ROWS):
+            marshal.dump(rows[i:i + SPILL_BLOCK_ROWS], self.spill_file)
+            number_of_blocks += 1
+        return offset, number_of_blocks, is_sorted
+
+    def read_segment(self, offset, number_of_blocks):
+        """ Yields the rows of a spilled segment, loading one block at a time.  Segments are read
+        in step with each other, so every block is read from its own position. """
+        for _ in xrange(number_of_blocks):
+            self.spill_file.seek(offset)
+            block = marshal.load(self.spill_file)
+            offset = self.spill_file.tell()
+            for row in block:
+                yield row
+
+    def _sorted_bin_rows(self, data_bin):
+        """ Yields the rows of a bin sorted by timestamp, in the order a stable sort of the rows
+        in the order they were added would put them.  The rows in memory are released once the
+        bin has been read.  Rows with a timestamp that is not an integer raise a ValueError. """
+        in_memory_rows, _, segments = self.bins[data_bin]
+        sorted_rows_iterables = []
+        for offset, number_of_blocks, is_sorted in segments:
+            segment_rows = self.read_segment(offset, number_of_blocks)
+            if not is_sorted:
+                segment_rows = sorted(segment_rows, key=timestamp_key)
+            sorted_rows_iterables.append(segment_rows)
+        sorted_rows_iterables.append(sorted(in_memory_rows, key=timestamp_key))
+        in_memory_rows.clear()
+        self.in_memory_size -= self.bin_sizes[data_bin]
+        self.bin_sizes[data_bin] = 0
+
+        if len(sorted_rows_iterables) == 1:
+            for row in sorted_rows_iterables[0]:
+                yield row
+        else:
+            # the segment index breaks timestamp ties, earlier segments were added first.
+            for _, _, row in heapq_merge(*[_decorate_rows(rows, segment_index) for segment_index, rows
+                                           in enumerate(sorted_rows_iterables)]):
+                yield row
+        del segments[:]
+
+    def __iter__(self):
+        return iter(self.bins)
+
+    def __len__(self):
+        return len(self.bins)
+
+    def __contains__(self, data_bin):
+        return data_bin in self.bins
+
+    def iteritems(self):
+        """ Yields (data_bin, (rows, ftp ids)) for every bin; rows is a generator of the bin's rows
+        sorted by timestamp that consumes them, so this can be iterated over only once. """
+        for data_bin, (_, ftp_ids, _) in self.bins.iteritems():
+            yield data_bin, (self._sorted_bin_rows(data_bin), ftp_ids)
+
+    def close(self):
+        """ Deletes the spill file. """
+        if self.spill_file is not None:
+            self.spill_file.close()
+            self.spill_file = None
+
+
+def _decorate_rows(rows, segment_index):
+    for row in rows:
+        yield timestamp_key(row), segment_index, row
@@ -0,0 +1,278 @@
+import errno
+import fcntl
+import hashlib
+import os
+from tempfile import mkstemp
+from threading import Lock
+from time import time
+
+from config.constants import CHUNK_CACHE_DIRECTORY, CHUNK_CACHE_MB, CHUNKABLE_FILES
+from libs.bw_logging import log_error
+from libs.s3 import s3_retrieve
+
+TEMPORARY_SUFFIX = ".tmp"
+LOCK_FILE_NAME = ".evict.lock"
+# The cache looks at its total size each time this fraction of its size limit has been written by
+# a process, and evicts entries down to EVICTION_TARGET of the limit.
+SIZE_CHECK_FRACTION = 0.05
+EVICTION_TARGET = 0.9
+# Temporary files older than this were left behind by a process that died, they are deleted.
+STALE_TEMPORARY_FILE_SECONDS = 60 * 60
+
+
+def cacheable_hash(data_type, chunk_hash):
+    """ Returns the chunk hash a chunk is cached under.  Chunks of unchunkable data (e.g. audio)
+    never change once they are registered, they are cached by path alone (an empty hash).  A
+    chunkable chunk without a hash is not cached (None). """
+    if data_type not in CHUNKABLE_FILES:
+        return ""
+    return chunk_hash or None
+
+
+class ChunkHasher(object):
+    """ Computes the chunk hash of ChunkRegistry.hash_chunk_contents a block at a time: trailing
+    newlines are replaced with a single newline, so they are held back until more data arrives. """
+
+    def __init__(self):
+        self.md5 = hashlib.md5()
+        self.trailing_newlines = 0
+
+    def update(self, block):
+        stripped = block.rstrip("\n")
+        if stripped:
+            self.md5.update("\n" * self.trailing_newlines)
+            self.md5.update(stripped)
+            self.trailing_newlines = len(block) - len(stripped)
+        else:
+            self.trailing_newlines += len(block)
+
+    def chunk_hash(self):
+        md5 = self.md5.copy()
+        md5.update("\n")
+        return md5.digest().encode('base64')
+
+
+class ChunkCache(object):
+    """
+    An on-disk LRU cache of decrypted files from S3, shared by the processes of a host.
+
+    Entries are keyed by key path and chunk hash, so a chunk that has been updated is a different
+    entry and a stale one is never served.  Contents are only cached if they match their chunk
+    hash; files cached with an empty chunk hash (see cacheable_hash) are not checked.
+
+    Entries are written to a temporary file and renamed into place, so readers only ever see
+    complete entries.  Reading an entry updates its modification time, and once the entries are
+    larger than max_bytes the least recently used ones are deleted by whichever process notices
+    first.  A reader that has an entry open keeps reading it if it is deleted.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.size_check_bytes = max(int(max_bytes * SIZE_CHECK_FRACTION), 1)
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.bytes_served = 0
+        self.bytes_written = 0
+        self.bytes_written_since_check = 0
+        self.rejected = 0
+        self.evictions = 0
+        if not os.path.isdir(directory):
+            # the cache holds decrypted data.
+            os.makedirs(directory, 0700)
+
+    def entry_path(self, key_path, chunk_hash):
+        name = hashlib.sha1(key_path + "\0" + chunk_hash).hexdigest()
+        return os.path.join(self.directory, name[:2], name)
+
+    def open(self, key_path, chunk_hash):
+        """ Returns the cached contents as an open file, or None if they are not cached. """
+        entry_path = self.entry_path(key_path, chunk_hash)
+        try:
+            entry = open(entry_path, "rb")
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                log_error(e, "chunk cache read error")
+            with self.lock:
+                self.misses += 1
+            return None
+        try:
+            os.utime(entry_path, None)
+        except OSError:
+            pass  # evicted since it was opened
+        with self.lock:
+            self.hits += 1
+            self.bytes_served += os.fstat(entry.fileno()).st_size
+        return entry
+
+    def get(self, key_path, chunk_hash):
+        """ Returns the cached contents, or None if they are not cached. """
+        entry = self.open(key_path, chunk_hash)
+        if entry is None:
+            return None
+        with entry:
+            return entry.read()
+
+    def put(self, key_path, chunk_hash, contents):
+        writer = self.writer(key_path, chunk_hash)
+        writer.write(contents)
+        return writer.commit()
+
+    def writer(self, key_path, chunk_hash):
+        """ Returns a ChunkCacheWriter for adding contents that arrive a block at a time. """
+        return ChunkCacheWriter(self, key_path, chunk_hash)
+
+    def _written(self, number_bytes):
+        with self.lock:
+            self.bytes_written += number_bytes
+            self.bytes_written_since_check += number_bytes
+            if self.bytes_written_since_check < self.size_check_bytes:
+                return
+            self.bytes_written_since_check = 0
+        self.evict()
+
+    def evict(self):
+        """ Deletes the least recently used entries while the cache is larger than max_bytes, and
+        any abandoned temporary files.  If another process is already evicting this does nothing. """
+        lock_file = open(os.path.join(self.directory, LOCK_FILE_NAME), "a")
+        try:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                return
+            entries = []
+            total_size = 0
+            for subdirectory in os.listdir(self.directory):
+                subdirectory_path = os.path.join(self.directory, subdirectory)
+                if not os.path.isdir(subdirectory_path):
+                    continue
+                for file_name in os.listdir(subdirectory_path):
+                    file_path = os.path.join(subdirectory_path, file_name)
+                    try:
+                        stat = os.stat(file_path)
+                    except OSError:
+                        continue
+                    if file_name.endswith(TEMPORARY_SUFFIX):
+                        if time() - stat.st_mtime > STALE_TEMPORARY_FILE_SECONDS:
+                            self._remove(file_path)
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, file_path))
+                    total_size += stat.st_size
+            if total_size <= self.max_bytes:
+                return
+            entries.sort()
+            for _, size, file_path in entries:
+                if total_size <= self.max_bytes * EVICTION_TARGET:
+                    break
+                if self._remove(file_path):
+                    with self.lock:
+                        self.evictions += 1
+                total_size -= size
+        finally:
+            lock_file.close()
+
+    @staticmethod
+    def _remove(file_path):
+        try:
+            os.remove(file_path)
+            return True
+        except OSError:
+            return False
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": float(self.hits) / lookups if lookups else 0.0,
+                "bytes_served": self.bytes_served,
+                "bytes_written": self.bytes_written,
+                "rejected": self.rejected,
+                "evictions": self.evictions,
+            }
+
+
+class ChunkCacheWriter(object):
+    """ Adds an entry to a ChunkCache a block at a time, e.g. as a file is downloaded.  The entry
+    is added by commit() if its contents match the chunk hash; abort() discards it.  Errors
+    writing to the cache are logged and the entry is discarded, they never reach the caller. """
+
+    def __init__(self, cache, key_path, chunk_hash):
+        self.cache = cache
+        self.chunk_hash = chunk_hash
+        self.entry_path = cache.entry_path(key_path, chunk_hash)
+        self.hasher = ChunkHasher() if chunk_hash else None
+        self.size = 0
+        self.file = None
+        self.temporary_path = None
+        try:
+            entry_directory = os.path.dirname(self.entry_path)
+            if not os.path.isdir(entry_directory):
+                try:
+                    os.mkdir(entry_directory, 0700)
+                except OSError as e:
+                    if e.errno != errno.EEXIST:
+                        raise
+            fd, self.temporary_path = mkstemp(dir=entry_directory, suffix=TEMPORARY_SUFFIX)
+            self.file = os.fdopen(fd, "wb")
+        except EnvironmentError as e:
+            log_error(e, "chunk cache write error")
+            self.abort()
+
+    def write(self, block):
+        if self.file is None:
+            return
+        try:
+            self.file.write(block)
+        except EnvironmentError as e:
+            log_error(e, "chunk cache write error")
+            self.abort()
+            return
+        self.size += len(block)
+        if self.hasher:
+            self.hasher.update(block)
+
+    def commit(self):
+        """ Adds the entry, returns whether it was added. """
+        if self.file is None:
+            return False
+        try:
+            self.file.close()
+            self.file = None
+            if self.hasher and self.hasher.chunk_hash() != self.chunk_hash:
+                with self.cache.lock:
+                    self.cache.rejected += 1
+                self.abort()
+                return False
+            os.rename(self.temporary_path, self.entry_path)
+        except EnvironmentError as e:
+            log_error(e, "chunk cache write error")
+            self.abort()
+            return False
+        self.cache._written(self.size)
+        return True
+
+    def abort(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if self.temporary_path is not None:
+            ChunkCache._remove(self.temporary_path)
+            self.temporary_path = None
+
+
+chunk_cache = ChunkCache(CHUNK_CACHE_DIRECTORY, CHUNK_CACHE_MB * 1024 * 1024) if CHUNK_CACHE_DIRECTORY else None
+
+
+def retrieve_chunk(key_path, study_object_id, chunk_hash):
+    """ s3_retrieve of a full key path, through the chunk cache when there is one.  chunk_hash is
+    the return value of cacheable_hash, None bypasses the cache. """
+    if chunk_cache is None or chunk_hash is None:
+        return s3_retrieve(key_path, study_object_id, raw_path=True)
+    contents = chunk_cache.get(key_path, chunk_hash)
+    if contents is None:
+        contents = s3_retrieve(key_path, study_object_id, raw_path=True)
+        chunk_cache.put(key_path, chunk_hash, contents)
+    return contents
@@ -1,3 +1,8 @@
+from collections import OrderedDict
+from threading import Lock
+from time import time
+
+from config.constants import PRIVATE_KEY_CACHE_MB, PRIVATE_KEY_CACHE_TTL_SECONDS
 from libs import encryption
 from libs.s3 import s3_upload, s3_retrieve, construct_s3_key_paths
 
@@ -11,8 +16,15 @@ def create_client_key_pair(patient_id, study_id):
     key_pair_paths = construct_s3_key_paths(study_id, patient_id)
     s3_upload(key_pair_paths['private'], private, study_id, raw_path=True )
     s3_upload(key_pair_paths['public'], public, study_id, raw_path=True )
+    private_key_cache.invalidate((study_id, patient_id))
     return
 
+def restore_client_public_key(patient_id, study_id):
+    """Recreates a user's missing public key from their private key, which is left as it is."""
+    key_pair_paths = construct_s3_key_paths(study_id, patient_id)
+    public = get_client_private_key(patient_id, study_id).publickey().exportKey()
+    s3_upload(key_pair_paths['public'], public, study_id, raw_path=True )
+
 def get_client_public_key_string(patient_id, study_id):
     """Grabs a user's public key string from s3."""
     key_pair_paths = construct_s3_key_paths(study_id, patient_id)
@@ -26,7 +38,11 @@ def get_client_public_key(patient_id, study_id):
     return encryption.import_RSA_key( key )
 
 def get_client_private_key(patient_id, study_id):
-    """Grabs a user's private key file from s3."""
+    """Grabs a user's private key file from s3, parsed keys are kept in the private_key_cache."""
+    cached_key = private_key_cache.get((study_id, patient_id))
+    if cached_key is not None:
+        return cached_key
+
     key_pair_paths = construct_s3_key_paths(study_id, patient_id)
     try:
         key = s3_retrieve(key_pair_paths['private'], study_id, raw_path=True)
@@ -34,4 +50,78 @@ def get_client_private_key(patient_id, study_id):
         print('Could not find key {0} in {1}'.format('private', key_pair_paths))
         raise
 
-    return encryption.import_RSA_key( key )
+    private_key = encryption.import_RSA_key( key )
+    private_key_cache.put((study_id, patient_id), private_key)
+    return private_key
+
+################################################################################
+########################### Private Key Cache ##################################
+################################################################################
+
+# Approximate memory used by a parsed RSA private key besides its numbers (python objects, the
+# key's methods and the cache entry itself).
+RSA_KEY_OVERHEAD = 2048
+
+
+def estimate_rsa_key_size(rsa_key):
+    """ n and d are the full key length, p, q and u about half of it. """
+    key_bytes = (rsa_key.size() + 1) / 8
+    return RSA_KEY_OVERHEAD + 4 * key_bytes
+
+
+class PrivateKeyCache(object):
+    """
+    A least recently used cache of parsed RSA private keys keyed by (study object id, patient id),
+    bounded by the estimated memory of the keys it holds.  A max_bytes of 0 disables the cache.
+    Entries expire after ttl seconds; create_client_key_pair invalidates the participant's entry
+    in the process that created the key pair, other processes see the new key once their entry
+    expires.  A key that does not exist yet fails to retrieve and is not cached.
+    """
+
+    def __init__(self, max_bytes, ttl):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.lock = Lock()
+        self.keys = OrderedDict()  # (study object id, patient id) -> (rsa key, estimated size, expiry)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, cache_key):
+        with self.lock:
+            entry = self.keys.pop(cache_key, None)
+            if entry is None or entry[2] <= time():
+                if entry is not None:
+                    self.size -= entry[1]
+                self.misses += 1
+                return None
+            # reinserting moves the entry to the most recently used end.
+            self.keys[cache_key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def put(self, cache_key, rsa_key):
+        if not self.max_bytes:
+            return
+        key_size = estimate_rsa_key_size(rsa_key)
+        with self.lock:
+            old_entry = self.keys.pop(cache_key, None)
+            if old_entry is not None:
+                self.size -= old_entry[1]
+            self.keys[cache_key] = (rsa_key, key_size, time() + self.ttl)
+            self.size += key_size
+            while self.size > self.max_bytes and self.keys:
+                _, (_, evicted_size, _) = self.keys.popitem(last=False)
+                self.size -= evicted_size
+
+    def invalidate(self, cache_key):
+        with self.lock:
+            entry = self.keys.pop(cache_key, None)
+            if entry is not None:
+                self.size -= entry[1]
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "size": len(self.keys), "bytes": self.size}
+
+
+private_key_cache = PrivateKeyCache(PRIVATE_KEY_CACHE_MB * 1024 * 1024, PRIVATE_KEY_CACHE_TTL_SECONDS)
@@ -1,15 +1,17 @@
-import json, traceback
+import json, struct, traceback, zlib
+from itertools import chain
 from os import urandom
 
 from Crypto.Cipher import AES
 from Crypto.PublicKey import RSA
+from Crypto.Util import Counter
 from flask import request
 
-from config.constants import ASYMMETRIC_KEY_LENGTH
+from config.constants import ASYMMETRIC_KEY_LENGTH, SERVER_ENCRYPTION_MODE
 from config.settings import IS_STAGING
 from database.profiling_models import DecryptionKeyError, EncryptionErrorMetadata, LineEncryptionError
-from database.study_models import Study
 from libs.bw_logging import log_error
+from libs.study_key_cache import study_key_cache
 from security import decode_base64, encode_base64, PaddingException
 
 
@@ -18,6 +20,7 @@ class HandledError(Exception): pass
 class InvalidIV(Exception): pass
 class InvalidData(Exception): pass
 class DefinitelyInvalidFile(Exception):pass
+class UnknownServerEncryptionVersion(Exception): pass
 
 # The private keys are stored server-side (S3), and the public key is sent to the android device.
 
@@ -51,23 +54,200 @@ def import_RSA_key( key ):
 ################################# AES ##########################################
 ################################################################################
 
-def encrypt_for_server(input_string, study_object_id):
+# Data encrypted for the server starts with a 16 byte header.  Originally the header was just the
+# initialization vector of AES-CFB with 8 bit segments, which runs the block cipher once for every
+# byte.  Versioned headers start with SERVER_ENCRYPTION_MAGIC and a version byte; a random
+# initialization vector starts with the magic bytes once in 2^56 files.
+SERVER_ENCRYPTION_HEADER_LENGTH = 16
+SERVER_ENCRYPTION_MAGIC = "\xbbBEIWE\x00"
+# Version 0 is the unversioned format.  Version 1 is AES-CTR: the header ends with an 8 byte nonce,
+# followed by a 64 bit block counter that starts at 0.
+SERVER_ENCRYPTION_CFB8 = 0
+SERVER_ENCRYPTION_CTR = 1
+SERVER_ENCRYPTION_VERSIONS = {"cfb": SERVER_ENCRYPTION_CFB8, "ctr": SERVER_ENCRYPTION_CTR}
+# the version new data is encrypted in.
+SERVER_ENCRYPTION_VERSION = SERVER_ENCRYPTION_VERSIONS[SERVER_ENCRYPTION_MODE]
+# Version 2 is version 1 of compressed data: the data is the size and the crc32 of the original data
+# (DEFLATE_PREFIX_FORMAT), followed by the data compressed with raw deflate, as in a zip file.
+SERVER_ENCRYPTION_CTR_DEFLATE = 2
+DEFLATE_PREFIX_FORMAT = ">QL"
+DEFLATE_PREFIX_LENGTH = struct.calcsize(DEFLATE_PREFIX_FORMAT)
+
+
+def server_encryption_version(header):
+    """ Returns the version of the format of data encrypted for the server, from its header. """
+    if header[:len(SERVER_ENCRYPTION_MAGIC)] == SERVER_ENCRYPTION_MAGIC:
+        return ord(header[len(SERVER_ENCRYPTION_MAGIC)])
+    return SERVER_ENCRYPTION_CFB8
+
+
+def _ctr_cipher(encryption_key, nonce):
+    return AES.new( encryption_key, AES.MODE_CTR, counter=Counter.new(64, prefix=nonce, initial_value=0) )
+
+
+def new_server_cipher(encryption_key, version=None):
+    """ Returns the header and the cipher to encrypt data for the server with, in the given version
+    of the format or SERVER_ENCRYPTION_VERSION. """
+    if version is None:
+        version = SERVER_ENCRYPTION_VERSION
+    if version in (SERVER_ENCRYPTION_CTR, SERVER_ENCRYPTION_CTR_DEFLATE):
+        nonce = urandom(8)
+        return SERVER_ENCRYPTION_MAGIC + chr(version) + nonce, _ctr_cipher(encryption_key, nonce)
+    iv = urandom(16)
+    return iv, AES.new( encryption_key, AES.MODE_CFB, segment_size=8, IV=iv )
+
+
+def server_decryption_cipher(encryption_key, header):
+    """ Returns the cipher to decrypt the data that follows the header of data encrypted for the
+    server. """
+    version = server_encryption_version(header)
+    if version == SERVER_ENCRYPTION_CFB8:
+        return AES.new( encryption_key, AES.MODE_CFB, segment_size=8, IV=header )
+    if version in (SERVER_ENCRYPTION_CTR, SERVER_ENCRYPTION_CTR_DEFLATE):
+        return _ctr_cipher(encryption_key, header[len(SERVER_ENCRYPTION_MAGIC) + 1:])
+    raise UnknownServerEncryptionVersion(version)
+
+
+def encrypt_for_server(input_string, study_object_id, compression_level=0):
     """
-    Encrypts config using the ENCRYPTION_KEY, prepends the generated initialization vector.
+    Encrypts config using the ENCRYPTION_KEY, prepends the header with the generated nonce or
+    initialization vector.
     Use this function on an entire file (as a string).
+    With a compression_level (1 to 9) the data is compressed first, in SERVER_ENCRYPTION_CTR_DEFLATE.
     """
 
-    encryption_key = Study.objects.get(object_id=study_object_id).encryption_key
-    iv = urandom(16)
-    return iv + AES.new( encryption_key, AES.MODE_CFB, segment_size=8, IV=iv ).encrypt( input_string )
+    encryption_key = study_key_cache.get_encryption_key(study_object_id)
+    if compression_level:
+        header, cipher = new_server_cipher(encryption_key, SERVER_ENCRYPTION_CTR_DEFLATE)
+        compressor = zlib.compressobj(compression_level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        prefix = struct.pack(DEFLATE_PREFIX_FORMAT, len(input_string), zlib.crc32(input_string) & 0xffffffff)
+        return header + cipher.encrypt( prefix + compressor.compress(input_string) + compressor.flush() )
+    header, cipher = new_server_cipher(encryption_key)
+    return header + cipher.encrypt( input_string )
 
 
 def decrypt_server(data, study_object_id):
-    """ Decrypts config encrypted by the encrypt_for_server function."""
-    encryption_key = Study.objects.filter(object_id=study_object_id).values_list('encryption_key', flat=True).get()
-    iv = data[:16]
-    data = data[16:]
-    return AES.new( encryption_key, AES.MODE_CFB, segment_size=8, IV=iv ).decrypt( data )
+    """ Decrypts config encrypted by the encrypt_for_server function, in any format version."""
+    encryption_key = study_key_cache.get_encryption_key(study_object_id)
+    header = data[:SERVER_ENCRYPTION_HEADER_LENGTH]
+    data = data[SERVER_ENCRYPTION_HEADER_LENGTH:]
+    data = server_decryption_cipher(encryption_key, header).decrypt( data )
+    if server_encryption_version(header) == SERVER_ENCRYPTION_CTR_DEFLATE:
+        return zlib.decompress(data[DEFLATE_PREFIX_LENGTH:], -zlib.MAX_WBITS)
+    return data
+
+
+# CTR and CFB with 8 bit segments are stream modes: any length of data can be encrypted or decrypted
+# and the cipher carries on from where it left off, so streams are processed this many bytes at a time.
+SERVER_STREAM_BLOCK_SIZE = 1024 * 1024
+
+
+class ServerEncryptionStream(object):
+    """ A read-only file-like object of the encrypt_for_server output for the contents of another
+    file-like object, which are read and encrypted as this is read, in the given version of the
+    format (not a compressed one) or SERVER_ENCRYPTION_VERSION. """
+
+    def __init__(self, plaintext_file, study_object_id, version=None):
+        encryption_key = study_key_cache.get_encryption_key(study_object_id)
+        header, self.cipher = new_server_cipher(encryption_key, version)
+        self.plaintext_file = plaintext_file
+        # the header is the first 16 bytes of the output.
+        self.pending = header
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            head, self.pending = self.pending, ""
+            plaintext = self.plaintext_file.read()
+        else:
+            head, self.pending = self.pending[:size], self.pending[size:]
+            if len(head) == size:
+                return head
+            plaintext = self.plaintext_file.read(size - len(head))
+        self.bytes_read += len(plaintext)
+        return head + self.cipher.encrypt(plaintext) if plaintext else head
+
+
+class ServerDecryptionStream(object):
+    """ A read-only file-like object of the decrypted contents of a file-like object holding
+    encrypt_for_server output, e.g. the body of an S3 object, which is read as this is read.
+    Iterating over it yields blocks of up to SERVER_STREAM_BLOCK_SIZE bytes.  size is the size of
+    the decrypted data, if it is compressed or the size of the encrypted data is given.
+
+    Compressed data is decompressed as it is read, unless inflate is False: then deflated is set
+    and the raw deflate data is read, of which crc is the crc32 of the decompressed data. """
+
+    def __init__(self, encrypted_file, study_object_id, encrypted_size=None, inflate=True):
+        encryption_key = study_key_cache.get_encryption_key(study_object_id)
+        self.encrypted_file = encrypted_file
+        header = self._read_exactly(SERVER_ENCRYPTION_HEADER_LENGTH)
+        self.cipher = server_decryption_cipher(encryption_key, header)
+        self.deflated = False
+        self.decompressor = None
+        self.crc = None
+        self.size = None
+        if server_encryption_version(header) == SERVER_ENCRYPTION_CTR_DEFLATE:
+            prefix = self.cipher.decrypt(self._read_exactly(DEFLATE_PREFIX_LENGTH))
+            self.size, self.crc = struct.unpack(DEFLATE_PREFIX_FORMAT, prefix)
+            if inflate:
+                self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+                self.decompressed = ""
+            else:
+                self.deflated = True
+        elif encrypted_size is not None:
+            # the other formats are a 16 byte header followed by data of the same size as the plaintext.
+            self.size = max(encrypted_size - SERVER_ENCRYPTION_HEADER_LENGTH, 0)
+
+    def _read_exactly(self, size):
+        data = ""
+        while len(data) < size:
+            block = self.encrypted_file.read(size - len(data))
+            if not block:
+                break
+            data += block
+        return data
+
+    def read(self, size=-1):
+        if self.decompressor is not None:
+            return self._read_decompressed(size)
+        if size is None or size < 0:
+            data = self.encrypted_file.read()
+        else:
+            data = self.encrypted_file.read(size)
+        return self.cipher.decrypt(data) if data else ""
+
+    def _read_decompressed(self, size):
+        """ Returns size bytes of decompressed data, fewer only at the end of the data. """
+        if size is None or size < 0:
+            data = self.cipher.decrypt(self.encrypted_file.read())
+            data = self.decompressed + self.decompressor.decompress(data) + self.decompressor.flush()
+            self.decompressed = ""
+            return data
+        # the decompressor is asked for no more than is needed, so that a highly compressed block
+        # is never decompressed all at once.
+        while len(self.decompressed) < size:
+            if self.decompressor.unconsumed_tail:
+                data = self.decompressor.unconsumed_tail
+            else:
+                data = self.encrypted_file.read(SERVER_STREAM_BLOCK_SIZE)
+                if not data:
+                    self.decompressed += self.decompressor.flush()
+                    break
+                data = self.cipher.decrypt(data)
+            self.decompressed += self.decompressor.decompress(data, size - len(self.decompressed))
+        data, self.decompressed = self.decompressed[:size], self.decompressed[size:]
+        return data
+
+    def __iter__(self):
+        while True:
+            block = self.read(SERVER_STREAM_BLOCK_SIZE)
+            if not block:
+                return
+            yield block
+
+    def close(self):
+        if hasattr(self.encrypted_file, "close"):
+            self.encrypted_file.close()
 
 
 ########################### User/Device Decryption #############################
@@ -101,7 +281,9 @@ def decrypt_device_file(patient_id, original_data, private_key, user):
     bad_lines = []
     error_types = []
     error_count = 0
-    return_data = ""
+    decrypted_lines = []
+    # (iv, data) of lines waiting to be decrypted together, see decrypt_device_lines.
+    pending_lines = []
     file_data = [line for line in original_data.split('\n') if line != ""]
     
     if not file_data:
@@ -124,6 +306,8 @@ def decrypt_device_file(patient_id, original_data, private_key, user):
         create_decryption_key_error(traceback.format_exc())
         raise DecryptionKeyInvalidError("invalid decryption key. %s" % e.message)
     
+    # Lines can only be decrypted together if AES would accept the key for all of them.
+    batchable_key = isinstance(decrypted_key, str) and len(decrypted_key) in AES.key_size
     
     for i, line in enumerate(file_data):
         #we need to skip the first line (the decryption key), but need real index values in i
@@ -139,7 +323,16 @@ def decrypt_device_file(patient_id, original_data, private_key, user):
             continue
             
         try:
-            return_data += decrypt_device_line(patient_id, decrypted_key, line) + "\n"
+            iv, data = decode_device_line(line)
+            if batchable_key and len(iv) == AES.block_size and len(data) % AES.block_size == 0:
+                pending_lines.append((iv, data))
+            else:
+                # AES will reject this line, decrypt_device_line raises the error to classify.
+                # Should it not, the pending lines go first to keep the lines in order.
+                decrypted_line = decrypt_device_line(patient_id, decrypted_key, line)
+                decrypted_lines.extend(decrypt_device_lines(decrypted_key, pending_lines))
+                pending_lines = []
+                decrypted_lines.append(decrypted_line)
         except Exception as e:
             error_count += 1
             
@@ -230,8 +423,11 @@ def decrypt_device_file(patient_id, original_data, private_key, user):
             error_types=json.dumps(error_types),
             participant=user,
         )
-        
-    return return_data
+    
+    decrypted_lines.extend(decrypt_device_lines(decrypted_key, pending_lines))
+    if not decrypted_lines:
+        return ""
+    return "\n".join(decrypted_lines) + "\n"
 
 
 def decrypt_device_line(patient_id, key, data):
@@ -239,13 +435,7 @@ def decrypt_device_line(patient_id, key, data):
         value 1 is the symmetric key, encrypted with the patient's public key.
         value 2 is the initialization vector for the AES CBC cipher.
         value 3 is the config, encrypted using AES CBC, with the provided key and iv. """
-    iv, data = data.split(":")
-    iv = decode_base64( iv.encode( "utf-8" ) ) #handle non-ascii encoding garbage...
-    data = decode_base64( data.encode( "utf-8" ) )
-    if not data:
-        raise InvalidData()
-    if not iv:
-        raise InvalidIV
+    iv, data = decode_device_line(data)
     try:
         decrypted = AES.new(key, mode=AES.MODE_CBC, IV=iv).decrypt( data )
     except Exception:
@@ -263,6 +453,37 @@ def decrypt_device_line(patient_id, key, data):
         raise
     return remove_PKCS5_padding( decrypted )
 
+
+def decode_device_line(data):
+    """ Splits a line from a device into its iv and encrypted config, base64 decoded. """
+    iv, data = data.split(":")
+    iv = decode_base64( iv.encode( "utf-8" ) ) #handle non-ascii encoding garbage...
+    data = decode_base64( data.encode( "utf-8" ) )
+    if not data:
+        raise InvalidData()
+    if not iv:
+        raise InvalidIV
+    return iv, data
+
+
+def decrypt_device_lines(key, lines):
+    """ Decrypts a list of (iv, data) pairs from decode_device_line with a single cipher, returns
+        the list of decrypted lines.
+        CBC decryption of a block only depends on the block before it, so when the iv and data of
+        every line are decrypted back to back each line decrypts correctly; only the output for
+        the iv blocks themselves is garbage, and it is dropped. """
+    if not lines:
+        return []
+    decrypted = AES.new(key, mode=AES.MODE_CBC, IV="\x00" * AES.block_size)\
+        .decrypt("".join(chain.from_iterable(lines)))
+    ret = []
+    position = 0
+    for iv, data in lines:
+        start = position + len(iv)
+        position = start + len(data)
+        ret.append(remove_PKCS5_padding(decrypted[start:position]))
+    return ret
+
 ################################################################################
 
 def remove_PKCS5_padding(data):
@@ -1,9 +1,22 @@
 import gc
-from collections import defaultdict, deque
+import marshal
+from collections import defaultdict, deque, OrderedDict
+from heapq import merge as heapq_merge
+from itertools import chain, islice, izip
 from multiprocessing.pool import ThreadPool
+from Queue import Queue
+from threading import Thread
 from traceback import format_exc
 
+import numpy
 from boto.exception import S3ResponseError
+try:
+    # Celery's fork of multiprocessing, its pools can be started inside Celery's worker processes.
+    from billiard import current_process, Pool
+    DAEMONIC_PROCESS_POOLS = True
+except ImportError:
+    from multiprocessing import current_process, Pool
+    DAEMONIC_PROCESS_POOLS = False
 from cronutils.error_handler import ErrorHandler
 from datetime import datetime
 
@@ -14,15 +27,19 @@ from config.constants import (ANDROID_LOG_FILE, UPLOAD_FILE_TYPE_MAPPING, API_TI
     IDENTIFIERS,
     WIFI, CALL_LOG, CHUNK_TIMESLICE_QUANTUM, FILE_PROCESS_PAGE_SIZE, SURVEY_TIMINGS, ACCELEROMETER,
     SURVEY_DATA_FILES, CONCURRENT_NETWORK_OPS, KEY_FOLDER, RAW_DATA_FOLDER, CHUNKS_FOLDER, CHUNKABLE_FILES,
-    DATA_PROCESSING_NO_ERROR_STRING, IOS_LOG_FILE)
+    DATA_PROCESSING_NO_ERROR_STRING, IOS_LOG_FILE, CONCURRENT_PROCESSING_OPS,
+    HIGH_FREQUENCY_DATA_STREAMS, BINIFIED_DATA_MEMORY_BUDGET_MB, CHUNK_COMPRESSION_LEVEL)
 from database.data_access_models import ChunkRegistry, FileProcessLock, FileToProcess
 from database.user_models import Participant
 from database.study_models import Survey
-from .s3 import s3_retrieve, s3_upload, s3_move, s3_exists, construct_s3_key_paths, construct_s3_chunk_path, construct_s3_chunk_path_from_raw_data_path, unix_time_to_string
-from libs.client_key_management import create_client_key_pair
+from .s3 import s3_retrieve, s3_upload, s3_move, s3_move_many, s3_exists, construct_s3_key_paths, construct_s3_chunk_path, construct_s3_chunk_path_from_raw_data_path, unix_time_to_string
+from libs.binified_data_accumulator import BinifiedDataAccumulator
+from libs.chunk_cache import cacheable_hash, chunk_cache, retrieve_chunk
+from libs.client_key_management import create_client_key_pair, restore_client_public_key
 
 import json
 import os
+import re
 
 import logging
 logging.basicConfig()
@@ -34,6 +51,11 @@ from .parse_filename import resolve_survey_id_from_file_name
 class EverythingWentFine(Exception): pass
 class ProcessingOverlapError(Exception): pass
 
+# the process pool that csvs are binified on, see get_binification_pool.
+_binification_pool = None
+# the "UTC time" column is added to the rows of a bin this many at a time.
+HUMAN_READABLE_TIMESTAMP_BLOCK_ROWS = 10000
+
 
 """########################## Hourly Update Tasks ###########################"""
 
@@ -129,8 +151,8 @@ def chunk_file_lambda_handler(event, context):
 
     error_handler = ErrorHandler()
 
-    # Declare a defaultdict containing a tuple of two double ended queues (deque, pronounced "deck")
-    all_binified_data = defaultdict(lambda: (deque(), deque()))
+    # Collects the rows of every bin and the FTPs they came from, spilling to disk past the budget.
+    all_binified_data = BinifiedDataAccumulator(BINIFIED_DATA_MEMORY_BUDGET_MB * 1024 * 1024)
     ftps_to_remove = set()
     # The ThreadPool enables downloading multiple files simultaneously from the network, and continuing
     # to download files as other files are being processed, making the code as a whole run faster.
@@ -182,6 +204,17 @@ def chunk_file_lambda_handler(event, context):
                     'statusCode': 200,
                     'body': json.dumps('Key pair already exists for {0}: {1}'.format(study_object_id, participant_id))
                 }
+
+            elif s3_exists(key_paths['private'], study_object_id, raw_path=True):
+                # a new key pair would replace the private key, uploads encrypted for it could no
+                # longer be decrypted.
+                logger.error('Restoring the public key of {0}: {1}'.format(study_object_id, participant_id))
+                restore_client_public_key(participant_id, study_object_id)
+
+                return {
+                    'statusCode': 200,
+                    'body': json.dumps('Restored public key for {0}: {1}'.format(study_object_id, participant_id))
+                }
                
             else:
                 logger.info('Generating key pair for {0}: {1}'.format(study_object_id, participant_id))
@@ -239,16 +272,8 @@ def chunk_file_lambda_handler(event, context):
                 # print "1a"
                 newly_binified_data, survey_id_hash = process_csv_data(data)
                 # print data, "\n1b"
-                if data['data_type'] in SURVEY_DATA_FILES:
-                    # print survey_id_hash
-                    survey_id_dict[survey_id_hash] = resolve_survey_id_from_file_name(data['ftp']["s3_file_path"])
-
-                if newly_binified_data:
-                    # print "1c"
-                    append_binified_csvs(all_binified_data, newly_binified_data, data['ftp'])
-                else:  # delete empty files from FilesToProcess
-                    # print "1d"
-                    ftps_to_remove.add(data['ftp']['id'])
+                add_binified_file(all_binified_data, ftps_to_remove, survey_id_dict, data['ftp'],
+                                  data['data_type'], newly_binified_data, survey_id_hash)
 
             else:  # if not data['chunkable']
                 # print "2a"
@@ -277,7 +302,10 @@ def chunk_file_lambda_handler(event, context):
 
     #print(newly_binified_data)
     # print 3
-    more_ftps_to_remove, number_bad_files = upload_binified_data(all_binified_data, error_handler, survey_id_dict)
+    try:
+        more_ftps_to_remove, number_bad_files = upload_binified_data(all_binified_data, error_handler, survey_id_dict)
+    finally:
+        all_binified_data.close()
     # print "X"
     ftps_to_remove.update(more_ftps_to_remove)
     # Actually delete the processed FTPs from the database
@@ -315,12 +343,18 @@ def do_process_user_file_chunks(count, error_handler, skip_count, participant):
     skip_count. The first skip_count files are expected to be files that have previously errored
     in file processing.
     """
-    # Declare a defaultdict containing a tuple of two double ended queues (deque, pronounced "deck")
-    all_binified_data = defaultdict(lambda: (deque(), deque()))
+    # Collects the rows of every bin and the FTPs they came from, spilling to disk past the budget.
+    all_binified_data = BinifiedDataAccumulator(BINIFIED_DATA_MEMORY_BUDGET_MB * 1024 * 1024)
     ftps_to_remove = set()
+    # Parsing and binifying csvs is pure CPU work; when enabled it is handed to a process pool so
+    # that it is not limited to the single core the GIL allows.  The process pool is created
+    # on the first call, before the ThreadPool, so that the fork happens before any threads exist.
+    process_pool = get_binification_pool()
     # The ThreadPool enables downloading multiple files simultaneously from the network, and continuing
     # to download files as other files are being processed, making the code as a whole run faster.
     pool = ThreadPool(CONCURRENT_NETWORK_OPS)
+    pending_binifications = []
+    unchunkable_files = []
     survey_id_dict = {}
 
     # A Django query with a slice (e.g. .all()[x:y]) makes a LIMIT query, so it
@@ -347,18 +381,19 @@ def do_process_user_file_chunks(count, error_handler, skip_count, participant):
 
             if data['chunkable']:
                 # print "1a"
+                if process_pool:
+                    # the result is collected after all files have been handed out.
+                    pending_binifications.append((
+                        data['ftp'],
+                        data['data_type'],
+                        process_pool.apply_async(marshalled_binify_csv_payload,
+                                                 (csv_payload_from_data(data),)),
+                    ))
+                    continue
                 newly_binified_data, survey_id_hash = process_csv_data(data)
                 # print data, "\n1b"
-                if data['data_type'] in SURVEY_DATA_FILES:
-                    # print survey_id_hash
-                    survey_id_dict[survey_id_hash] = resolve_survey_id_from_file_name(data['ftp']["s3_file_path"])
-
-                if newly_binified_data:
-                    # print "1c"
-                    append_binified_csvs(all_binified_data, newly_binified_data, data['ftp'])
-                else:  # delete empty files from FilesToProcess
-                    # print "1d"
-                    ftps_to_remove.add(data['ftp']['id'])
+                add_binified_file(all_binified_data, ftps_to_remove, survey_id_dict, data['ftp'],
+                                  data['data_type'], newly_binified_data, survey_id_hash)
                 continue
 
             else:  # if not data['chunkable']
@@ -366,25 +401,32 @@ def do_process_user_file_chunks(count, error_handler, skip_count, participant):
                 timestamp = clean_java_timecode(data['ftp']["s3_file_path"].rsplit("/", 1)[-1][:-4])
                 # print "2a"
                 chunked_file_path = construct_s3_chunk_path_from_raw_data_path(data['ftp']['s3_file_path'])
-
-                s3_move(data['ftp']['s3_file_path'], chunked_file_path, data['ftp']['study'].object_id)
-
-                # Since we aren't binning the data by hour, just create a ChunkRegistry that
-                # points to the already existing S3 file.
-                ChunkRegistry.register_unchunked_data(
-                    data['data_type'],
-                    timestamp,
-                    chunked_file_path,
-                    data['ftp']['study'].pk,
-                    data['ftp']['participant'].pk,
-                )
-                # print "2b"
-                ftps_to_remove.add(data['ftp']['id'])
+                # the files are moved together once every file has been handed out.
+                unchunkable_files.append((data['ftp'], data['data_type'], timestamp, chunked_file_path))
 
     pool.close()
     pool.terminate()
+
+    move_unchunkable_files(unchunkable_files, ftps_to_remove, error_handler)
+    del unchunkable_files
+
+    for ftp, data_type, binification in pending_binifications:
+        with error_handler:
+            # errors that occurred on the worker process are re-raised by get()
+            newly_binified_data, survey_id_hash = unmarshal_binified_payload(binification.get())
+            add_binified_file(all_binified_data, ftps_to_remove, survey_id_dict, ftp, data_type,
+                              newly_binified_data, survey_id_hash)
+    del pending_binifications
     # print 3
-    more_ftps_to_remove, number_bad_files = upload_binified_data(all_binified_data, error_handler, survey_id_dict)
+    # The existing chunks every bin will be merged into are looked up in one query, and their
+    # contents start downloading before the first bin is merged.
+    try:
+        chunk_plan = plan_chunk_updates(all_binified_data)
+        more_ftps_to_remove, number_bad_files = upload_binified_data(
+            all_binified_data, error_handler, survey_id_dict, chunk_plan
+        )
+    finally:
+        all_binified_data.close()
     # print "X"
     ftps_to_remove.update(more_ftps_to_remove)
     # Actually delete the processed FTPs from the database
@@ -396,15 +438,173 @@ def do_process_user_file_chunks(count, error_handler, skip_count, participant):
     return number_bad_files
 
 
-def upload_binified_data(binified_data, error_handler, survey_id_dict):
-    """ Takes in binified csv data and handles uploading/downloading+updating
-        older data to/from S3 for each chunk.
+def move_unchunkable_files(unchunkable_files, ftps_to_remove, error_handler):
+    """ Moves the raw files of data types that are not chunked to the chunked data folder, with
+        pipelined copies and batched deletes, and registers them.  unchunkable_files is a list of
+        (ftp, data type, timestamp, chunked file path).  A file whose move failed is left in
+        FilesToProcess and its error goes to the error handler.
+        The move deletes the raw file, so a file that is processed again (a duplicate FTP, or a
+        retry after its registration failed) cannot be moved a second time; its move only counts
+        as failed if the file is neither registered nor already at its chunked file path. """
+    if not unchunkable_files:
+        return
+    move_errors = dict(
+        (source, e) for source, _, e in s3_move_many(
+            (ftp['s3_file_path'], chunked_file_path) for ftp, _, _, chunked_file_path in unchunkable_files
+        )
+    )
+    already_registered = ChunkRegistry.get_by_chunk_paths(
+        chunked_file_path for ftp, _, _, chunked_file_path in unchunkable_files
+        if ftp['s3_file_path'] in move_errors
+    )
+    for ftp, data_type, timestamp, chunked_file_path in unchunkable_files:
+        with error_handler:
+            if (ftp['s3_file_path'] in move_errors and chunked_file_path not in already_registered
+                    and not s3_exists(chunked_file_path, ftp['study'].object_id, raw_path=True)):
+                raise move_errors[ftp['s3_file_path']]
+            # Since we aren't binning the data by hour, just create a ChunkRegistry that
+            # points to the already existing S3 file.
+            ChunkRegistry.register_unchunked_data(
+                data_type, timestamp, chunked_file_path, ftp['study'].pk, ftp['participant'].pk,
+            )
+            ftps_to_remove.add(ftp['id'])
+
+
+def plan_chunk_updates(binified_data):
+    """ Works out the chunk path of every bin and loads the ChunkRegistries that already exist for
+        them in a single query.  Retrieval of those chunks from S3 is started right away.
+        Returns a dict of chunk path to ChunkRegistry and the ChunkPrefetcher to read the old chunk
+        contents from; the chunks are prefetched in the iteration order of binified_data, through
+        the chunk cache. """
+    bin_chunk_paths = [
+        (construct_s3_chunk_path(study_id, user_id, data_type, time_bin), study_id)
+        for study_id, user_id, data_type, time_bin, _ in binified_data
+    ]
+    existing_chunks = ChunkRegistry.get_by_chunk_paths(
+        set(chunk_path for chunk_path, _ in bin_chunk_paths)
+    )
+    prefetcher = ChunkPrefetcher([
+        (chunk_path, study_id, cacheable_hash(existing_chunks[chunk_path].data_type,
+                                              existing_chunks[chunk_path].chunk_hash))
+        for chunk_path, study_id in bin_chunk_paths if chunk_path in existing_chunks
+    ])
+    return existing_chunks, prefetcher
+
+
+class ChunkPrefetcher(object):
+    """ Retrieves existing chunks from S3 on a thread pool, at most CONCURRENT_NETWORK_OPS ahead of
+        the order in which they were planned, so that only a bounded number of chunk bodies are
+        held in memory. """
+
+    def __init__(self, planned_chunks):
+        # planned_chunks is a list of (chunk_path, study_id, chunk_hash), repeated chunk paths are
+        # fetched once.  chunk_hash is passed to retrieve_chunk.
+        self.planned_chunks = []
+        self.plan_index = {}
+        for planned_chunk in planned_chunks:
+            chunk_path = planned_chunk[0]
+            if chunk_path not in self.plan_index:
+                self.plan_index[chunk_path] = len(self.planned_chunks)
+                self.planned_chunks.append(planned_chunk)
+        self.in_flight = OrderedDict()
+        self.next_to_submit = 0
+        self.next_to_consume = 0
+        self.pool = ThreadPool(CONCURRENT_NETWORK_OPS)
+        self._fill()
+
+    def _fill(self):
+        while len(self.in_flight) < CONCURRENT_NETWORK_OPS and self.next_to_submit < len(self.planned_chunks):
+            chunk_path, study_id, chunk_hash = self.planned_chunks[self.next_to_submit]
+            self.in_flight[chunk_path] = self.pool.apply_async(
+                retrieve_chunk, (chunk_path, study_id, chunk_hash)
+            )
+            self.next_to_submit += 1
+
+    def retrieve(self, chunk_path, study_id, chunk_hash):
+        """ Returns the contents of the chunk as retrieve_chunk would, raising the same errors. """
+        index = self.plan_index.get(chunk_path)
+        if index is None or index < self.next_to_consume:
+            # not planned, or already handed out once
+            return retrieve_chunk(chunk_path, study_id, chunk_hash)
+
+        # Chunks planned before this one were skipped by the caller (e.g. their bin failed),
+        # their contents are dropped.
+        while self.in_flight and self.plan_index[next(iter(self.in_flight))] < index:
+            self.in_flight.popitem(last=False)
+        self.next_to_consume = index + 1
+        self.next_to_submit = max(self.next_to_submit, index + 1)
+        result = self.in_flight.pop(chunk_path, None)
+        self._fill()
+        if result is None:
+            return retrieve_chunk(chunk_path, study_id, chunk_hash)
+        return result.get()
+
+    def close(self):
+        self.in_flight.clear()
+        self.pool.close()
+        self.pool.terminate()
+
+
+def upload_binified_data(binified_data, error_handler, survey_id_dict, chunk_plan=None):
+    """ Takes in binified csv data (a BinifiedDataAccumulator, whose rows come sorted by
+        timestamp) and handles uploading/downloading+updating older data to/from S3 for each chunk.
+        chunk_plan is the return value of plan_chunk_updates, it is made here if not provided.
         Returns a set of concatenations that have succeeded and can be removed.
         Returns the number of failed FTPS so that we don't retry them.
         Raises any errors on the passed in ErrorHandler."""
+    if chunk_plan is None:
+        chunk_plan = plan_chunk_updates(binified_data)
+    existing_chunks, prefetcher = chunk_plan
     failed_ftps = set([])
     ftps_to_retire = set([])
-    upload_these = []
+    # Finished chunks are handed to the upload threads as soon as they are built, the bounded
+    # queue keeps at most a couple of chunk bodies per thread in memory while later bins merge.
+    upload_queue = Queue(maxsize=CONCURRENT_NETWORK_OPS * 2)
+    upload_errors = []
+    uploaded_chunks = []
+    upload_threads = start_upload_threads(upload_queue, upload_errors, uploaded_chunks)
+    try:
+        foreign_keys = resolve_chunk_foreign_keys(binified_data, survey_id_dict)
+        binify_and_queue_uploads(binified_data, error_handler, survey_id_dict, foreign_keys,
+                                 existing_chunks, prefetcher, upload_queue, failed_ftps,
+                                 ftps_to_retire)
+    finally:
+        prefetcher.close()
+        stop_upload_threads(upload_queue, upload_threads)
+
+    # The registries of everything that made it to S3 are written even if some uploads failed.
+    register_uploaded_chunks(uploaded_chunks)
+    for err_ret in upload_errors:
+        print(err_ret['traceback'])
+        raise err_ret['exception']
+
+    # The things in ftps to retire that are not in failed ftps.
+    # len(failed_ftps) will become the number of files to skip in the next iteration.
+    return ftps_to_retire.difference(failed_ftps), len(failed_ftps)
+
+
+def resolve_chunk_foreign_keys(binified_data, survey_id_dict):
+    """ Looks up the primary keys of every Participant and Survey the bins refer to, with one
+        query each.  Returns a dict of patient id to (participant pk, study pk) and a dict of
+        survey object id to survey pk. """
+    patient_ids = set(data_bin[1] for data_bin in binified_data)
+    participant_pks = {
+        patient_id: (participant_pk, study_pk) for patient_id, participant_pk, study_pk in
+        Participant.objects.filter(patient_id__in=patient_ids).values_list('patient_id', 'pk', 'study_id')
+    }
+    survey_object_ids = set(survey_id for survey_id in survey_id_dict.itervalues() if survey_id)
+    survey_pks = dict(
+        Survey.objects.filter(object_id__in=survey_object_ids).values_list('object_id', 'pk')
+    ) if survey_object_ids else {}
+    return participant_pks, survey_pks
+
+
+def binify_and_queue_uploads(binified_data, error_handler, survey_id_dict, foreign_keys,
+                             existing_chunks, prefetcher, upload_queue, failed_ftps,
+                             ftps_to_retire):
+    """ Builds the new contents of each chunk and puts it on the upload queue, blocking while the
+        queue is full.  Updates failed_ftps and ftps_to_retire in place. """
+    new_chunk_paths = set()
     for data_bin, (data_rows_deque, ftp_deque) in binified_data.iteritems():
         # print 3
         with error_handler:
@@ -412,27 +612,22 @@ def upload_binified_data(binified_data, error_handler, survey_id_dict):
                 # print 4
                 study_id, user_id, data_type, time_bin, original_header = data_bin
                 # print 5
-                # data_rows_deque may be a generator; here it is evaluated
-                rows = list(data_rows_deque)
-                updated_header = convert_unix_to_human_readable_timestamps(original_header, rows)
+                # The rows come sorted by timestamp and are converted a block at a time as the
+                # chunk is built, the bin is never held in memory as a list.
+                rows = with_human_readable_timestamps(data_rows_deque)
+                updated_header = add_utc_time_column(original_header)
                 # print 6
                 chunk_path = construct_s3_chunk_path(study_id, user_id, data_type, time_bin)
                 # print 7
-                old_chunks = ChunkRegistry.objects.filter(chunk_path=chunk_path)
-
-                if old_chunks.exists():
-
-                    # if there are more than one chunk with the same path, 
-                    # winnow it down to one 
-                    while ChunkRegistry.objects.filter(chunk_path=chunk_path).count() > 1:
-                        ChunkRegistry.objects.filter(chunk_path=chunk_path)[0].delete()
-
-                    chunk = ChunkRegistry.objects.get(chunk_path=chunk_path)
+                chunk = existing_chunks.get(chunk_path)
 
+                if chunk is not None:
                     try:
                         # print 8
                         # print chunk_path
-                        s3_file_data = s3_retrieve(chunk_path, study_id, raw_path=True)
+                        s3_file_data = prefetcher.retrieve(
+                            chunk_path, study_id, cacheable_hash(data_type, chunk.chunk_hash)
+                        )
                         # print "finished s3 retrieve"
                     except S3ResponseError as e:
                         # print 9
@@ -447,7 +642,9 @@ def upload_binified_data(binified_data, error_handler, survey_id_dict):
                             raise ChunkFailedToExist("chunk %s does not actually point to a file, deleting DB entry, should run correctly on next index." % chunk_path)
                         raise  # Raise original error if not 404 s3 error
                     # print 10
-                    old_header, old_rows = csv_to_list(s3_file_data)
+                    # The old chunk is already sorted and deduplicated, so it is streamed row by
+                    # row instead of being expanded into a list of lists.
+                    old_header, old_rows = csv_to_row_generator(s3_file_data)
                     if old_header != updated_header:
                         # To handle the case where a file was on an hour boundary and placed in
                         # two separate chunks we need to raise an error in order to retire this file. If this
@@ -457,29 +654,25 @@ def upload_binified_data(binified_data, error_handler, survey_id_dict):
                         raise HeaderMismatchException('%s\nvs.\n%s\nin\n%s' %
                                                       (old_header, updated_header, chunk_path) )
                     # print 11
-                    old_rows = [_ for _ in old_rows]
-                    # print "11a"
-                    # This is O(1), which is why we use a deque (double-ended queue)
-                    old_rows.extend(rows)
-                    # print "11b"
-                    del rows
+                    # both sequences are sorted, the merge walks them in step.
+                    merged_rows = merge_sorted_csv_rows(old_rows, rows)
                     # print 12
-                    ensure_sorted_by_timestamp(old_rows)
+                    new_contents = serialize_csv_lines(
+                        updated_header, merged_rows, utf_safe=data_type == SURVEY_TIMINGS
+                    )
+                    del rows, merged_rows, old_rows, s3_file_data
                     # print 13
-
-                    if data_type == SURVEY_TIMINGS:
-                        # print "13a"
-                        new_contents = construct_utf_safe_csv_string(updated_header, old_rows)
-                    else:
-                        # print "13b"
-                        new_contents = construct_csv_string(updated_header, old_rows)
-                    del old_rows
                     # print 14
-                    upload_these.append((chunk, chunk_path, new_contents.encode("zip"), study_id))
+                    upload_queue.put((chunk, chunk_path, new_contents, study_id))
                     del new_contents
                 else:
                     # print "7a"
-                    ensure_sorted_by_timestamp(rows)
+                    if chunk_path in new_chunk_paths:
+                        # Two bins with different headers land on the same new chunk, as with an
+                        # existing chunk only the first one can be kept.
+                        raise HeaderMismatchException('%s\nalready created with a different header in this run'
+                                                      % chunk_path)
+                    new_chunk_paths.add(chunk_path)
                     # print "7b"
                     if data_type == SURVEY_TIMINGS:
                         # print "7ba"
@@ -498,15 +691,21 @@ def upload_binified_data(binified_data, error_handler, survey_id_dict):
                         # print "7db"
                         survey_id = None
                     # print "7e"
+                    participant_pks, survey_pks = foreign_keys
+                    participant_pk, study_pk = participant_pks[user_id]
                     chunk_params = {
                         "study_id": study_id,
                         "user_id": user_id,
                         "data_type": data_type,
                         "chunk_path": chunk_path,
                         "time_bin": time_bin,
-                        "survey_id": survey_id
+                        "survey_id": survey_id,
+                        "study_pk": study_pk,
+                        "participant_pk": participant_pk,
+                        "survey_pk": survey_pks[survey_id] if survey_id else None,
                     }
-                    upload_these.append((chunk_params, chunk_path, new_contents.encode("zip"), study_id))
+                    upload_queue.put((chunk_params, chunk_path, new_contents, study_id))
+                    del new_contents
             except Exception as e:
                 # Here we catch any exceptions that may have arisen, as well as the ones that we raised
                 # ourselves (e.g. HeaderMismatchException). Whichever FTP we were processing when the
@@ -521,19 +720,6 @@ def upload_binified_data(binified_data, error_handler, survey_id_dict):
                 # retireable (i.e. completed) FTPs.
                 ftps_to_retire.update(ftp_deque)
 
-    pool = ThreadPool(CONCURRENT_NETWORK_OPS)
-    errors = pool.map(batch_upload, upload_these, chunksize=1)
-    for err_ret in errors:
-        if err_ret['exception']:
-            print(err_ret['traceback'])
-            raise err_ret['exception']
-
-    pool.close()
-    pool.terminate()
-    # The things in ftps to retire that are not in failed ftps.
-    # len(failed_ftps) will become the number of files to skip in the next iteration.
-    return ftps_to_retire.difference(failed_ftps), len(failed_ftps)
-
 
 """################################# Key ####################################"""
 
@@ -563,20 +749,82 @@ def ensure_sorted_by_timestamp(l):
         faster, this is how to declare a sort by the first column (timestamp). """
     l.sort(key = lambda x: int(x[0]))
 
-def convert_unix_to_human_readable_timestamps(header, rows):
-    """ Adds a new column to the end which is the unix time represented in
-    a human readable time format.  Returns an appropriately modified header. """
+def with_human_readable_timestamps(rows):
+    """ Yields rows with a second column which is the unix time represented in a human readable
+    time format, to go with the header from add_utc_time_column.  The parsed rows are left as they
+    are, each output row is built once by with_time_column.  Rows are converted
+    HUMAN_READABLE_TIMESTAMP_BLOCK_ROWS at a time so that rows can be a generator. """
+    rows = iter(rows)
+    while True:
+        block = list(islice(rows, HUMAN_READABLE_TIMESTAMP_BLOCK_ROWS))
+        if not block:
+            return
+        for row, time_string in izip(block, human_readable_time_strings(block)):
+            yield with_time_column(row, time_string)
+
+
+def with_time_column(row, time_string):
+    """ A row that joins into the csv line of row with time_string as its second column.  The
+    cells after the timestamp are joined into a single cell, a row is never shifted over to
+    make room. """
+    if len(row) == 1:
+        return [row[0], time_string]
+    return [row[0], time_string, ",".join(islice(row, 1, None))]
+
+
+def human_readable_time_strings(rows):
+    """ The "UTC time" column of a list of rows, one "YYYY-MM-DDThh:mm:ss.mmm" string per row. """
+    unix_milliseconds = parse_millisecond_timestamp_column(rows)
+    if unix_milliseconds is not None:
+        return unix_milliseconds_to_time_strings(unix_milliseconds)
+    # Within an hour long bin the seconds repeat up to 3600 times, so each second is only
+    # formatted once.
+    second_strings = {}
+    time_strings = []
     for row in rows:
-        unix_millisecond = int(row[0])
-        time_string = unix_time_to_string(unix_millisecond / 1000 )
+        unix_second, millisecond = divmod(int(row[0]), 1000)
+        try:
+            second_string = second_strings[unix_second]
+        except KeyError:
+            second_string = second_strings[unix_second] = unix_time_to_string(unix_second)
         # this line 0-pads millisecond values that have leading 0s.
-        time_string += ".%03d" % ( unix_millisecond % 1000 )
-        row.insert(1, time_string)
+        time_strings.append("%s.%03d" % (second_string, millisecond))
+    return time_strings
+
+
+def add_utc_time_column(header):
+    """ Returns the header with the "UTC time" column of with_human_readable_timestamps. """
     header = header.split(",")
     header.insert(1, "UTC time")
     return ",".join(header)
 
 
+def unix_milliseconds_to_time_strings(unix_milliseconds):
+    """ Vectorized form of the "UTC time" column, takes a sequence of integer unix millisecond
+    values and returns a list of "YYYY-MM-DDThh:mm:ss.mmm" (API_TIME_FORMAT plus milliseconds)
+    strings. """
+    as_datetimes = numpy.asarray(unix_milliseconds, dtype=numpy.int64).astype("datetime64[ms]")
+    return numpy.datetime_as_string(as_datetimes, unit="ms").astype(numpy.string_).tolist()
+
+
+def parse_millisecond_timestamp_column(rows):
+    """ Parses the timestamp column of a list of rows into an int64 numpy array in a single pass.
+    Returns None unless every timestamp is a plain 13 digit unix millisecond value (the total
+    length check and the range check together guarantee that), in which case callers fall back
+    to their row by row logic. """
+    if not rows:
+        return None
+    timestamp_column = ",".join([row[0] for row in rows])
+    if len(timestamp_column) != 14 * len(rows) - 1:
+        return None
+    timestamps = numpy.fromstring(timestamp_column, dtype=numpy.int64, sep=",")
+    if (len(timestamps) != len(rows)
+            or timestamps.min() < 10 ** 12
+            or timestamps.max() >= 10 ** 13):
+        return None
+    return timestamps
+
+
 def binify_from_timecode(unix_ish_time_code_string):
     """ Takes a unix-ish time code (accepts unix millisecond), and returns an
         integer value of the bin it should go in. """
@@ -601,12 +849,52 @@ def binify_csv_rows(rows_list, study_id, user_id, data_type, header):
     return ret
 
 
+def binify_csv_rows_columnar(rows_list, study_id, user_id, data_type, header):
+    """ Produces the same output as binify_csv_rows, intended for the high frequency sensor
+        streams.  The timestamp column is parsed into an int64 array in one pass, bin ids come
+        from integer division, and a single stable sort groups the rows so that they can be cut
+        at the bin boundaries.  Because the sort is stable the rows in each bin are already in
+        exactly the order ensure_sorted_by_timestamp would put them in.
+        Timestamps that are not plain 13 digit millisecond values fall back to binify_csv_rows,
+        whose first-ten-characters binning could differ from a division. """
+    rows = [row for row in rows_list if row and row[0]]
+    if not rows:
+        return defaultdict(deque)
+
+    timestamps = parse_millisecond_timestamp_column(rows)
+    if timestamps is None:
+        return binify_csv_rows(rows, study_id, user_id, data_type, header)
+
+    order = numpy.argsort(timestamps, kind="mergesort")
+    sorted_bins = timestamps[order] // 1000 // CHUNK_TIMESLICE_QUANTUM
+    del timestamps
+    boundaries = (numpy.flatnonzero(sorted_bins[1:] != sorted_bins[:-1]) + 1).tolist()
+    rows = [rows[i] for i in order.tolist()]
+    del order
+
+    ret = defaultdict(deque)
+    for start, end in zip([0] + boundaries, boundaries + [len(rows)]):
+        ret[(study_id, user_id, data_type, int(sorted_bins[start]), header)] = deque(rows[start:end])
+    return ret
+
+
 def append_binified_csvs(old_binified_rows, new_binified_rows, file_to_process):
-    """ Appends binified rows to an existing binified row data structure.
-        Should be in-place. """
+    """ Appends binified rows to a BinifiedDataAccumulator, in-place. """
     for data_bin, rows in new_binified_rows.iteritems():
-        old_binified_rows[data_bin][0].extend(rows)  # Add data rows
-        old_binified_rows[data_bin][1].append(file_to_process['id'])  # Add ftp
+        old_binified_rows.add(data_bin, rows, file_to_process['id'])
+
+
+def add_binified_file(all_binified_data, ftps_to_remove, survey_id_dict, file_to_process,
+                      data_type, newly_binified_data, survey_id_hash):
+    """ Folds the output of process_csv_data for a single file into the batch's binified data,
+        empty files are marked for removal from FilesToProcess. """
+    if data_type in SURVEY_DATA_FILES:
+        survey_id_dict[survey_id_hash] = resolve_survey_id_from_file_name(file_to_process["s3_file_path"])
+
+    if newly_binified_data:
+        append_binified_csvs(all_binified_data, newly_binified_data, file_to_process)
+    else:  # delete empty files from FilesToProcess
+        ftps_to_remove.add(file_to_process['id'])
 
 
 def process_csv_data(data):
@@ -614,52 +902,113 @@ def process_csv_data(data):
     """ Constructs a binified dict of a given list of a csv rows,
         catches csv files with known problems and runs the correct logic.
         Returns None If the csv has no data in it. """
-    participant = data['ftp']['participant']
-    
-    if participant.os_type == Participant.ANDROID_API:
+    return binify_csv_payload(csv_payload_from_data(data))
+
+
+def get_binification_pool():
+    """ Returns the process pool that csvs are binified on, or None when csvs are binified in this
+        process.  The pool is created on first use and lives as long as the process does, so its
+        workers are forked once rather than once per batch of files.
+        Celery's prefork worker processes are daemonic, only billiard can start a pool in them;
+        without billiard installed a daemonic process binifies csvs itself. """
+    global _binification_pool
+    if CONCURRENT_PROCESSING_OPS <= 1:
+        return None
+    if current_process().daemon and not DAEMONIC_PROCESS_POOLS:
+        return None
+    if _binification_pool is None:
+        _binification_pool = Pool(CONCURRENT_PROCESSING_OPS)
+    return _binification_pool
+
+
+def marshalled_binify_csv_payload(payload):
+    """ binify_csv_payload for a worker process.  The bins are returned marshalled, as a single
+        string, which crosses the process boundary much faster and smaller than the rows would
+        pickled one object at a time. """
+    binified_data, survey_id_hash = binify_csv_payload(payload)
+    if binified_data is None:
+        return marshal.dumps((None, None))
+    return marshal.dumps(
+        ([(data_bin, list(rows)) for data_bin, rows in binified_data.iteritems()], survey_id_hash)
+    )
+
+
+def unmarshal_binified_payload(marshalled_payload):
+    """ The inverse of marshalled_binify_csv_payload, the bins come back as a dict of row lists. """
+    binified_data, survey_id_hash = marshal.loads(marshalled_payload)
+    if binified_data is None:
+        return None, None
+    return dict(binified_data), survey_id_hash
+
+
+def csv_payload_from_data(data):
+    """ Reduces the output of batch_retrieve_for_processing to the plain values that the csv logic
+        needs, no database objects, so that it can be pickled and sent to a worker process.
+        The file contents are moved out of data rather than copied. """
+    return {
+        "file_contents": data.pop('file_contents'),
+        "data_type": data['data_type'],
+        "s3_file_path": data['ftp']['s3_file_path'],
+        "os_type": data['ftp']['participant'].os_type,
+        "study_object_id": data['ftp']['study'].object_id,
+        "patient_id": data['ftp']['participant'].patient_id,
+    }
+
+
+def binify_csv_payload(payload):
+    """ The body of process_csv_data, runs on either the main process or a worker process.
+        Must not touch the database. """
+    data_type = payload["data_type"]
+    s3_file_path = payload["s3_file_path"]
+
+    if payload["os_type"] == Participant.ANDROID_API:
         # Do fixes for Android
-        if data["data_type"] == ANDROID_LOG_FILE:
-            data['file_contents'] = fix_app_log_file(data['file_contents'], data['ftp']['s3_file_path'])
+        if data_type == ANDROID_LOG_FILE:
+            payload['file_contents'] = fix_app_log_file(payload['file_contents'], s3_file_path)
 
-        header, csv_rows_list = csv_to_list(data['file_contents'])
-        if data["data_type"] != ACCELEROMETER:
+        header, csv_rows_list = csv_to_list(payload['file_contents'])
+        if data_type != ACCELEROMETER:
             # If the data is not accelerometer data, convert the generator to a list.
             # For accelerometer data, the data is massive and so we don't want it all
             # in memory at once.
             csv_rows_list = [r for r in csv_rows_list]
 
-        if data["data_type"] == CALL_LOG:
+        if data_type == CALL_LOG:
             header = fix_call_log_csv(header, csv_rows_list)
-        if data["data_type"] == WIFI:
-            header = fix_wifi_csv(header, csv_rows_list, data['ftp']['s3_file_path'])
+        if data_type == WIFI:
+            header = fix_wifi_csv(header, csv_rows_list, s3_file_path)
     else:
         # Do fixes for iOS
-        header, csv_rows_list = csv_to_list(data['file_contents'])
-        if data["data_type"] != ACCELEROMETER:
+        header, csv_rows_list = csv_to_list(payload['file_contents'])
+        if data_type != ACCELEROMETER:
             csv_rows_list = [r for r in csv_rows_list]
 
     # Memory saving measure: this data is now stored in its entirety in csv_rows_list
-    del data['file_contents']
+    del payload['file_contents']
 
     # Do these fixes for data whether from Android or iOS
-    if data["data_type"] == IDENTIFIERS:
-        header = fix_identifier_csv(header, csv_rows_list, data['ftp']['s3_file_path'])
-    if data["data_type"] == SURVEY_TIMINGS:
-        header = fix_survey_timings(header, csv_rows_list, data['ftp']['s3_file_path'])
+    if data_type == IDENTIFIERS:
+        header = fix_identifier_csv(header, csv_rows_list, s3_file_path)
+    if data_type == SURVEY_TIMINGS:
+        header = fix_survey_timings(header, csv_rows_list, s3_file_path)
 
     header = ",".join([column_name.strip() for column_name in header.split(",")])
+    if data_type in HIGH_FREQUENCY_DATA_STREAMS:
+        binify = binify_csv_rows_columnar
+    else:
+        binify = binify_csv_rows
     if csv_rows_list:
         return (
             # return item 1: the data as a defaultdict
-            binify_csv_rows(
+            binify(
                 csv_rows_list,
-                data['ftp']['study'].object_id,
-                data['ftp']['participant'].patient_id,
-                data["data_type"],
+                payload["study_object_id"],
+                payload["patient_id"],
+                data_type,
                 header
             ),
             # return item 2: the tuple that we use as a key for the defaultdict
-            (data['ftp']['study'].object_id, data['ftp']['participant'].patient_id, data["data_type"], header)
+            (payload["study_object_id"], payload["patient_id"], data_type, header)
         )
     else:
         return None, None
@@ -741,6 +1090,10 @@ def insert_timestamp_single_row_csv(header, rows_list, time_stamp):
     return ",".join(header_list)
 
 
+# the line breaks that str.splitlines splits on.
+LINE_BREAK_REGEX = re.compile(r"\r\n|\r|\n")
+
+
 def csv_to_list(csv_string):
     """ Grab a list elements from of every line in the csv, strips off trailing whitespace. dumps
     them into a new list (of lists), and returns the header line along with the list of rows. """
@@ -757,56 +1110,100 @@ def csv_to_list(csv_string):
     return header, split_yielder(lines)
 
 
-def construct_csv_string(header, rows_list):
-    """ Takes a header list and a csv and returns a single string of a csv.
-        Now handles unicode errors.  :D :D :D """
-    # The old, compact list comprehension was, it turned out, both nonperformant and of an
-    # incomprehensible memory order. This is ~1.5x faster, and has a much clearer memory order.
-    def deduplicate(seq):
-        #highly optimized order preserving deduplication function.
-        # print "dedupling"
-        seen = set()
-        seen_add = seen.add
-        return [x for x in seq if not (x in seen or seen_add(x))]
-    # print "rows 1"
-    rows = []
-    for row_items in rows_list:
-        rows.append(",".join(row_items))
-    del rows_list, row_items
-    #we need to ensure no duplicates
-    # print "rows 2"
-    rows = deduplicate(rows)
-    # print "rows 3"
-    ret = header
+def csv_to_row_generator(csv_string):
+    """ As csv_to_list, but the string is never split into a list of lines; each row is cut out
+    of the string only when the generator reaches it.  Lines are split exactly as splitlines
+    splits them, so the rows are always the same as those of csv_to_list.  The one difference
+    is a csv with no newline at all (only a header), whose header is returned whole. """
+    header_end = csv_string.find("\n")
+    if header_end == -1:
+        header_end = len(csv_string)
+    first_line_break = LINE_BREAK_REGEX.search(csv_string)
+    if first_line_break is None:
+        return csv_string[:header_end], iter([])
+
+    def row_yielder():
+        start = first_line_break.end()
+        for line_break in LINE_BREAK_REGEX.finditer(csv_string, start):
+            yield csv_string[start:line_break.start()].split(",")
+            start = line_break.end()
+        # like splitlines, a final line break does not end in an empty line
+        if start < len(csv_string):
+            yield csv_string[start:].split(",")
+
+    return csv_string[:header_end], row_yielder()
+
+
+def merge_sorted_csv_rows(*sorted_rows_iterables):
+    """ A k-way streaming merge of row iterables that are each already sorted by timestamp.
+    Yields each row as a joined csv line, in timestamp order, with duplicates dropped.
+    Identical rows always share a timestamp, so only the lines of the current timestamp need to
+    be remembered in order to deduplicate.  On equal timestamps rows from earlier iterables come
+    first, which matches the stable sort that was used before. """
+    decorated_iterables = [_decorate_rows_with_timestamp(rows, source_index)
+                           for source_index, rows in enumerate(sorted_rows_iterables)]
+    current_timestamp = None
+    seen = set()
+    for timestamp, _, row in heapq_merge(*decorated_iterables):
+        if timestamp != current_timestamp:
+            current_timestamp = timestamp
+            seen.clear()
+        line = ",".join(row)
+        if line in seen:
+            continue
+        seen.add(line)
+        yield line
+
+
+def _decorate_rows_with_timestamp(rows, source_index):
+    # The source index breaks timestamp ties before the rows themselves would be compared.
     for row in rows:
-        ret += "\n" + row
-    return ret
+        yield int(row[0]), source_index, row
+
+
+def deduplicate_sorted_csv_rows(rows_list):
+    """ Joins rows that are sorted by timestamp into csv lines, dropping duplicate rows.
+        Identical rows always share a timestamp, so only the lines of the current timestamp need
+        to be remembered; the dedupe set stays tiny instead of holding every line of the chunk.
+        Timestamps are compared as integers, as ensure_sorted_by_timestamp sorts them, and rows
+        that are not sorted raise a ValueError rather than letting duplicates through. """
+    current_timestamp = None
+    seen = set()
+    for row in rows_list:
+        timestamp = int(row[0])
+        if timestamp != current_timestamp:
+            if timestamp < current_timestamp:
+                raise ValueError("rows are not sorted by timestamp: %s follows %s" % (timestamp, current_timestamp))
+            current_timestamp = timestamp
+            seen.clear()
+        line = ",".join(row)
+        if line not in seen:
+            seen.add(line)
+            yield line
+
+
+def serialize_csv_lines(header, lines, utf_safe=False):
+    """ Takes a header and deduplicated csv lines (from deduplicate_sorted_csv_rows or
+        merge_sorted_csv_rows) and returns a single string of a csv, built in one join.
+        utf_safe validates the finished file as utf-8 once instead of decoding every cell, we use
+        it on data files that have user-entered strings.  Invalid data raises UnicodeDecodeError,
+        as it always has. """
+    contents = "\n".join(chain([header], lines))
+    if utf_safe:
+        contents.decode('utf')
+    return contents
+
+
+def construct_csv_string(header, rows_list):
+    """ Takes a header list and a csv and returns a single string of a csv.  Duplicate rows are
+        dropped.  The rows must already be sorted with ensure_sorted_by_timestamp, unsorted rows
+        raise a ValueError. """
+    return serialize_csv_lines(header, deduplicate_sorted_csv_rows(rows_list))
+
 
 def construct_utf_safe_csv_string(header, rows_list):
-    """ Takes a header list and a csv and returns a single string of a csv.
-        Poor memory performances, but handles unicode errors.  :D :D :D """
-    # This is almost identical to the above construct_csv_string, but it handles unicode
-    # characters correctly, and is therefore an order of magnitude slower.  We only use this on
-    # data files that have user-entered strings, and it is an order
-    def deduplicate(seq):
-        #highly optimized order preserving deduplication function.
-        # print "dedupling"
-        seen = set()
-        seen_add = seen.add
-        return [x for x in seq if not (x in seen or seen_add(x))]
-    # print "rows 1"
-    rows = []
-    for row_items in rows_list:
-        rows.append(u",".join([r.decode("utf") for r in row_items]))
-    del rows_list, row_items
-    #we need to ensure no duplicates
-    # print "rows 2"
-    rows = deduplicate(rows)
-    # print "rows 3"
-    ret = header.decode('utf')
-    for row in rows:
-        ret += u"\n" + row
-    return ret.encode('utf')
+    """ As construct_csv_string, but ensures the result is valid utf-8. """
+    return serialize_csv_lines(header, deduplicate_sorted_csv_rows(rows_list), utf_safe=True)
 
 def clean_java_timecode(java_time_code_string):
     """ converts millisecond time (string) to an integer normal unix time. """
@@ -855,41 +1252,85 @@ def batch_retrieve_for_processing(ftp_as_object):
 def batch_upload(upload):
     """ Used for mapping an s3_upload function. """
     ret = {'exception': None,
-           'traceback': None}
+           'traceback': None,
+           'chunk': None}
     try:
         if len(upload) != 4:
             # upload should have length 4; this is for debugging if it doesn't
             print(upload)
         chunk, chunk_path, new_contents, study_object_id = upload
         del upload
-        new_contents = new_contents.decode("zip")
-        s3_upload(chunk_path, new_contents, study_object_id, raw_path=True)
+        s3_upload(chunk_path, new_contents, study_object_id, raw_path=True,
+                  compression_level=CHUNK_COMPRESSION_LEVEL)
         print("data uploaded!", chunk_path)
+        # The database writes are made in bulk by register_uploaded_chunks, here the ChunkRegistry
+        # is only brought up to date with the uploaded contents.
         if isinstance(chunk, ChunkRegistry):
             # If the contents are being appended to an existing ChunkRegistry object
-            chunk.low_memory_update_chunk_hash(new_contents)
+            chunk.set_chunk_hash(new_contents)
+            ret['chunk'] = chunk
         else:
-            # If a new ChunkRegistry object is being created
-            # Convert the ID's used in the S3 file names into primary keys for making ChunkRegistry FKs
-            participant_pk, study_pk = Participant.objects.filter(patient_id=chunk['user_id']).values_list('pk', 'study_id').get()
-            if chunk['survey_id']:
-                survey_pk = Survey.objects.filter(object_id=chunk['survey_id']).values_list('pk', flat=True).get()
-            else:
-                survey_pk = None
-            ChunkRegistry.register_chunked_data(
+            # If a new ChunkRegistry object is being created, the primary keys for the FKs were
+            # looked up by resolve_chunk_foreign_keys.
+            ret['chunk'] = ChunkRegistry.build_chunked_data(
                 chunk['data_type'],
                 chunk['time_bin'],
                 chunk['chunk_path'],
                 new_contents,  # unlikely to be huge
-                study_pk,
-                participant_pk,
-                survey_pk,
+                chunk['study_pk'],
+                chunk['participant_pk'],
+                chunk['survey_pk'],
             )
+        # The next update of this chunk will most likely read it back, it is cached under its new hash.
+        if chunk_cache is not None:
+            chunk_cache.put(chunk_path, ret['chunk'].chunk_hash, new_contents)
     except Exception as e:
         ret['traceback'] = format_exc(e)
         ret['exception'] = e
     return ret
 
+
+def register_uploaded_chunks(uploaded_chunks):
+    """ Inserts the new ChunkRegistries and updates the hashes of the existing ones, a few
+        queries in total rather than several per chunk. """
+    ChunkRegistry.bulk_register_chunked_data([chunk for chunk in uploaded_chunks if chunk.pk is None])
+    ChunkRegistry.bulk_update_chunk_hashes([chunk for chunk in uploaded_chunks if chunk.pk is not None])
+
+
+def start_upload_threads(upload_queue, upload_errors, uploaded_chunks):
+    """ Starts CONCURRENT_NETWORK_OPS threads that run batch_upload on everything put on the
+        upload queue. """
+    upload_threads = []
+    for _ in xrange(CONCURRENT_NETWORK_OPS):
+        thread = Thread(target=upload_worker, args=(upload_queue, upload_errors, uploaded_chunks))
+        thread.daemon = True
+        thread.start()
+        upload_threads.append(thread)
+    return upload_threads
+
+
+def stop_upload_threads(upload_queue, upload_threads):
+    """ Waits for the upload queue to drain and for the upload threads to exit. """
+    for _ in upload_threads:
+        upload_queue.put(None)
+    for thread in upload_threads:
+        thread.join()
+
+
+def upload_worker(upload_queue, upload_errors, uploaded_chunks):
+    """ Drains the upload queue until it receives None.  Errors are collected in upload_errors,
+        the ChunkRegistries of successful uploads in uploaded_chunks. """
+    while True:
+        upload = upload_queue.get()
+        if upload is None:
+            return
+        err_ret = batch_upload(upload)
+        del upload
+        if err_ret['exception']:
+            upload_errors.append(err_ret)
+        else:
+            uploaded_chunks.append(err_ret['chunk'])
+
 """ Exceptions """
 class HeaderMismatchException(Exception): pass
 class ChunkFailedToExist(Exception): pass
@@ -6,7 +6,7 @@ from config.constants import (
     PROCESSABLE_FILE_EXTENSIONS, data_stream_to_s3_file_name_string,
 )
 from libs.file_processing import process_file_chunks
-from libs.s3 import s3_list_files, s3_delete, s3_upload
+from libs.s3 import s3_delete_many, s3_folder_stats, s3_iterate_objects, s3_list_files, s3_upload
 from database.data_access_models import ChunkRegistry, FileProcessLock, FileToProcess
 from database.study_models import Study
 from database.user_models import Participant
@@ -29,9 +29,9 @@ def reindex_all_files_to_process():
     pool = ThreadPool(CONCURRENT_NETWORK_OPS * 2)
     
     # Delete all preexisting chunked data files
-    CHUNKED_DATA = s3_list_files(CHUNKS_FOLDER)
+    CHUNKED_DATA = [key_path for key_path, _ in s3_iterate_objects(CHUNKS_FOLDER, shard_depth=2)]
     print('{!s} deleting older chunked data: {:d}'.format(datetime.now(), len(CHUNKED_DATA)))
-    pool.map(s3_delete, CHUNKED_DATA)
+    report_delete_errors(s3_delete_many(CHUNKED_DATA))
     del CHUNKED_DATA
     
     # Get a list of all S3 files to replace in the database
@@ -75,8 +75,9 @@ def reindex_specific_data_type(data_type):
     print("purging old data...")
     relevant_chunks.delete()
 
+    report_delete_errors(s3_delete_many(relevant_indexed_files))
+
     pool = ThreadPool(20)
-    pool.map(s3_delete, relevant_indexed_files)
 
     print("pulling files to process...")
     files_lists = pool.map(s3_list_files, Study.objects.values_list('object_id', flat=True))
@@ -98,6 +99,12 @@ def reindex_specific_data_type(data_type):
     print("Done.")
 
 
+def report_delete_errors(delete_errors):
+    """ Prints the keys that s3_delete_many could not delete. """
+    for error in delete_errors:
+        print('{!s} could not delete {}'.format(datetime.now(), error))
+
+
 # def reindex_study(study_id):
 #     if isinstance(study_id, (str, unicode)):
 #         study_id = ObjectId(study_id)
@@ -133,13 +140,22 @@ def reindex_specific_data_type(data_type):
 
 def check_for_bad_chunks():
     """ This function runs through all chunkable data and checks for invalid file pointers
-    to s3. """
-    chunked_file_paths = set(s3_list_files("CHUNKED_DATA"))
+    to s3.  It goes one study at a time, so only the file list of a single study is in memory.
+    Returns the chunk paths of the bad chunks. """
     bad_chunks = []
-    for entry in ChunkRegistry.objects.all():
-        if entry.data_type in CHUNKABLE_FILES and entry.chunk_path not in chunked_file_paths:
-            bad_chunks.append(entry)
+    for study_pk, study_object_id in Study.objects.values_list('pk', 'object_id'):
+        # a shard per participant
+        chunked_file_paths = set(
+            key_path for key_path, _ in s3_iterate_objects(CHUNKS_FOLDER + "/" + study_object_id)
+        )
+        chunk_paths = ChunkRegistry.objects.filter(study_id=study_pk, data_type__in=CHUNKABLE_FILES)\
+            .values_list('chunk_path', flat=True)
+        for chunk_path in chunk_paths.iterator():
+            if chunk_path not in chunked_file_paths:
+                bad_chunks.append(chunk_path)
+        del chunked_file_paths
     print("bad chunks:", len(bad_chunks))
+    return bad_chunks
 
     # for chunk in bad_chunks:
     #     u = chunk.user_id
@@ -147,14 +163,17 @@ def check_for_bad_chunks():
 
 
 def count_study_chunks():
-    chunked_file_paths = s3_list_files("CHUNKED_DATA")
+    """ Returns the number of chunked files on S3 of every study, by study name.  The files are
+    counted while they are listed, a shard per participant. """
     # The file paths start with CHUNKED_DATA/[24-digit object ID]
-    study_prefixes = [f[:38] for f in chunked_file_paths]
-    study_prefix_to_id = {study_prefix: study_prefix.split("/")[-2] for study_prefix in study_prefixes}
-    study_prefix_to_name = {study_prefix: Study.objects.get(object_id=study_object_id).name for study_prefix, study_object_id in study_prefix_to_id.iteritems()}
-    print(study_prefix_to_name)
-    study_count = {study_prefix_to_name[study_prefix]: len([f for f in chunked_file_paths if f[:38] == study_prefix]) for study_prefix in study_prefixes}
-    return study_count
+    study_stats = s3_folder_stats(CHUNKS_FOLDER, prefix_depth=1, shard_depth=2)
+    study_names = dict(
+        Study.objects.filter(object_id__in=study_stats.keys()).values_list('object_id', 'name')
+    )
+    print(study_names)
+    # files of a study that is not in the database are counted under its object id.
+    return {study_names.get(study_object_id, study_object_id): stats["count"]
+            for study_object_id, stats in study_stats.iteritems()}
 
 
 def create_fake_mp4(number=10):
@@ -1,5 +1,6 @@
 from flask import json
-from libs.s3 import s3_list_files, s3_retrieve
+from libs.chunk_cache import retrieve_chunk
+from libs.s3 import s3_list_files
 
 ################################ CSV HANDLER ###################################
 def csv_to_dict(csv_string):
@@ -60,9 +61,9 @@ def get_survey_results( study_id, user_id, survey_id, number_points=7 ):
     # Get files from s3 for user answers, convert each csv_file to a list of dicts,
     # pull the questions and corresponding answers.
     files = grab_file_names( study_id, survey_id, user_id, number_points )
-    #note: we need to remove the prepended study id from file name strings,
-    # that string is always 24 characters + the slash.
-    surveys = [ csv_to_dict( s3_retrieve( file_name[25:], study_id ) ) for file_name in files ]
+    #note: the file names are full key paths (prepended with the study id).  Uploaded survey
+    # answers never change, so they are cached by path alone.
+    surveys = [ csv_to_dict( retrieve_chunk( file_name, study_id, "" ) ) for file_name in files ]
     all_questions = compile_question_data(surveys)
     all_answers = pull_answers(surveys, all_questions)
     #all answers may be identical to all questions at this point.
@@ -1,17 +1,131 @@
 import boto3
 import os
-
-from config.constants import DEFAULT_S3_RETRIES, KEY_FOLDER, RAW_DATA_FOLDER, CHUNKS_FOLDER, API_TIME_FORMAT, CHUNK_TIMESLICE_QUANTUM
+from collections import deque
+from io import BytesIO
+from multiprocessing.pool import ThreadPool
+from Queue import Queue
+from random import random
+from threading import Lock
+from time import sleep, time
+
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+
+from config.constants import (DEFAULT_S3_RETRIES, KEY_FOLDER, RAW_DATA_FOLDER, CHUNKS_FOLDER,
+    API_TIME_FORMAT, CHUNK_TIMESLICE_QUANTUM, CONCURRENT_NETWORK_OPS, S3_MAX_POOL_CONNECTIONS,
+    S3_MULTIPART_THRESHOLD_MB)
 from config.settings import (S3_BUCKET, BEIWE_SERVER_AWS_ACCESS_KEY_ID,
     BEIWE_SERVER_AWS_SECRET_ACCESS_KEY, S3_REGION_NAME)
 from libs import encryption
-from botocore.exceptions import ClientError
+from botocore.exceptions import (ClientError, ConnectionClosedError, ConnectTimeoutError,
+    EndpointConnectionError, IncompleteReadError, ReadTimeoutError)
 from datetime import datetime
 
-conn = boto3.client('s3',
-                    aws_access_key_id=BEIWE_SERVER_AWS_ACCESS_KEY_ID,
-                    aws_secret_access_key=BEIWE_SERVER_AWS_SECRET_ACCESS_KEY,
-                    region_name=S3_REGION_NAME)
+# The chunker and data downloads run up to 3 thread pools of CONCURRENT_NETWORK_OPS threads at once
+# (downloads, prefetches and uploads), the connection pool is sized so that they do not wait on it.
+MAX_POOL_CONNECTIONS = S3_MAX_POOL_CONNECTIONS or 4 * CONCURRENT_NETWORK_OPS
+# Objects larger than this are uploaded with multipart uploads and retrieved with parallel ranged
+# GETs of this size.
+TRANSFER_PART_SIZE = S3_MULTIPART_THRESHOLD_MB * 1024 * 1024
+TRANSFER_CONCURRENCY = 4
+# Exponential backoff between retries: a random time up to BACKOFF_BASE * 2^attempt, at most BACKOFF_CAP.
+BACKOFF_BASE = 0.2
+BACKOFF_CAP = 10.0
+# The most keys a single delete_objects request accepts.
+DELETE_OBJECTS_BATCH_SIZE = 1000
+# Client errors that are worth retrying, other 4xx errors (e.g. a missing key) fail immediately.
+RETRYABLE_ERROR_CODES = {"SlowDown", "Throttling", "ThrottlingException", "RequestTimeout",
+                         "RequestTimeTooSkewed", "InternalError", "ServiceUnavailable"}
+# Connection errors and timeouts that are worth retrying, e.g. a connection dropped while a body was
+# read.  Anything else (bad parameters, missing credentials, bugs) fails immediately.
+RETRYABLE_EXCEPTIONS = (EndpointConnectionError, ConnectTimeoutError, ReadTimeoutError,
+                        ConnectionClosedError, IncompleteReadError)
+
+
+def create_s3_client():
+    """ Tests can replace the module's client with one created inside of a moto mock, e.g.
+    libs.s3.conn = create_s3_client() """
+    return boto3.client('s3',
+                        aws_access_key_id=BEIWE_SERVER_AWS_ACCESS_KEY_ID,
+                        aws_secret_access_key=BEIWE_SERVER_AWS_SECRET_ACCESS_KEY,
+                        region_name=S3_REGION_NAME,
+                        config=Config(max_pool_connections=MAX_POOL_CONNECTIONS))
+
+conn = create_s3_client()
+
+transfer_config = TransferConfig(multipart_threshold=TRANSFER_PART_SIZE,
+                                 multipart_chunksize=TRANSFER_PART_SIZE,
+                                 max_concurrency=TRANSFER_CONCURRENCY)
+
+
+class S3Metrics(object):
+    """ Per-operation counts, errors, bytes and latencies of the S3 calls made by this process. """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.operations = {}
+
+    def record(self, operation, seconds, number_bytes=0, error=False):
+        with self.lock:
+            stats = self.operations.setdefault(
+                operation, {"count": 0, "errors": 0, "bytes": 0, "total_seconds": 0.0, "max_seconds": 0.0}
+            )
+            stats["count"] += 1
+            stats["errors"] += 1 if error else 0
+            stats["bytes"] += number_bytes
+            stats["total_seconds"] += seconds
+            stats["max_seconds"] = max(stats["max_seconds"], seconds)
+
+    def stats(self):
+        with self.lock:
+            ret = {}
+            for operation, stats in self.operations.iteritems():
+                ret[operation] = dict(stats, mean_seconds=stats["total_seconds"] / stats["count"])
+            return ret
+
+    def reset(self):
+        with self.lock:
+            self.operations = {}
+
+s3_metrics = S3Metrics()
+
+
+def _is_retryable(e):
+    if isinstance(e, RETRYABLE_EXCEPTIONS):
+        return True
+    if not isinstance(e, ClientError):
+        return False
+    error = e.response.get("Error", {})
+    status = e.response.get("ResponseMetadata", {}).get("HTTPStatusCode") or 0
+    return status >= 500 or error.get("Code") in RETRYABLE_ERROR_CODES
+
+
+def _s3_call(operation, function, number_retries=DEFAULT_S3_RETRIES, **kwargs):
+    """ Runs function(**kwargs), retrying retryable errors with exponential backoff and full jitter
+    and recording the latency of each attempt in s3_metrics under operation.  A function that
+    returns a string, or a tuple starting with one, has its length recorded as the bytes
+    transferred. """
+    attempt = 0
+    while True:
+        start = time()
+        try:
+            ret = function(**kwargs)
+        except Exception as e:
+            s3_metrics.record(operation, time() - start, error=True)
+            if attempt >= number_retries or not _is_retryable(e):
+                raise
+            print("s3 %s failed, retrying on %s" % (operation, kwargs.get("Key")))
+            sleep(random() * min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+            attempt += 1
+            continue
+        s3_metrics.record(operation, time() - start, _transferred_bytes(ret))
+        return ret
+
+
+def _transferred_bytes(ret):
+    if isinstance(ret, tuple) and ret:
+        ret = ret[0]
+    return len(ret) if isinstance(ret, str) else 0
 
 def unix_time_to_string(unix_time):
     return datetime.utcfromtimestamp(unix_time).strftime( API_TIME_FORMAT )
@@ -19,7 +133,7 @@ def unix_time_to_string(unix_time):
 def s3_delete(key_path, study_object_id, raw_path=False):
     if not raw_path:
         key_path = os.path.join(study_object_id, key_path)
-    conn.delete_object(Bucket=S3_BUCKET, Key=key_path)
+    _s3_call("delete", conn.delete_object, Bucket=S3_BUCKET, Key=key_path)
 
 def s3_exists(key_path, study_object_id, raw_path=False):
 
@@ -29,7 +143,7 @@ def s3_exists(key_path, study_object_id, raw_path=False):
         key_path = os.path.join(study_object_id, key_path)
 
     try:
-        conn.head_object(Bucket=S3_BUCKET, Key=key_path)
+        _s3_call("head", conn.head_object, Bucket=S3_BUCKET, Key=key_path)
     except ClientError:
         return_value = False
 
@@ -42,27 +156,99 @@ def s3_move(source_key_path, destination_key_path, study_object_id, raw_path=Fal
         destination_key_path = os.path.join(study_object_id, destination_key_path)
 
     try:
-        conn.copy_object(CopySource={'Bucket': S3_BUCKET, 'Key': source_key_path}, 
-                         Bucket=S3_BUCKET, Key=destination_key_path)
+        _s3_call("copy", conn.copy_object, CopySource={'Bucket': S3_BUCKET, 'Key': source_key_path},
+                 Bucket=S3_BUCKET, Key=destination_key_path)
     except:
         print('Could not copy key {0} {1}'.format(S3_BUCKET, source_key_path))
         raise
 
-    conn.delete_object(Bucket=S3_BUCKET, Key=source_key_path)
+    _s3_call("delete", conn.delete_object, Bucket=S3_BUCKET, Key=source_key_path)
+
+
+class S3BatchError(Exception):
+    """ An error that S3 reported for a single key of a delete_objects request. """
+    def __init__(self, key_path, code, message):
+        super(S3BatchError, self).__init__("%s: %s %s" % (key_path, code, message))
+        self.key_path = key_path
+        self.code = code
+
 
-def s3_upload(key_path, data_string, study_object_id, raw_path=False):
+def _map_concurrently(function, items):
+    """ Maps function over items on up to CONCURRENT_NETWORK_OPS threads, or on this thread when
+    there is only one item. """
+    if len(items) <= 1:
+        return map(function, items)
+    pool = ThreadPool(min(len(items), CONCURRENT_NETWORK_OPS))
+    try:
+        return pool.map(function, items, chunksize=1)
+    finally:
+        pool.close()
+        pool.terminate()
+
+
+def _delete_objects(key_paths):
+    response = _s3_call("delete_many", conn.delete_objects, Bucket=S3_BUCKET,
+                        Delete={'Objects': [{'Key': key_path} for key_path in key_paths], 'Quiet': True})
+    return [S3BatchError(error['Key'], error.get('Code'), error.get('Message'))
+            for error in response.get('Errors', [])]
+
+
+def s3_delete_many(key_paths):
+    """ Deletes a list of full key paths with delete_objects requests of up to
+    DELETE_OBJECTS_BATCH_SIZE keys, several requests at a time.  Returns a list of S3BatchErrors
+    for the keys S3 could not delete; a request that fails as a whole raises. """
+    key_paths = list(key_paths)
+    batches = [key_paths[i:i + DELETE_OBJECTS_BATCH_SIZE]
+               for i in xrange(0, len(key_paths), DELETE_OBJECTS_BATCH_SIZE)]
+    return [error for errors in _map_concurrently(_delete_objects, batches) for error in errors]
+
+
+def s3_move_many(key_path_pairs):
+    """ Moves a list of (source, destination) full key paths.  The copies are made several at a
+    time and then the sources of the successful copies are removed with s3_delete_many.
+    Returns a list of (source, destination, exception) for the moves that failed, a source is
+    only deleted once its copy exists. """
+    def copy(key_path_pair):
+        source_key_path, destination_key_path = key_path_pair
+        try:
+            _s3_call("copy", conn.copy_object, CopySource={'Bucket': S3_BUCKET, 'Key': source_key_path},
+                     Bucket=S3_BUCKET, Key=destination_key_path)
+        except Exception as e:
+            print('Could not copy key {0} {1}'.format(S3_BUCKET, source_key_path))
+            return e
+        return None
+
+    key_path_pairs = list(key_path_pairs)
+    copy_errors = _map_concurrently(copy, key_path_pairs)
+    failures = [(source, destination, e)
+                for (source, destination), e in zip(key_path_pairs, copy_errors) if e is not None]
+    copied = [(source, destination)
+              for (source, destination), e in zip(key_path_pairs, copy_errors) if e is None]
+
+    destinations = dict(copied)
+    try:
+        delete_errors = s3_delete_many(destinations.keys())
+    except Exception as e:
+        return failures + [(source, destination, e) for source, destination in copied]
+    for error in delete_errors:
+        failures.append((error.key_path, destinations[error.key_path], error))
+    return failures
 
+
+def s3_upload(key_path, data_string, study_object_id, raw_path=False, compression_level=0):
+    """ With a compression_level (1 to 9) the data is compressed before it is encrypted, it is
+    decompressed again by s3_retrieve. """
     if not raw_path:
         key_path = study_object_id + "/" + key_path
-    data = encryption.encrypt_for_server(data_string, study_object_id)
-    conn.put_object(Body=data, Bucket=S3_BUCKET, Key=key_path, ContentType='string')
+    data = encryption.encrypt_for_server(data_string, study_object_id, compression_level)
+    _do_upload(S3_BUCKET, key_path, data)
 
 def s3_upload_public(key_path, data_string, study_object_id, raw_path=False):
 
     if not raw_path:
         key_path = study_object_id + "/" + key_path
 
-    conn.put_object(Body=data_string, Bucket=S3_BUCKET, Key=key_path, ContentType='string', ACL='public-read')
+    _do_upload(S3_BUCKET, key_path, data_string, ACL='public-read')
     return 'https://{0}.s3.amazonaws.com/{1}'.format(S3_BUCKET, key_path)
 
 def s3_retrieve(key_path, study_object_id, raw_path=False, number_retries=DEFAULT_S3_RETRIES):
@@ -71,19 +257,125 @@ def s3_retrieve(key_path, study_object_id, raw_path=False, number_retries=DEFAUL
     appropriate study_id folder. """
     if not raw_path:
         key_path = study_object_id + "/" + key_path
-    encrypted_data = _do_retrieve(S3_BUCKET, key_path, number_retries=number_retries)['Body'].read()
+    encrypted_data = _do_retrieve(S3_BUCKET, key_path, number_retries=number_retries)
     return encryption.decrypt_server(encrypted_data, study_object_id)
 
 
-def _do_retrieve(bucket_name, key_path, number_retries=DEFAULT_S3_RETRIES):
-    """ Run-logic to do a data retrieval for a file in an S3 bucket."""
+def s3_retrieve_stream(key_path, study_object_id, raw_path=False, number_retries=DEFAULT_S3_RETRIES,
+                       inflate=True):
+    """ As s3_retrieve, but returns a file-like ServerDecryptionStream that downloads and decrypts
+    the object as it is read, so that the object is never in memory as a whole.  Only opening
+    the object is retried, an error while reading it is raised to the reader.
+    If inflate is False an object that was uploaded compressed is read as raw deflate data. """
+    if not raw_path:
+        key_path = study_object_id + "/" + key_path
+    response = _s3_call("get_stream", conn.get_object, number_retries=number_retries,
+                        Bucket=S3_BUCKET, Key=key_path, ResponseContentType='string')
+    return encryption.ServerDecryptionStream(response['Body'], study_object_id, response['ContentLength'],
+                                             inflate=inflate)
+
+
+def s3_reencrypt(key_path, study_object_id, compression_level=0):
+    """ Rewrites an object in the encryption format new objects are written in, if it is in another
+    one.  Only the header is downloaded for an object that is already in that format.
+    With a compression_level the format is the compressed one that s3_upload writes.
+    Takes a full key path, returns whether the object was rewritten. """
+    try:
+        header, _ = _s3_call("get", _read_object, Bucket=S3_BUCKET, Key=key_path,
+                             Range="bytes=0-%s" % (encryption.SERVER_ENCRYPTION_HEADER_LENGTH - 1))
+    except ClientError as e:
+        # an empty object, which is not encrypted.
+        if e.response.get("ResponseMetadata", {}).get("HTTPStatusCode") == 416:
+            return False
+        raise
+    if compression_level:
+        version = encryption.SERVER_ENCRYPTION_CTR_DEFLATE
+    else:
+        version = encryption.SERVER_ENCRYPTION_VERSION
+    if encryption.server_encryption_version(header) == version:
+        return False
+    data = encryption.decrypt_server(_do_retrieve(S3_BUCKET, key_path), study_object_id)
+    _do_upload(S3_BUCKET, key_path, encryption.encrypt_for_server(data, study_object_id, compression_level))
+    return True
+
+
+def s3_upload_stream(key_path, file_object, study_object_id, raw_path=False):
+    """ As s3_upload, for the contents of a file-like object.  The contents are encrypted as they
+    are read and sent in parts of TRANSFER_PART_SIZE, only a few parts are in memory at once. """
+    if not raw_path:
+        key_path = study_object_id + "/" + key_path
+    encrypted_file = encryption.ServerEncryptionStream(file_object, study_object_id)
+    start = time()
+    try:
+        # the stream can not be rewound, so the transfer manager reads it into parts itself.
+        conn.upload_fileobj(encrypted_file, S3_BUCKET, key_path, ExtraArgs={'ContentType': 'string'},
+                            Config=transfer_config)
+    except Exception:
+        s3_metrics.record("stream_put", time() - start, error=True)
+        raise
+    s3_metrics.record("stream_put", time() - start, encrypted_file.bytes_read)
+
+
+def _do_upload(bucket_name, key_path, data, **extra_args):
+    """ Uploads a string in a single put_object, or as a multipart upload when it is larger than
+    TRANSFER_PART_SIZE. """
+    if len(data) <= TRANSFER_PART_SIZE:
+        _s3_call("put", conn.put_object, Body=data, Bucket=bucket_name, Key=key_path,
+                 ContentType='string', **extra_args)
+        return
+    extra_args['ContentType'] = 'string'
+    start = time()
     try:
-        return conn.get_object(Bucket=bucket_name, Key=key_path, ResponseContentType='string')
+        # the transfer manager retries the individual parts itself.
+        conn.upload_fileobj(BytesIO(data), bucket_name, key_path, ExtraArgs=extra_args,
+                            Config=transfer_config)
     except Exception:
-        if number_retries > 0:
-            print("s3_retrieve failed with incomplete read, retrying on %s" % key_path)
-            return _do_retrieve(bucket_name, key_path, number_retries=number_retries - 1)
+        s3_metrics.record("multipart_put", time() - start, error=True)
         raise
+    s3_metrics.record("multipart_put", time() - start, len(data))
+
+
+def _read_object(**kwargs):
+    """ get_object that reads the body, so that an interrupted read is retried as well.
+    Returns the body and the total size of the object. """
+    response = conn.get_object(ResponseContentType='string', **kwargs)
+    body = response['Body'].read()
+    if 'ContentRange' in response:
+        return body, int(response['ContentRange'].rsplit("/", 1)[1])
+    return body, len(body)
+
+
+def _do_retrieve(bucket_name, key_path, number_retries=DEFAULT_S3_RETRIES):
+    """ Run-logic to do a data retrieval for a file in an S3 bucket.
+    The first request asks for the first TRANSFER_PART_SIZE bytes, which is all of almost every
+    object; the rest of larger objects is retrieved with parallel ranged requests. """
+    try:
+        body, total_size = _s3_call(
+            "get", _read_object, number_retries=number_retries,
+            Bucket=bucket_name, Key=key_path, Range="bytes=0-%s" % (TRANSFER_PART_SIZE - 1)
+        )
+    except ClientError as e:
+        # S3 refuses any range on an empty object.
+        if e.response.get("ResponseMetadata", {}).get("HTTPStatusCode") != 416:
+            raise
+        body, total_size = _s3_call("get", _read_object, number_retries=number_retries,
+                                    Bucket=bucket_name, Key=key_path)
+    if total_size <= len(body):
+        return body
+
+    def retrieve_range(start):
+        end = min(start + TRANSFER_PART_SIZE, total_size) - 1
+        return _s3_call("get_range", _read_object, number_retries=number_retries, Bucket=bucket_name,
+                        Key=key_path, Range="bytes=%s-%s" % (start, end))[0]
+
+    starts = range(len(body), total_size, TRANSFER_PART_SIZE)
+    pool = ThreadPool(min(len(starts), TRANSFER_CONCURRENCY))
+    try:
+        parts = pool.map(retrieve_range, starts, chunksize=1)
+    finally:
+        pool.close()
+        pool.terminate()
+    return "".join([body] + parts)
 
 
 def s3_list_files(prefix, as_generator=False):
@@ -115,6 +407,97 @@ def _do_list_files_generator(page_iterator):
             yield item['Key'].strip("/")
 
 
+def s3_iterate_objects(folder, shard_depth=1):
+    """ Yields (key path, size) for every object in a folder, in no particular order.
+    The folder is split into shards, its subfolders shard_depth levels down (e.g. for CHUNKS_FOLDER
+    1 is a shard per study and 2 a shard per participant), and the shards are listed concurrently,
+    a page of up to 1000 keys at a time.  At most CONCURRENT_NETWORK_OPS pages are held at once, so
+    memory use does not grow with the size of the folder. """
+    pool = ThreadPool(CONCURRENT_NETWORK_OPS)
+    try:
+        shards = [folder.rstrip("/") + "/"]
+        for _ in xrange(shard_depth):
+            subfolders = []
+            for objects, folder_subfolders in pool.imap_unordered(_list_folder, shards):
+                for s3_object in objects:
+                    yield s3_object
+                subfolders.extend(folder_subfolders)
+            shards = subfolders
+
+        pages = Queue()
+        def list_page(prefix, continuation_token):
+            try:
+                pages.put(_list_page(prefix, continuation_token))
+            except Exception as e:
+                pages.put(e)
+
+        waiting_shards = deque(shards)
+        pages_in_flight = 0
+        while waiting_shards or pages_in_flight:
+            while waiting_shards and pages_in_flight < CONCURRENT_NETWORK_OPS:
+                pool.apply_async(list_page, (waiting_shards.popleft(), None))
+                pages_in_flight += 1
+            page = pages.get()
+            pages_in_flight -= 1
+            if isinstance(page, Exception):
+                raise page
+            prefix, objects, continuation_token, _ = page
+            # the next page of the shard is listed while this one is consumed.
+            if continuation_token:
+                pool.apply_async(list_page, (prefix, continuation_token))
+                pages_in_flight += 1
+            for s3_object in objects:
+                yield s3_object
+    finally:
+        pool.close()
+        pool.terminate()
+
+
+def _list_page(prefix, continuation_token=None, delimiter=None):
+    """ Returns the prefix, the (key path, size) of a page of objects under it, the continuation
+    token of the next page or None, and the common prefixes of the page when there is a delimiter. """
+    kwargs = {"Bucket": S3_BUCKET, "Prefix": prefix}
+    if continuation_token:
+        kwargs["ContinuationToken"] = continuation_token
+    if delimiter:
+        kwargs["Delimiter"] = delimiter
+    response = _s3_call("list", conn.list_objects_v2, **kwargs)
+    objects = [(item['Key'].strip("/"), item['Size']) for item in response.get('Contents', [])]
+    next_token = response.get('NextContinuationToken') if response.get('IsTruncated') else None
+    return prefix, objects, next_token, [p['Prefix'] for p in response.get('CommonPrefixes', [])]
+
+
+def _list_folder(folder):
+    """ Returns the (key path, size) of the objects directly in a folder, and its subfolders. """
+    objects, subfolders = [], []
+    continuation_token = None
+    while True:
+        _, page_objects, continuation_token, page_subfolders = _list_page(folder, continuation_token, "/")
+        objects.extend(page_objects)
+        subfolders.extend(page_subfolders)
+        if not continuation_token:
+            return objects, subfolders
+
+
+def s3_folder_stats(folder, prefix_depth=1, shard_depth=None):
+    """ Returns {prefix: {"count": number of objects, "bytes": total size}} for the objects in a
+    folder, grouped by their first prefix_depth path components below the folder (e.g. for
+    CHUNKS_FOLDER 1 groups by study and 2 by study/participant).  The totals are added up as the
+    folder is listed, the keys are never all in memory.  The folder is sharded prefix_depth levels
+    down unless a shard_depth is provided. """
+    folder = folder.rstrip("/") + "/"
+    stats = {}
+    for key_path, size in s3_iterate_objects(folder, prefix_depth if shard_depth is None else shard_depth):
+        path_components = key_path[len(folder):].split("/")
+        # the file name is not part of the prefix.
+        prefix = "/".join(path_components[:min(prefix_depth, len(path_components) - 1)])
+        if prefix not in stats:
+            stats[prefix] = {"count": 0, "bytes": 0}
+        stats[prefix]["count"] += 1
+        stats[prefix]["bytes"] += size
+    return stats
+
+
 """################################ S3 PATHS ################################"""
 
 def construct_s3_key_paths(study_id, participant_id):
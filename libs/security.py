@@ -36,6 +36,15 @@ def low_memory_chunk_hash( data ):
     passed by reference to reduce memory usage. """
     return hashlib.md5( data[0] ).digest().encode('base64')
 
+def file_object_hash( file_object ):
+    """ as chunk_hash, for the contents of a file-like object.  The file is hashed a block at a
+    time and then rewound, so it is never in memory as a whole. """
+    md5 = hashlib.md5()
+    for block in iter(lambda: file_object.read(1024 * 1024), ""):
+        md5.update(block)
+    file_object.seek(0)
+    return md5.digest().encode('base64')
+
 
 def device_hash( data ):
     """ Hashes an input string using the sha256 hash, mimicing the hash used on
@@ -18,3 +18,8 @@ class StreamingBytesIO(BytesIO):
         """ Returns the current stream's virtual position (where the stream would be if it had
         been running contiguously and self.empty() is not called) """
         return self._position + super(StreamingBytesIO, self).tell()
+
+    def advance(self, number_bytes):
+        """ Moves the virtual position forward past bytes that were passed on without being
+        written to the stream.  The stream must be empty. """
+        self._position += number_bytes
@@ -0,0 +1,96 @@
+import tarfile
+import time
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+DEFAULT_ZSTD_LEVEL = 3
+MAX_ZSTD_LEVEL = 22
+# zstd compresses on this many threads of its own, which run while the download carries on.
+ZSTD_WORKER_THREADS = 2
+
+
+class StreamingZstdTarFile(object):
+    """
+    Builds a zstd compressed tar file as a sequence of strings, with the same methods as
+    StreamingZipFile.  Tar headers hold the size of a member, so the DownloadBlocks passed to
+    write_blocks must know theirs (DownloadBlocks.size).
+
+    The tar file is a single zstd frame, which every zstd decompressor reads as a whole.  The
+    compression itself runs on zstd's worker threads, so it overlaps with downloading.
+    """
+    file_extension = "tar.zst"
+    mimetype = "application/zstd"
+    compressed = True
+    copies_deflated_data = False
+
+    def __init__(self, level=DEFAULT_ZSTD_LEVEL):
+        if zstandard is None:
+            raise ImportError("zstd compression requires the zstandard package")
+        self.compressor = zstandard.ZstdCompressor(level=level, threads=ZSTD_WORKER_THREADS).compressobj()
+        # the uncompressed size of the tar file so far, it is padded to a whole record at the end.
+        self.offset = 0
+        # the size of the contents of the members added by write_blocks, and of the compressed
+        # tar file so far.
+        self.uncompressed_bytes = 0
+        self.compressed_bytes = 0
+
+    def _compress(self, data):
+        data = self.compressor.compress(data)
+        self.compressed_bytes += len(data)
+        return data
+
+    @staticmethod
+    def _padding(size):
+        return tarfile.NUL * (-size % tarfile.BLOCKSIZE)
+
+    def _header(self, file_name, size):
+        tarinfo = tarfile.TarInfo(file_name)
+        tarinfo.size = size
+        tarinfo.mtime = int(time.time())
+        tarinfo.mode = 0600
+        header = tarinfo.tobuf(format=tarfile.GNU_FORMAT)
+        self.offset += len(header) + size + len(self._padding(size))
+        return header
+
+    def writestr(self, file_name, contents):
+        return self._compress(self._header(file_name, len(contents)) + contents + self._padding(len(contents)))
+
+    def flush(self):
+        """ Returns all the data compressed so far, after which compressed_bytes is up to date. """
+        data = self.compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+        self.compressed_bytes += len(data)
+        return data
+
+    def prepare(self, blocks):
+        return blocks
+
+    def write_blocks(self, file_name, blocks):
+        size = blocks.size
+        data = self._compress(self._header(file_name, size))
+        if data:
+            yield data
+        written = 0
+        for block in blocks:
+            if not block:
+                continue
+            written += len(block)
+            data = self._compress(block)
+            if data:
+                yield data
+        if written != size:
+            # the header already went out with the wrong size, the tar file cannot be completed.
+            raise IOError("%s was %s bytes, expected %s" % (file_name, written, size))
+        self.uncompressed_bytes += size
+        data = self._compress(self._padding(size))
+        if data:
+            yield data
+
+    def close(self):
+        """ Writes the end of archive marker, returns the remaining bytes of the tar file. """
+        end = tarfile.NUL * (tarfile.BLOCKSIZE * 2)
+        self.offset += len(end)
+        end += tarfile.NUL * (-self.offset % tarfile.RECORDSIZE)
+        return self._compress(end) + self.compressor.flush()
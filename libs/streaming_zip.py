@@ -0,0 +1,170 @@
+import struct
+import time
+import zlib
+from zipfile import LargeZipFile, ZipFile, ZipInfo, ZIP_DEFLATED, ZIP_STORED, ZIP64_LIMIT
+from zlib import crc32
+
+from libs.streaming_bytes_io import StreamingBytesIO
+
+# Bit 3 of a member's flags: its crc and sizes follow its data, in a data descriptor.
+DATA_DESCRIPTOR_FLAG = 0x08
+DATA_DESCRIPTOR_SIGNATURE = "PK\x07\x08"
+DEFAULT_DEFLATE_LEVEL = 6
+# The version needed to extract a member with zip64 extensions.
+ZIP64_VERSION = 45
+
+
+def deflate_bound(size):
+    """ The most that deflate can expand size bytes to: 5 bytes per 16KB stored block, and a
+    little more at the end. """
+    return size + size // 16000 + 64
+
+
+def raw_deflate(data, level):
+    """ Returns data compressed as the contents of a ZIP_DEFLATED member. """
+    # negative window bits leave out the zlib header and trailer.
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+class StreamingZipFile(object):
+    """
+    Builds a zip file as a sequence of strings without ever seeking backwards, so that it can be
+    returned by a streaming response as it is produced.  Every method returns, or yields, the next
+    bytes of the zip file.
+
+    writestr adds a member whose contents are in memory.  write_blocks adds a member whose
+    contents arrive as an iterable of strings; stored blocks are passed on as they are, without
+    being copied into a buffer, and the member's crc and sizes are written after it.  Readers only
+    expect the 64 bit sizes of a zip64 data descriptor when the local header has a zip64 extra
+    field, so it is written whenever a member's size is unknown or may be over ZIP64_LIMIT.
+
+    With ZIP_DEFLATED compression, members are deflated at level.  prepare() deflates a file that
+    has been downloaded in full on the download thread, so that compression overlaps with other
+    downloads; larger files are deflated as their blocks arrive.  Files that are already deflated
+    (DownloadBlocks.deflated) are copied as they are.
+    """
+    file_extension = "zip"
+    mimetype = "zip"
+
+    def __init__(self, compression=ZIP_STORED, level=DEFAULT_DEFLATE_LEVEL):
+        self.output = StreamingBytesIO()
+        self.compression = compression
+        self.compressed = compression != ZIP_STORED
+        self.level = level
+        # the sizes of the contents of the members added by write_blocks, before and after compression.
+        self.uncompressed_bytes = 0
+        self.compressed_bytes = 0
+        # whether files should be downloaded as raw deflate data when they are stored compressed.
+        self.copies_deflated_data = self.compressed
+        self.zip_file = ZipFile(self.output, mode="w", compression=compression, allowZip64=True)
+
+    def _flush(self):
+        data = self.output.getvalue()
+        self.output.empty()
+        return data
+
+    def flush(self):
+        """ Returns the bytes of the zip file that have not been returned yet. """
+        return self._flush()
+
+    def writestr(self, file_name, contents):
+        self.zip_file.writestr(file_name, contents)
+        return self._flush()
+
+    def prepare(self, blocks):
+        """ Compresses a DownloadBlocks that has been read in full, returns it. """
+        if self.compression == ZIP_DEFLATED and blocks.stream is None and not blocks.deflated:
+            blocks.prepared = (raw_deflate(blocks.first_block, self.level),
+                               crc32(blocks.first_block), len(blocks.first_block))
+        return blocks
+
+    def write_blocks(self, file_name, blocks):
+        deflated = getattr(blocks, "deflated", False)
+        zinfo = ZipInfo(file_name, date_time=time.localtime(time.time())[:6])
+        zinfo.compress_type = ZIP_DEFLATED if deflated else self.compression
+        zinfo.external_attr = 0600 << 16
+        zinfo.flag_bits |= DATA_DESCRIPTOR_FLAG
+        zinfo.header_offset = self.output.tell()
+        zip64 = self.needs_zip64(blocks, zinfo.compress_type)
+        if zip64:
+            zinfo.extract_version = max(ZIP64_VERSION, zinfo.extract_version)
+            zinfo.create_version = max(ZIP64_VERSION, zinfo.create_version)
+        # with the data descriptor flag the sizes in the header, and its zip64 extra field, are 0.
+        self.output.write(zinfo.FileHeader(zip64))
+        yield self._flush()
+
+        if getattr(blocks, "prepared", None) is not None:
+            compressed, crc, size = blocks.prepared
+            compressed_size = len(compressed)
+            self.output.advance(compressed_size)
+            yield compressed
+        elif deflated:
+            crc = blocks.crc
+            size = blocks.size
+            compressed_size = 0
+            for block in blocks:
+                compressed_size += len(block)
+                self.output.advance(len(block))
+                yield block
+        else:
+            crc = 0
+            size = 0
+            compressed_size = 0
+            compressor = None
+            if self.compression == ZIP_DEFLATED:
+                compressor = zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS)
+            for block in blocks:
+                if not block:
+                    continue
+                crc = crc32(block, crc)
+                size += len(block)
+                if compressor is not None:
+                    block = compressor.compress(block)
+                    if not block:
+                        continue
+                compressed_size += len(block)
+                self.output.advance(len(block))
+                yield block
+            if compressor is not None:
+                block = compressor.flush()
+                compressed_size += len(block)
+                self.output.advance(len(block))
+                yield block
+
+        self.uncompressed_bytes += size
+        self.compressed_bytes += compressed_size
+        zinfo.CRC = crc & 0xffffffff
+        zinfo.file_size = size
+        zinfo.compress_size = compressed_size
+        if zip64:
+            self.output.write(struct.pack("<4sLQQ", DATA_DESCRIPTOR_SIGNATURE, zinfo.CRC, compressed_size, size))
+        elif max(size, compressed_size) > ZIP64_LIMIT:
+            raise LargeZipFile("%s is larger than the size it was added with" % file_name)
+        else:
+            self.output.write(struct.pack("<4sLLL", DATA_DESCRIPTOR_SIGNATURE, zinfo.CRC, compressed_size, size))
+        # the central directory that close() writes is built from these.
+        self.zip_file.filelist.append(zinfo)
+        self.zip_file.NameToInfo[zinfo.filename] = zinfo
+        yield self._flush()
+
+    @staticmethod
+    def needs_zip64(blocks, compress_type):
+        """ Whether the member that blocks are written to needs zip64 sizes: its contents are
+        prepared and over ZIP64_LIMIT, or its size (blocks.size) is unknown or, allowing for the
+        expansion of deflate, may be over ZIP64_LIMIT. """
+        prepared = getattr(blocks, "prepared", None)
+        if prepared is not None:
+            compressed, _, size = prepared
+            return max(len(compressed), size) > ZIP64_LIMIT
+        size = getattr(blocks, "size", None)
+        if size is None:
+            return True
+        if compress_type == ZIP_DEFLATED:
+            size = deflate_bound(size)
+        return size > ZIP64_LIMIT
+
+    def close(self):
+        """ Writes the central directory, returns the remaining bytes of the zip file. """
+        self.zip_file.close()
+        return self._flush()
@@ -0,0 +1,71 @@
+from threading import Lock
+from time import time
+
+from config.constants import STUDY_KEY_CACHE_TTL_SECONDS
+from database.study_models import Study
+
+
+class StudyKeyCache(object):
+    """
+    A process-local cache of study encryption keys, keyed by study object id, and of study object
+    ids, keyed by study primary key.  Entries expire after ttl seconds; saving a Study invalidates
+    its entries in the process that saved it (see database.signals), other processes see the
+    change once their entries expire.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.lock = Lock()
+        self.encryption_keys = {}  # study object id -> (encryption key, expiry)
+        self.object_ids = {}  # study pk -> (study object id, expiry)
+        self.hits = 0
+        self.misses = 0
+
+    def get_encryption_key(self, study_object_id):
+        encryption_key = self._get(self.encryption_keys, study_object_id)
+        if encryption_key is None:
+            encryption_key = Study.objects.filter(object_id=study_object_id)\
+                .values_list('encryption_key', flat=True).get()
+            self._set(self.encryption_keys, study_object_id, encryption_key)
+        return encryption_key
+
+    def get_object_id(self, study_pk):
+        object_id = self._get(self.object_ids, study_pk)
+        if object_id is None:
+            # the encryption key is almost always needed next, it is cached by the same query.
+            object_id, encryption_key = Study.objects.filter(pk=study_pk)\
+                .values_list('object_id', 'encryption_key').get()
+            self._set(self.object_ids, study_pk, object_id)
+            self._set(self.encryption_keys, object_id, encryption_key)
+        return object_id
+
+    def _get(self, cache, key):
+        entry = cache.get(key)
+        with self.lock:
+            if entry is not None and entry[1] > time():
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+            return None
+
+    def _set(self, cache, key, value):
+        with self.lock:
+            cache[key] = (value, time() + self.ttl)
+
+    def invalidate(self, study_object_id=None):
+        """ Removes the entries of a study, or of every study if no object id is provided. """
+        with self.lock:
+            if study_object_id is None:
+                self.encryption_keys.clear()
+                self.object_ids.clear()
+                return
+            self.encryption_keys.pop(study_object_id, None)
+            for study_pk, (object_id, _) in self.object_ids.items():
+                if object_id == study_object_id:
+                    del self.object_ids[study_pk]
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "size": len(self.encryption_keys)}
+
+
+study_key_cache = StudyKeyCache(STUDY_KEY_CACHE_TTL_SECONDS)
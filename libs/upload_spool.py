@@ -0,0 +1,307 @@
+import json
+import os
+from datetime import datetime
+from threading import Event, Lock, Thread
+from time import time
+from uuid import uuid4
+
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+
+from config.constants import UPLOAD_SPOOL_DIRECTORY, UPLOAD_SPOOL_UPLOADERS
+from database.data_access_models import FileToProcess
+from database.profiling_models import ReceivedDataStats, UploadTracking
+from database.study_models import Study
+from database.user_models import Participant
+from libs.bw_logging import log_error
+from libs.s3 import s3_upload
+
+# Spooled uploads are written as .tmp files and renamed to .upload once they are durable. An
+# uploader claims a file by renaming it to .claimed, which only one process can do.
+SPOOLED_SUFFIX = ".upload"
+CLAIMED_SUFFIX = ".claimed"
+TEMPORARY_SUFFIX = ".tmp"
+# The number of failed attempts to send a spooled upload follows this in its file name.
+ATTEMPTS_SEPARATOR = "#"
+# Uploads that failed UPLOAD_SPOOL_MAX_ATTEMPTS times are moved to this subdirectory of the spool.
+QUARANTINE_DIRECTORY = "quarantine"
+
+# The number of spooled uploads an uploader sends before doing their database bookkeeping.
+UPLOAD_SPOOL_BATCH_SIZE = 50
+# Seconds an idle uploader waits before looking at the spool directory again.
+UPLOAD_SPOOL_POLL_INTERVAL = 5
+# Claimed files older than this were left behind by a process that died, they are spooled again.
+STALE_CLAIM_SECONDS = 60 * 60
+# A failed upload is retried after this many seconds, doubled after each further failure.
+UPLOAD_SPOOL_RETRY_SECONDS = 30
+UPLOAD_SPOOL_MAX_RETRY_SECONDS = 60 * 60
+UPLOAD_SPOOL_MAX_ATTEMPTS = 10
+
+
+def s3_store(s3_path, contents, study_object_id):
+    s3_upload(s3_path, contents, study_object_id, raw_path=True)
+
+
+def spooled_attempts(spooled_path):
+    """ The number of times a spooled or claimed upload has failed. """
+    base_name = os.path.splitext(os.path.basename(spooled_path))[0]
+    if ATTEMPTS_SEPARATOR not in base_name:
+        return 0
+    return int(base_name.rsplit(ATTEMPTS_SEPARATOR, 1)[1])
+
+
+def retry_delay(attempts):
+    """ Seconds to wait before sending an upload that failed this many times. """
+    if not attempts:
+        return 0
+    return min(UPLOAD_SPOOL_RETRY_SECONDS * 2 ** (attempts - 1), UPLOAD_SPOOL_MAX_RETRY_SECONDS)
+
+
+def local_directory_store(directory):
+    """ Returns a store function that writes uploads under a local directory instead of S3, for
+    testing and development. """
+    def store(s3_path, contents, study_object_id):
+        file_path = os.path.join(directory, s3_path)
+        if not os.path.isdir(os.path.dirname(file_path)):
+            os.makedirs(os.path.dirname(file_path))
+        with open(file_path, "wb") as f:
+            f.write(contents)
+    return store
+
+
+class UploadSpool(object):
+    """
+    Decouples the mobile upload endpoint from S3 and the database.  spool() durably writes a
+    decrypted upload to a local directory so that the request can be acknowledged; uploader threads
+    then store the spooled files (on S3 by default) and create their FileToProcess, UploadTracking
+    and ReceivedDataStats entries in batches.  A spooled file is only removed after its database
+    entries are committed.  Uploads that fail stay in the spool and are retried with a growing
+    delay, behind the uploads that have not failed, until they are quarantined after
+    UPLOAD_SPOOL_MAX_ATTEMPTS failures.
+    """
+
+    def __init__(self, directory, store=s3_store, uploader_count=UPLOAD_SPOOL_UPLOADERS):
+        self.directory = directory
+        self.store = store
+        self.uploader_count = uploader_count
+        self.uploaders = []
+        self.start_lock = Lock()
+        self.work_available = Event()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def spool(self, s3_path, contents, study_object_id, study_pk, participant_pk):
+        """ Writes an upload to the spool, it is durable on disk when this returns. """
+        metadata = {
+            "s3_path": s3_path,
+            "study_object_id": study_object_id,
+            "study_pk": study_pk,
+            "participant_pk": participant_pk,
+            "timestamp": time(),
+        }
+        file_name = "%f-%s" % (time(), uuid4().hex)
+        temporary_path = os.path.join(self.directory, file_name + TEMPORARY_SUFFIX)
+        with open(temporary_path, "wb") as f:
+            f.write(json.dumps(metadata) + "\n")
+            f.write(contents)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(temporary_path, os.path.join(self.directory, file_name + SPOOLED_SUFFIX))
+        # the rename is only durable once the directory itself is synced.
+        directory_fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(directory_fd)
+        finally:
+            os.close(directory_fd)
+        self.start()
+        self.work_available.set()
+
+    def start(self):
+        """ Starts the uploader threads once per process, after releasing stale claims.  app.py
+        calls this at startup, mod_wsgi imports the app in each of its daemon processes so the
+        threads exist only there; spool() calls it as well, for any process that did not. """
+        if self.uploaders:
+            return
+        with self.start_lock:
+            if self.uploaders:
+                return
+            self.release_stale_claims()
+            for _ in xrange(self.uploader_count):
+                thread = Thread(target=self.run_uploader)
+                thread.daemon = True
+                thread.start()
+                self.uploaders.append(thread)
+
+    def run_uploader(self):
+        while True:
+            self.work_available.clear()
+            try:
+                uploaded = self.drain_batch()
+            except Exception as e:
+                log_error(e, "upload spool error")
+                uploaded = 0
+            finally:
+                close_old_connections()
+            # nothing was sent when the spool is empty or every upload in it is failing, wait
+            # rather than trying them again straight away.
+            if not uploaded:
+                self.work_available.wait(UPLOAD_SPOOL_POLL_INTERVAL)
+
+    def drain_batch(self):
+        """ Claims up to UPLOAD_SPOOL_BATCH_SIZE spooled uploads, stores them and records them in
+        the database.  Returns the number of uploads that were stored and recorded. """
+        stored = []
+        for claimed_path in self.claim_batch():
+            try:
+                metadata = self.store_upload(claimed_path)
+            except Exception as e:
+                log_error(e, "could not store spooled upload %s" % claimed_path)
+                self.retry_later(claimed_path)
+            else:
+                stored.append((claimed_path, metadata))
+        if not stored:
+            return 0
+
+        # an upload whose participant or study was deleted can never be recorded.
+        participant_pks = set(Participant.objects.filter(
+            pk__in=set(metadata["participant_pk"] for _, metadata in stored)
+        ).values_list("pk", flat=True))
+        study_pks = set(Study.objects.filter(
+            pk__in=set(metadata["study_pk"] for _, metadata in stored)
+        ).values_list("pk", flat=True))
+        recordable = []
+        for claimed_path, metadata in stored:
+            if metadata["participant_pk"] in participant_pks and metadata["study_pk"] in study_pks:
+                recordable.append((claimed_path, metadata))
+            else:
+                log_error(ValueError("participant or study does not exist"),
+                          "quarantining spooled upload %s" % claimed_path)
+                self.quarantine(claimed_path)
+
+        try:
+            self.record_uploads([metadata for _, metadata in recordable])
+        except Exception as e:
+            # one bad upload must not hold back the rest of the batch, record them one at a time.
+            log_error(e, "could not record a batch of spooled uploads, recording them one at a time")
+            recorded = []
+            for claimed_path, metadata in recordable:
+                try:
+                    self.record_uploads([metadata])
+                except Exception as e:
+                    log_error(e, "could not record spooled upload %s" % claimed_path)
+                    self.retry_later(claimed_path)
+                else:
+                    recorded.append(claimed_path)
+        else:
+            recorded = [claimed_path for claimed_path, _ in recordable]
+
+        for claimed_path in recorded:
+            os.remove(claimed_path)
+        return len(recorded)
+
+    def claim_batch(self):
+        """ Claims the uploads that have failed the fewest times first, skipping those that are
+        waiting for their retry_delay. """
+        spooled = []
+        for file_name in os.listdir(self.directory):
+            if not file_name.endswith(SPOOLED_SUFFIX):
+                continue
+            attempts = spooled_attempts(file_name)
+            if attempts:
+                try:
+                    failed_at = os.path.getmtime(os.path.join(self.directory, file_name))
+                except OSError:
+                    # another uploader claimed it
+                    continue
+                if time() - failed_at < retry_delay(attempts):
+                    continue
+            spooled.append((attempts, file_name))
+        spooled.sort()
+
+        claimed = []
+        for _, file_name in spooled:
+            if len(claimed) >= UPLOAD_SPOOL_BATCH_SIZE:
+                break
+            spooled_path = os.path.join(self.directory, file_name)
+            claimed_path = spooled_path[:-len(SPOOLED_SUFFIX)] + CLAIMED_SUFFIX
+            try:
+                os.rename(spooled_path, claimed_path)
+            except OSError:
+                # another uploader claimed it first
+                continue
+            # the modification time of a claimed file is the time it was claimed.
+            os.utime(claimed_path, None)
+            claimed.append(claimed_path)
+        return claimed
+
+    def release_claim(self, claimed_path):
+        os.rename(claimed_path, claimed_path[:-len(CLAIMED_SUFFIX)] + SPOOLED_SUFFIX)
+
+    def retry_later(self, claimed_path):
+        """ Returns a failed upload to the spool with one more attempt in its name, or quarantines
+        it once it has failed UPLOAD_SPOOL_MAX_ATTEMPTS times. """
+        attempts = spooled_attempts(claimed_path) + 1
+        if attempts >= UPLOAD_SPOOL_MAX_ATTEMPTS:
+            self.quarantine(claimed_path)
+            return
+        base_path = claimed_path[:-len(CLAIMED_SUFFIX)]
+        if ATTEMPTS_SEPARATOR in os.path.basename(base_path):
+            base_path = base_path.rsplit(ATTEMPTS_SEPARATOR, 1)[0]
+        spooled_path = "%s%s%d%s" % (base_path, ATTEMPTS_SEPARATOR, attempts, SPOOLED_SUFFIX)
+        # the modification time of a spooled file that failed is the time of its last failure.
+        os.utime(claimed_path, None)
+        os.rename(claimed_path, spooled_path)
+
+    def quarantine(self, claimed_path):
+        """ Moves an upload that cannot be sent out of the spool, it is kept for inspection. """
+        quarantine_directory = os.path.join(self.directory, QUARANTINE_DIRECTORY)
+        try:
+            os.makedirs(quarantine_directory)
+        except OSError:
+            # it already exists
+            pass
+        os.rename(claimed_path, os.path.join(quarantine_directory, os.path.basename(claimed_path)))
+
+    def release_stale_claims(self):
+        for file_name in os.listdir(self.directory):
+            claimed_path = os.path.join(self.directory, file_name)
+            if file_name.endswith(CLAIMED_SUFFIX) and \
+                    time() - os.path.getmtime(claimed_path) > STALE_CLAIM_SECONDS:
+                try:
+                    self.release_claim(claimed_path)
+                except OSError:
+                    pass
+
+    def store_upload(self, claimed_path):
+        with open(claimed_path, "rb") as f:
+            metadata = json.loads(f.readline())
+            contents = f.read()
+        self.store(metadata["s3_path"], contents, metadata["study_object_id"])
+        metadata["file_size"] = len(contents)
+        return metadata
+
+    @staticmethod
+    def record_uploads(uploads):
+        """ Creates the database entries of stored uploads, a few queries for the whole batch. """
+        uploads = [
+            (upload, timezone.make_aware(datetime.utcfromtimestamp(upload["timestamp"]), timezone.utc))
+            for upload in uploads
+        ]
+        with transaction.atomic():
+            FileToProcess.objects.bulk_create([
+                FileToProcess(s3_file_path=upload["s3_path"], study_id=upload["study_pk"],
+                              participant_id=upload["participant_pk"])
+                for upload, _ in uploads
+            ])
+            UploadTracking.objects.bulk_create([
+                UploadTracking(file_path=upload["s3_path"], file_size=upload["file_size"],
+                               timestamp=timestamp, participant_id=upload["participant_pk"])
+                for upload, timestamp in uploads
+            ])
+            ReceivedDataStats.bulk_update_statistics([
+                (upload["s3_path"], upload["participant_pk"], upload["file_size"], timestamp)
+                for upload, timestamp in uploads
+            ])
+
+
+upload_spool = UploadSpool(UPLOAD_SPOOL_DIRECTORY) if UPLOAD_SPOOL_DIRECTORY else None
@@ -0,0 +1,250 @@
+import os
+from collections import deque
+from multiprocessing.pool import ThreadPool
+from threading import Lock
+from time import time
+
+from config.constants import DOWNLOAD_CONCURRENCY, DOWNLOAD_PREFETCH_MB
+from libs.chunk_cache import chunk_cache
+from libs.encryption import SERVER_STREAM_BLOCK_SIZE
+from libs.s3 import S3Metrics, s3_retrieve_stream
+
+# A download starts with the number of concurrent S3 requests that was heuristically determined to
+# be a good value on an m4.large, and adapts between it and DOWNLOAD_CONCURRENCY.
+MIN_CONCURRENCY = 3
+# Bounds the bookkeeping of downloads of many tiny files, whose bytes never fill the window.
+MAX_FILES_AHEAD = 1000
+# How often a download that is waiting on S3 checks whether it can start more requests.
+WAIT_INTERVAL_SECONDS = 0.05
+
+# The number, bytes and durations of the zip downloads of this process, by kind of download.
+download_metrics = S3Metrics()
+
+
+class DownloadBlocks(object):
+    """ The decrypted blocks of a file on S3.  The file is opened and its first block downloaded
+    when this is created, on a thread of a PrefetchingDownload's pool; the rest of the file is
+    downloaded as this is iterated over.  Almost every file fits in a single block and is closed
+    right away.  A DownloadBlocks that is not iterated over to the end must be closed.
+
+    If there is a chunk cache and chunk_hash is not None (see cacheable_hash) the file is read from
+    the cache when it is there, and otherwise added to the cache as it is downloaded.
+
+    size is the size of the file.  prepared is set by the prepare() of the archive the file is
+    written to, e.g. to the compressed contents of a file that fits in a block.
+
+    If deflated is True a file that was stored compressed is read as raw deflate data, it is then
+    not cached; deflated and crc (the crc32 of the file) are set. """
+
+    def __init__(self, key_path, study_object_id, chunk_hash=None, deflated=False):
+        self.cache_writer = None
+        self.bytes_read = 0
+        self.stream = None
+        self.prepared = None
+        try:
+            if chunk_cache is not None and chunk_hash is not None:
+                self.stream = chunk_cache.open(key_path, chunk_hash)
+                if self.stream is None:
+                    self.cache_writer = chunk_cache.writer(key_path, chunk_hash)
+            if self.stream is None:
+                self.stream = s3_retrieve_stream(key_path, study_object_id, raw_path=True,
+                                                 inflate=not deflated)
+            self.deflated = getattr(self.stream, "deflated", False)
+            self.crc = getattr(self.stream, "crc", None)
+            if self.deflated and self.cache_writer is not None:
+                self.cache_writer.abort()
+                self.cache_writer = None
+            if isinstance(self.stream, file):
+                self.size = os.fstat(self.stream.fileno()).st_size
+            else:
+                self.size = self.stream.size
+            self.first_block = self.read_block()
+        except Exception:
+            self.close()
+            raise
+        if len(self.first_block) < SERVER_STREAM_BLOCK_SIZE:
+            self.close(complete=True)
+            if not self.deflated:
+                self.size = len(self.first_block)
+
+    def read_block(self):
+        block = self.stream.read(SERVER_STREAM_BLOCK_SIZE)
+        self.bytes_read += len(block)
+        if self.cache_writer is not None:
+            self.cache_writer.write(block)
+        return block
+
+    def __iter__(self):
+        complete = False
+        try:
+            first_block, self.first_block = self.first_block, None
+            yield first_block
+            if self.stream is not None:
+                for block in iter(self.read_block, ""):
+                    yield block
+            complete = True
+        finally:
+            self.close(complete)
+
+    def close(self, complete=False):
+        """ complete is whether the whole file has been read, only then is it added to the cache. """
+        if self.cache_writer is not None:
+            if complete:
+                self.cache_writer.commit()
+            else:
+                self.cache_writer.abort()
+            self.cache_writer = None
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+
+
+class PrefetchingDownload(object):
+    """
+    Opens files with open_file(item), a function that returns a DownloadBlocks, on a thread pool
+    ahead of the consumer, and iterates over (item, DownloadBlocks) in the order of items.
+
+    Prefetching is bounded in bytes, not files: no new file is opened while the first blocks of
+    the files that are waiting to be consumed add up to prefetch_bytes, so a slow client never
+    lets the pool run ahead of it.  Files that are larger than a block keep their S3 connection
+    open until they are consumed; those and the files being opened are at most max_concurrency.
+
+    The number of files opened at once adapts to whichever side is slower: it goes up each time
+    the consumer has to wait on S3, and down each time the prefetch window is full because the
+    consumer is slow.
+    """
+
+    def __init__(self, items, open_file, kind, prefetch_bytes=None, max_concurrency=None):
+        self.items = iter(items)
+        self.open_file = open_file
+        self.kind = kind
+        self.prefetch_bytes = prefetch_bytes or DOWNLOAD_PREFETCH_MB * 1024 * 1024
+        self.max_concurrency = max(max_concurrency or DOWNLOAD_CONCURRENCY, MIN_CONCURRENCY)
+        self.concurrency = MIN_CONCURRENCY
+        # the pool is started when iteration starts, a download that is never iterated over holds nothing.
+        self.pool = None
+        self.closed = False
+        # (item, AsyncResult of _open) of the files that were started and not yet consumed, in order.
+        self.pending = deque()
+        self.items_exhausted = False
+        # in_flight, buffered_bytes and open_ahead are updated by the pool's threads.
+        self.lock = Lock()
+        self.in_flight = 0
+        self.buffered_bytes = 0
+        self.open_ahead = 0
+        self.files = 0
+        self.bytes = 0
+        self.wait_seconds = 0.0
+        self.peak_buffered_bytes = 0
+        self.start = None
+
+    def _open(self, item):
+        try:
+            blocks = self.open_file(item)
+        except Exception:
+            with self.lock:
+                self.in_flight -= 1
+            raise
+        held_bytes = len(blocks.first_block)
+        holds_connection = blocks.stream is not None
+        with self.lock:
+            self.in_flight -= 1
+            self.buffered_bytes += held_bytes
+            self.open_ahead += holds_connection
+            self.peak_buffered_bytes = max(self.peak_buffered_bytes, self.buffered_bytes)
+        return blocks, held_bytes, holds_connection
+
+    def _window_is_full(self):
+        return self.buffered_bytes >= self.prefetch_bytes or len(self.pending) >= MAX_FILES_AHEAD
+
+    def _fill(self):
+        """ Starts opening the next files while there is room for them. """
+        while not self.items_exhausted:
+            with self.lock:
+                if (self.in_flight >= self.concurrency or self._window_is_full() or
+                        self.in_flight + self.open_ahead >= self.max_concurrency):
+                    return
+                self.in_flight += 1
+            try:
+                item = next(self.items)
+            except StopIteration:
+                self.items_exhausted = True
+                with self.lock:
+                    self.in_flight -= 1
+                return
+            self.pending.append((item, self.pool.apply_async(self._open, (item,))))
+
+    def __iter__(self):
+        if self.closed:
+            return
+        self.start = time()
+        self.pool = ThreadPool(self.max_concurrency)
+        current = None
+        try:
+            while True:
+                self._fill()
+                if not self.pending:
+                    break
+                item, result = self.pending.popleft()
+                if result.ready():
+                    if self._window_is_full():
+                        self.concurrency = max(self.concurrency - 1, MIN_CONCURRENCY)
+                else:
+                    wait_start = time()
+                    if self.in_flight >= self.concurrency:
+                        self.concurrency = min(self.concurrency + 1, self.max_concurrency)
+                    while not result.ready():
+                        self._fill()
+                        result.wait(WAIT_INTERVAL_SECONDS)
+                    self.wait_seconds += time() - wait_start
+                current, held_bytes, holds_connection = result.get()
+                with self.lock:
+                    self.buffered_bytes -= held_bytes
+                    self.open_ahead -= holds_connection
+                yield item, current
+                # the consumer is done with the file once it asks for the next one.
+                current.close()
+                self.files += 1
+                self.bytes += current.bytes_read
+                current = None
+        finally:
+            if current is not None:
+                current.close()
+                self.files += 1
+                self.bytes += current.bytes_read
+            self.close()
+
+    def close(self):
+        """ Closes the files that were opened ahead and the pool, and records the metrics. """
+        if self.closed:
+            return
+        self.closed = True
+        if self.pool is None:
+            return
+        self.pool.close()
+        for _, result in self.pending:
+            # A file that is still being opened is left for the garbage collector.
+            if result.ready() and result.successful():
+                result.get()[0].close()
+        self.pending.clear()
+        self.pool.terminate()
+        self.pool = None
+        stats = self.stats()
+        download_metrics.record(self.kind, stats["seconds"], stats["bytes"])
+        print("%s download: %s files, %s bytes in %.1f seconds (%.1f MB/s), %.1f seconds waiting on S3, "
+              "peak prefetch %s bytes, concurrency %s" % (
+                  self.kind, stats["files"], stats["bytes"], stats["seconds"],
+                  stats["megabytes_per_second"], stats["wait_seconds"],
+                  stats["peak_buffered_bytes"], stats["concurrency"]))
+
+    def stats(self):
+        seconds = time() - self.start if self.start else 0.0
+        return {
+            "files": self.files,
+            "bytes": self.bytes,
+            "seconds": seconds,
+            "megabytes_per_second": self.bytes / 1048576.0 / seconds if seconds else 0.0,
+            "wait_seconds": self.wait_seconds,
+            "peak_buffered_bytes": self.peak_buffered_bytes,
+            "concurrency": self.concurrency,
+        }
@@ -0,0 +1,64 @@
+""" Compares binify_csv_rows with binify_csv_rows_columnar on a synthetic accelerometer file, and
+checks that the chunk files they lead to are byte-for-byte identical.
+usage: python scripts/benchmark_binification.py [number_of_rows] """
+import sys
+from copy import deepcopy
+from random import randint, random
+from time import time
+
+from config.constants import ACCELEROMETER
+from libs.file_processing import (add_utc_time_column, binify_csv_rows, binify_csv_rows_columnar,
+    construct_csv_string, ensure_sorted_by_timestamp, with_human_readable_timestamps)
+
+HEADER = "timestamp,accuracy,x,y,z"
+
+
+def synthetic_accelerometer_rows(number_of_rows):
+    """ About 10 hours of 10Hz data, lightly shuffled the way files from a phone can be. """
+    start = 1500000000000
+    rows = [[str(start + i * 100 + randint(-150, 150)), "unknown",
+             "%.6f" % random(), "%.6f" % random(), "%.6f" % random()]
+            for i in xrange(number_of_rows)]
+    # a few exact duplicates, these are dropped when the chunk is constructed.
+    rows.extend(deepcopy(rows[:number_of_rows / 100]))
+    return rows
+
+
+def chunk_files(binified):
+    ret = {}
+    for data_bin, rows in binified.iteritems():
+        rows = list(rows)
+        ensure_sorted_by_timestamp(rows)
+        ret[data_bin] = construct_csv_string(add_utc_time_column(HEADER), with_human_readable_timestamps(rows))
+    return ret
+
+
+def time_binify(binify, rows):
+    rows = deepcopy(rows)
+    t1 = time()
+    binified = binify(rows, "study", "patient", ACCELEROMETER, HEADER)
+    t2 = time()
+    return t2 - t1, binified
+
+
+if __name__ == "__main__":
+    number_of_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    print "generating %s rows..." % number_of_rows
+    rows = synthetic_accelerometer_rows(number_of_rows)
+
+    row_time, row_binified = time_binify(binify_csv_rows, rows)
+    columnar_time, columnar_binified = time_binify(binify_csv_rows_columnar, rows)
+    print "binify_csv_rows:          %.3f seconds, %s bins" % (row_time, len(row_binified))
+    print "binify_csv_rows_columnar: %.3f seconds, %s bins" % (columnar_time, len(columnar_binified))
+
+    t1 = time()
+    row_chunks = chunk_files(row_binified)
+    t2 = time()
+    columnar_chunks = chunk_files(columnar_binified)
+    t3 = time()
+    print "chunk construction after binify_csv_rows:          %.3f seconds" % (t2 - t1)
+    print "chunk construction after binify_csv_rows_columnar: %.3f seconds" % (t3 - t2)
+
+    if row_chunks != columnar_chunks:
+        raise Exception("chunk files differ between the two binification paths.")
+    print "chunk files are identical."
@@ -0,0 +1,188 @@
+""" Seeds a scratch database with chunk registries and compares ChunkRegistry.get_chunks_time_range
+with and without the (study, participant, data_type, time_bin) index, and against the query it
+replaced, which joined the participant table to filter on patient_id.  Prints the query plans and
+the median latency of each.
+
+The scratch database is a temporary sqlite file, or with --postgres an existing empty postgres
+database on which the database is migrated and filled with millions of rows; connection settings
+are taken from the usual PGHOST, PGUSER and PGPASSWORD environment variables.  Never point this
+at a database that holds real data.
+usage: python scripts/benchmark_chunk_registry_query.py [--rows N] [--postgres DATABASE_NAME] """
+import argparse
+import os
+from datetime import datetime, timedelta
+from tempfile import mkstemp
+from time import time
+
+import django
+from django.conf import settings
+
+from config.constants import CHUNKABLE_FILES
+from config.django_settings import INSTALLED_APPS, SECRET_KEY, TIME_ZONE, USE_TZ
+
+INDEX_NAME = "chunk_time_range_idx"
+NUMBER_OF_PARTICIPANTS = 20
+# one in this many chunks is marked deleted, they are left out of the postgres index.
+DELETED_EVERY = 20
+SEED_BATCH_SIZE = 10000
+# postgres allows 65535 query parameters, a chunk registry is 13; on sqlite Django picks the batch size.
+POSTGRES_INSERT_BATCH_SIZE = 1000
+REPETITIONS = 20
+# the fields of a data download, see handle_database_query.
+CHUNK_FIELDS = ["pk", "participant_id", "data_type", "chunk_path", "time_bin", "chunk_hash",
+                "participant__patient_id", "study_id", "survey_id", "survey__object_id"]
+
+
+def configure_scratch_database(postgres_database_name):
+    if postgres_database_name:
+        # an empty user, password and host make psycopg2 use the PG* environment variables.
+        database = {'ENGINE': 'django.db.backends.postgresql', 'NAME': postgres_database_name}
+    else:
+        fd, sqlite_path = mkstemp(suffix=".sqlite")
+        os.close(fd)
+        database = {'ENGINE': 'django.db.backends.sqlite3', 'NAME': sqlite_path}
+    settings.configure(
+        SECRET_KEY=SECRET_KEY,
+        DATABASES={'default': database},
+        TIME_ZONE=TIME_ZONE,
+        USE_TZ=USE_TZ,
+        INSTALLED_APPS=INSTALLED_APPS
+    )
+    django.setup()
+    return database['NAME']
+
+
+def seed(number_of_rows):
+    """ Registers about number_of_rows hourly chunks of every chunkable data stream for
+    NUMBER_OF_PARTICIPANTS participants, in the interleaved order that data is processed in. """
+    study = Study.create_with_object_id(name="benchmark study", encryption_key="a" * 32)
+    Participant.objects.bulk_create([
+        Participant(patient_id="b%07d" % i, password="x", salt="x", os_type=Participant.ANDROID_API,
+                    study=study)
+        for i in xrange(NUMBER_OF_PARTICIPANTS)
+    ])
+    participants = list(Participant.objects.filter(study=study).order_by("patient_id"))
+    data_types = sorted(CHUNKABLE_FILES)
+    hours = max(number_of_rows // (len(participants) * len(data_types)), 1)
+    first_time_bin = timezone.make_aware(datetime(2018, 1, 1), timezone.utc)
+    insert_batch_size = None if connection.vendor == "sqlite" else POSTGRES_INSERT_BATCH_SIZE
+
+    t1 = time()
+    batch = []
+    count = 0
+    for hour in xrange(hours):
+        time_bin = first_time_bin + timedelta(hours=hour)
+        for participant in participants:
+            for data_type in data_types:
+                batch.append(ChunkRegistry(
+                    is_chunkable=True,
+                    chunk_path="%s/%s/%s/%s.csv" % (study.object_id, participant.patient_id, data_type, hour),
+                    chunk_hash="x",
+                    data_type=data_type,
+                    time_bin=time_bin,
+                    study=study,
+                    participant=participant,
+                    number_of_observations=0,
+                    deleted=count % DELETED_EVERY == 0,
+                ))
+                count += 1
+        if len(batch) >= SEED_BATCH_SIZE:
+            ChunkRegistry.objects.bulk_create(batch, batch_size=insert_batch_size)
+            batch = []
+    ChunkRegistry.objects.bulk_create(batch, batch_size=insert_batch_size)
+    with connection.cursor() as cursor:
+        cursor.execute("ANALYZE")
+    print "seeded %s chunk registries in %.1f seconds" % (count, time() - t1)
+    return study, participants, data_types, first_time_bin, hours
+
+
+def join_query(study_id, user_ids=None, data_types=None, start=None, end=None):
+    """ get_chunks_time_range as it was before participants were resolved to primary keys. """
+    return ChunkRegistry.objects.filter(study_id=study_id, deleted=False, participant__patient_id__in=user_ids,
+                                        data_type__in=data_types, time_bin__gte=start, time_bin__lte=end)
+
+
+def query_plan(queryset):
+    sql, params = queryset.query.sql_with_params()
+    prefix = "EXPLAIN QUERY PLAN " if connection.vendor == "sqlite" else "EXPLAIN "
+    with connection.cursor() as cursor:
+        cursor.execute(prefix + sql, params)
+        return "\n".join("    %s" % row[-1] for row in cursor.fetchall())
+
+
+def median_seconds(get_chunks, query):
+    """ Runs get_chunks(**query) with the fields of a download, returns the median time it took and
+    the number of chunks. """
+    times = []
+    for _ in xrange(REPETITIONS):
+        t1 = time()
+        chunks = list(get_chunks(**query).values(*CHUNK_FIELDS))
+        times.append(time() - t1)
+    return sorted(times)[len(times) // 2], len(chunks)
+
+
+def drop_index():
+    """ Drops the time range index, returns the sql that recreates it as it was. """
+    if connection.vendor == "sqlite":
+        definition_query = "SELECT sql FROM sqlite_master WHERE type = 'index' AND name = %s"
+    else:
+        definition_query = "SELECT indexdef FROM pg_indexes WHERE indexname = %s"
+    with connection.cursor() as cursor:
+        cursor.execute(definition_query, [INDEX_NAME])
+        definition = cursor.fetchone()[0]
+        cursor.execute('DROP INDEX "%s"' % INDEX_NAME)
+    return definition
+
+
+def compare(query):
+    results = {}
+    for get_chunks, description in [(join_query, "join on patient_id"),
+                                    (ChunkRegistry.get_chunks_time_range, "participant primary keys")]:
+        print "%s:" % description
+        print query_plan(get_chunks(**query).values(*CHUNK_FIELDS))
+        seconds, number_of_chunks = median_seconds(get_chunks, query)
+        print "    %.2f ms, %s chunks" % (seconds * 1000, number_of_chunks)
+        results[description] = number_of_chunks
+    if len(set(results.values())) != 1:
+        raise Exception("the queries returned different chunks: %s" % results)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="benchmarks ChunkRegistry.get_chunks_time_range")
+    parser.add_argument("--rows", type=int, default=2000000)
+    parser.add_argument("--postgres", help="the name of an empty postgres database to use")
+    args = parser.parse_args()
+
+    database_name = configure_scratch_database(args.postgres)
+    from django.core.management import call_command
+    from django.db import connection
+    from django.utils import timezone
+    from database.data_access_models import ChunkRegistry
+    from database.study_models import Study
+    from database.user_models import Participant
+
+    print "migrating the %s database %s..." % (connection.vendor, database_name)
+    call_command("migrate", verbosity=0)
+    study, participants, data_types, first_time_bin, hours = seed(args.rows)
+
+    # a week of two data streams of one participant, from the middle of the data.
+    start = first_time_bin + timedelta(hours=hours // 2)
+    query = {
+        "study_id": study.pk,
+        "user_ids": [participants[len(participants) // 2].patient_id],
+        "data_types": data_types[:2],
+        "start": start,
+        "end": start + timedelta(days=7),
+    }
+
+    print "\n### without %s" % INDEX_NAME
+    index_definition = drop_index()
+    compare(query)
+    print "\n### with %s" % INDEX_NAME
+    with connection.cursor() as cursor:
+        cursor.execute(index_definition)
+        cursor.execute("ANALYZE")
+    compare(query)
+
+    if connection.vendor == "sqlite":
+        os.remove(database_name)
@@ -0,0 +1,60 @@
+""" Compares decrypt_device_file with line-by-line decryption (the way decrypt_device_file used to
+work) on a synthetic file of device-encrypted lines, and checks that the output is identical.
+usage: python scripts/benchmark_device_decryption.py [number_of_lines] """
+import sys
+from os import urandom
+from random import random
+from time import time
+
+from Crypto.Cipher import AES
+from Crypto.PublicKey import RSA
+
+from libs.encryption import decrypt_device_file, decrypt_device_line
+from libs.security import decode_base64, encode_base64
+
+
+def encrypt_device_line(key, line):
+    """ Encrypts a line the way the apps do: AES CBC with PKCS5 padding and a random iv. """
+    iv = urandom(16)
+    padding_length = 16 - len(line) % 16
+    data = AES.new(key, mode=AES.MODE_CBC, IV=iv).encrypt(line + chr(padding_length) * padding_length)
+    return encode_base64(iv) + ":" + encode_base64(data)
+
+
+def synthetic_device_file(private_key, number_of_lines):
+    aes_key = urandom(16)
+    # the key line is the aes key, base64 encoded, rsa encrypted and base64 encoded again.
+    key_line = encode_base64(private_key.publickey().encrypt(encode_base64(aes_key), 0)[0])
+    lines = [key_line]
+    for i in xrange(number_of_lines):
+        line = "%s,unknown,%.6f,%.6f,%.6f" % (1500000000000 + i * 100, random(), random(), random())
+        lines.append(encrypt_device_line(aes_key, line))
+    return "\n".join(lines)
+
+
+def line_by_line_decryption(file_contents, private_key):
+    file_data = [line for line in file_contents.split('\n') if line != ""]
+    decrypted_key = decode_base64(private_key.decrypt(decode_base64(file_data[0])))
+    return_data = ""
+    for line in file_data[1:]:
+        return_data += decrypt_device_line("patient", decrypted_key, line) + "\n"
+    return return_data
+
+
+if __name__ == "__main__":
+    number_of_lines = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    print "generating %s encrypted lines..." % number_of_lines
+    private_key = RSA.generate(2048)
+    file_contents = synthetic_device_file(private_key, number_of_lines)
+
+    t1 = time()
+    old_output = line_by_line_decryption(file_contents, private_key)
+    t2 = time()
+    new_output = decrypt_device_file("patient", file_contents, private_key, None)
+    t3 = time()
+    print "line by line decryption: %.3f seconds" % (t2 - t1)
+    print "decrypt_device_file:     %.3f seconds" % (t3 - t2)
+
+    if old_output != new_output:
+        raise Exception("decrypted output differs between the two decryption paths.")
+    print "decrypted output is identical."
@@ -0,0 +1,31 @@
+""" Compares the encryption and decryption throughput of the server encryption formats on
+chunk-sized payloads, and checks that every format decrypts back to the original data.
+usage: python scripts/benchmark_server_encryption.py [payload_megabytes] """
+import sys
+from os import urandom
+from time import time
+
+from libs.encryption import (SERVER_ENCRYPTION_HEADER_LENGTH, SERVER_ENCRYPTION_VERSIONS,
+    new_server_cipher, server_decryption_cipher)
+
+
+def throughput(megabytes, seconds):
+    return "%.1f MB/s" % (megabytes / seconds) if seconds else "-"
+
+
+if __name__ == "__main__":
+    payload_megabytes = float(sys.argv[1]) if len(sys.argv) > 1 else 4
+    payload = urandom(int(payload_megabytes * 1024 * 1024))
+    encryption_key = urandom(32)
+
+    for mode, version in sorted(SERVER_ENCRYPTION_VERSIONS.items()):
+        t1 = time()
+        header, cipher = new_server_cipher(encryption_key, version)
+        encrypted = header + cipher.encrypt(payload)
+        t2 = time()
+        decrypted = server_decryption_cipher(encryption_key, encrypted[:SERVER_ENCRYPTION_HEADER_LENGTH])\
+            .decrypt(encrypted[SERVER_ENCRYPTION_HEADER_LENGTH:])
+        t3 = time()
+        assert decrypted == payload, "%s did not decrypt to the original data" % mode
+        print "%s: encrypt %s, decrypt %s" % (mode, throughput(payload_megabytes, t2 - t1),
+                                              throughput(payload_megabytes, t3 - t2))
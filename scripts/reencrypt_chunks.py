@@ -0,0 +1,83 @@
+""" Rewrites chunked data on S3 in the encryption format that new files are written in
+(SERVER_ENCRYPTION_MODE, or compressed chunks of csv data if CHUNK_COMPRESSION_LEVEL is set), most
+recently updated chunks first, as those are the ones that are downloaded and reprocessed the most.
+Chunks that are already in that format only have their header downloaded.
+
+The chunker rewrites chunks while it runs, so chunks are re-encrypted in batches while holding the
+FileProcessLock, and the tool waits for the chunker between batches.
+usage: python scripts/reencrypt_chunks.py [--study OBJECT_ID] [--data_type DATA_TYPE] [--limit N] """
+import argparse
+from multiprocessing.pool import ThreadPool
+from time import sleep
+
+import config.load_django
+from config.constants import CHUNK_COMPRESSION_LEVEL, CONCURRENT_NETWORK_OPS
+from database.data_access_models import ChunkRegistry, FileProcessLock
+from libs.s3 import s3_reencrypt
+
+BATCH_SIZE = 500
+LOCK_WAIT_SECONDS = 60
+
+
+def reencrypt_chunk(chunk_path_study_and_chunkable):
+    chunk_path, study_object_id, is_chunkable = chunk_path_study_and_chunkable
+    # unchunkable data (e.g. audio) is already compressed.
+    compression_level = CHUNK_COMPRESSION_LEVEL if is_chunkable else 0
+    try:
+        return s3_reencrypt(chunk_path, study_object_id, compression_level)
+    except Exception as e:
+        print("could not re-encrypt %s: %s" % (chunk_path, e))
+        return None
+
+
+def reencrypt_batch(pool, batch):
+    """ Re-encrypts a batch of chunks while holding the FileProcessLock, returns the results of
+    reencrypt_chunk. """
+    while FileProcessLock.islocked():
+        print("waiting for data processing to finish...")
+        sleep(LOCK_WAIT_SECONDS)
+    FileProcessLock.lock()
+    try:
+        return pool.map(reencrypt_chunk, batch, chunksize=1)
+    finally:
+        FileProcessLock.unlock()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Re-encrypt chunked data in the current server encryption format")
+    parser.add_argument('--study', help='only re-encrypt the chunks of the study with this object id')
+    parser.add_argument('--data_type', help='only re-encrypt chunks of this data type')
+    parser.add_argument('--limit', help='re-encrypt at most this many chunks, 0 re-encrypts all of them',
+                        type=int, default=0)
+    args = parser.parse_args()
+
+    chunks = ChunkRegistry.objects.order_by('-last_updated')
+    if args.study:
+        chunks = chunks.filter(study__object_id=args.study)
+    if args.data_type:
+        chunks = chunks.filter(data_type=args.data_type)
+    chunks = chunks.values_list('chunk_path', 'study__object_id', 'is_chunkable')
+    if args.limit:
+        chunks = chunks[:args.limit]
+
+    pool = ThreadPool(CONCURRENT_NETWORK_OPS)
+    # reencrypt_chunk returns True for a rewritten chunk, False for a current one, None on errors.
+    totals = {True: 0, False: 0, None: 0}
+    batch = []
+    try:
+        for chunk in chunks.iterator():
+            batch.append(chunk)
+            if len(batch) == BATCH_SIZE:
+                for result in reencrypt_batch(pool, batch):
+                    totals[result] += 1
+                print("%s chunks re-encrypted, %s already current, %s errors"
+                      % (totals[True], totals[False], totals[None]))
+                batch = []
+        if batch:
+            for result in reencrypt_batch(pool, batch):
+                totals[result] += 1
+    finally:
+        pool.close()
+        pool.terminate()
+    print("done: %s chunks re-encrypted, %s already current, %s errors"
+          % (totals[True], totals[False], totals[None]))